@@ -0,0 +1,113 @@
+"""
+Requests/s and latency of the same query served by a sync handler (Session, run in FastAPI's threadpool) and by an
+async one (AsyncSession on the event loop), under many concurrent connections.
+
+The app below is served by uvicorn in a subprocess, against the database configured by the POSTGRES_* variables
+(or the SQLite test database with ENVIRONMENT=test).
+
+Usage:
+    python -m benchmarks.async_db
+    python -m benchmarks.async_db --requests 20000 --concurrency 500
+"""
+
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from shop.models import Item
+from shop.utils import get_async_db, get_db
+
+PORT = 8765
+QUERY = select(Item.id, Item.name, Item.price).order_by(Item.id).limit(20)
+
+app = FastAPI()
+
+
+@app.get("/sync/")
+def items_sync(db: Session = Depends(get_db)):
+    return [row._asdict() for row in db.execute(QUERY)]
+
+
+@app.get("/async/")
+async def items_async(db: AsyncSession = Depends(get_async_db)):
+    return [row._asdict() for row in await db.execute(QUERY)]
+
+
+async def load(client: httpx.AsyncClient, path: str, requests: int, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    remaining = iter(range(requests))
+
+    async def connection():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connection() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else float("nan")
+
+    return {
+        "requests/s": len(latencies) / elapsed,
+        "p50 ms": percentile(0.50),
+        "p95 ms": percentile(0.95),
+        "p99 ms": percentile(0.99),
+        "errors": errors,
+    }
+
+
+async def run(requests: int, concurrency: int):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", limits=limits, timeout=60) as client:
+        for _ in range(100):
+            try:
+                await client.get("/sync/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+        print(f"{'handler':<10}{'requests/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for path in ("/sync/", "/async/"):
+            # warm up the connections and the pools
+            await load(client, path, concurrency, concurrency)
+            result = await load(client, path, requests, concurrency)
+            print(
+                f"{path.strip('/'):<10}{result['requests/s']:>12,.0f}{result['p50 ms']:>10.1f}"
+                f"{result['p95 ms']:>10.1f}{result['p99 ms']:>10.1f}{result['errors']:>8}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.async_db", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    args = parser.parse_args()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.async_db:app", "--port", str(PORT), "--log-level", "warning"]
+    )
+    try:
+        asyncio.run(run(args.requests, args.concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
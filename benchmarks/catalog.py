@@ -0,0 +1,37 @@
+"""
+Catalog reads per second from the database (utils.get_available_items / get_item_by_slug) and from the in-process
+snapshot of shop/catalog.py, against the database configured by the POSTGRES_* variables (or the SQLite test database
+with ENVIRONMENT=test).
+
+Usage:
+    python -m benchmarks.catalog
+"""
+
+import timeit
+
+from shop import utils
+from shop.catalog import load_snapshot
+
+
+def main(number: int = 1000):
+    db = utils.get_session()
+    snapshot = load_snapshot(db, 1)
+    shop_slug = next(iter(snapshot.shops), None)
+    item_slug = next(iter(snapshot.slugs), None)
+    print(f"{len(snapshot.entries)} public items, {len(snapshot.shops)} shops")
+    reads = {
+        "items, database": lambda: utils.get_available_items(db, shop_slug),
+        "items, snapshot": lambda: snapshot.available_items(shop_slug),
+    }
+    if item_slug is not None:
+        reads["item, database"] = lambda: utils.get_item_by_slug(db, item_slug)
+        reads["item, snapshot"] = lambda: snapshot.get_item(item_slug)
+    print(f"{'read':<20}{'reads/s':>15}")
+    for name, read in reads.items():
+        seconds = timeit.timeit(read, number=number)
+        print(f"{name:<20}{number / seconds:>15,.0f}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,30 +3,30 @@ from typing import List, MutableMapping, Optional, Union
 
 from fastapi import HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTError
-from passlib.context import CryptContext
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm.session import Session
 
-from shop import constants
+from shop import constants, keyring, passwords
 from shop.models import NewsLetter, User
 
 JWTPayloadMapping = MutableMapping[str, Union[datetime, bool, str, List[str], List[int]]]
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
-PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
+PWD_CONTEXT = passwords.PWD_CONTEXT
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return PWD_CONTEXT.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await passwords.password_hasher.verify(plain_password, hashed_password)
 
 
-def authenticate(*, email: str, password: str, db: Session) -> Optional[User]:
-    user = db.query(User).filter(User.email == email).first()
+async def authenticate(*, email: str, password: str, db: AsyncSession) -> Optional[User]:
+    user = await db.scalar(select(User).where(User.email == email))
     if not user:
         return None
-    if not verify_password(password, user.password):  # 1
+    if not await verify_password(password, user.password):  # 1
         return None
     return user
 
@@ -47,12 +47,12 @@ def _create_token(token_type: str, lifetime: timedelta, sub: str) -> str:
     payload["iat"] = datetime.utcnow()
     payload["sub"] = str(sub)
 
-    return jwt.encode(payload, constants.JWT_SECRET, constants.ALGORITHM)
+    return keyring.encode(payload)
 
 
 def verify_token(token: str, db: Session):
     try:
-        payload = jwt.decode(token, constants.JWT_SECRET, algorithms=[constants.ALGORITHM])
+        payload = keyring.decode(token)
         user = db.query(User).filter(User.id == payload.get("sub")).first()
         if user:
             return user
@@ -66,7 +66,7 @@ def verify_token(token: str, db: Session):
 
 def verify_token_newsletter(token: str, db: Session):
     try:
-        payload = jwt.decode(token, constants.JWT_SECRET, algorithms=[constants.ALGORITHM])
+        payload = keyring.decode(token)
         email: str = payload.get("sub")
 
         if email is None:
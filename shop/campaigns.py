@@ -0,0 +1,171 @@
+"""
+Sends scheduled newsletter campaigns to the active NewsLetter subscribers.
+
+Subscribers are streamed in id order (through a server-side cursor on Postgres) and sent to in chunks of up to 1000,
+the most personalizations SendGrid accepts in one request. The campaign is rendered once per chunk, only the
+`{{email}}` and `{{unsubscribe_url}}` substitutions differ per subscriber. After every chunk the id of its last
+subscriber is checkpointed, so a campaign interrupted by a crash or a failed request resumes after the last chunk
+that was accepted; at most the chunk in flight is sent twice.
+
+A chunk refused because of a recipient (a 400 whose errors point at the personalizations) is split until the
+refused subscribers are isolated, they are skipped and counted in rejected_count. Other failures (network errors,
+429, 5xx, but also an invalid API key or a message the provider refuses, which concern every recipient) are retried
+with exponential backoff; after EMAIL_MAX_ATTEMPTS failed attempts on the same chunk the campaign is marked failed,
+with the error in last_error.
+
+Campaigns are sent by the email worker (python -m shop.email_worker).
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy import or_, select
+from sqlalchemy.orm import Session
+
+from shop import constants, keyring, utils
+from shop.models import NewsLetter, NewsletterCampaign
+from shop.schemas import CampaignStatusEnum
+
+CHUNK_SIZE = 1000
+# how long a worker holds a campaign between checkpoints
+LOCK_TIMEOUT = timedelta(minutes=5)
+
+
+def unsubscribe_url(email: str) -> str:
+    expiration_time = datetime.utcnow() + timedelta(days=30)
+    token = keyring.encode({"sub": email, "exp": expiration_time})
+    return f"http://{constants.HOST}/newsletter/unsubscribe/?token={token}"
+
+
+def claim_campaign(db: Session, exclude_ids=()):
+    now = datetime.now(timezone.utc)
+    campaign = (
+        db.query(NewsletterCampaign)
+        .filter(
+            or_(
+                (NewsletterCampaign.status == CampaignStatusEnum.SCHEDULED) & (NewsletterCampaign.scheduled_at <= now),
+                NewsletterCampaign.status == CampaignStatusEnum.SENDING,
+            ),
+            or_(NewsletterCampaign.locked_until.is_(None), NewsletterCampaign.locked_until <= now),
+            NewsletterCampaign.id.notin_(exclude_ids),
+        )
+        .order_by(NewsletterCampaign.scheduled_at)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if campaign:
+        campaign.status = CampaignStatusEnum.SENDING
+        campaign.started_at = campaign.started_at or now
+        campaign.locked_until = now + LOCK_TIMEOUT
+    db.commit()
+    return campaign
+
+
+def stream_subscribers(db: Session, after_id: int, chunk_size: int):
+    subscribers = select(NewsLetter.id, NewsLetter.email).where(NewsLetter.is_active == True).order_by(NewsLetter.id)
+    if db.get_bind().dialect.name == "postgresql":
+        # a session of its own, so checkpoint commits do not close the server-side cursor
+        stream_db = utils.get_session()
+        try:
+            result = stream_db.execute(
+                subscribers.where(NewsLetter.id > after_id).execution_options(yield_per=chunk_size)
+            )
+            for chunk in result.partitions():
+                yield chunk
+        finally:
+            stream_db.close()
+    else:
+        # SQLite can't commit while a cursor is reading, chunks are read with keyset pagination instead
+        while True:
+            chunk = db.execute(subscribers.where(NewsLetter.id > after_id).limit(chunk_size)).all()
+            if not chunk:
+                return
+            yield chunk
+            after_id = chunk[-1].id
+
+
+def refuses_recipient(response: httpx.Response) -> bool:
+    # SendGrid names the field of every error, recipients are in personalizations.<n>.to.<n>.email
+    if response.status_code != 400:
+        return False
+    try:
+        errors = response.json()["errors"]
+        return any(str(error.get("field") or "").startswith("personalizations") for error in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+async def send_chunk(client: httpx.AsyncClient, message: dict, chunk: list) -> list:
+    """
+    Sends the message to the subscribers of the chunk, returns the (email, error) of the ones the provider refused.
+    Raises httpx.HTTPError for the failures worth retrying.
+    """
+    personalizations = [
+        {
+            "to": [{"email": subscriber.email}],
+            "substitutions": {"{{email}}": subscriber.email, "{{unsubscribe_url}}": unsubscribe_url(subscriber.email)},
+        }
+        for subscriber in chunk
+    ]
+    response = await client.post("/v3/mail/send", json=dict(message, personalizations=personalizations))
+    if response.is_success:
+        return []
+    if not refuses_recipient(response):
+        response.raise_for_status()
+    # a refused recipient fails the same way on every attempt, the halves without the refused subscribers are sent
+    if len(chunk) == 1:
+        return [(chunk[0].email, f"{response.status_code}: {response.text[:500]}")]
+    middle = len(chunk) // 2
+    return await send_chunk(client, message, chunk[:middle]) + await send_chunk(client, message, chunk[middle:])
+
+
+async def send_campaign(client: httpx.AsyncClient, db: Session, campaign: NewsletterCampaign, chunk_size: int):
+    message = {
+        "from": {"email": constants.FROM_EMAIL},
+        "subject": campaign.subject,
+        "content": [{"type": "text/html", "value": campaign.html_content}],
+    }
+    subscribers = stream_subscribers(db, campaign.last_newsletter_id, chunk_size)
+    try:
+        for chunk in subscribers:
+            rejected = await send_chunk(client, message, chunk)
+            campaign.last_newsletter_id = chunk[-1].id
+            campaign.sent_count += len(chunk) - len(rejected)
+            if rejected:
+                campaign.rejected_count += len(rejected)
+                campaign.last_error = "; ".join(f"{email}: {error}" for email, error in rejected)[:2000]
+            campaign.attempts = 0
+            campaign.locked_until = datetime.now(timezone.utc) + LOCK_TIMEOUT
+            db.commit()
+    except httpx.HTTPError as e:
+        db.rollback()
+        campaign.attempts += 1
+        campaign.last_error = repr(e)
+        if campaign.attempts >= constants.EMAIL_MAX_ATTEMPTS:
+            campaign.status = CampaignStatusEnum.FAILED
+            campaign.locked_until = None
+        else:
+            # resumed from the checkpoint once the retry delay is over
+            delay = constants.EMAIL_RETRY_DELAY * 2 ** (campaign.attempts - 1)
+            campaign.locked_until = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        db.commit()
+        return
+    finally:
+        subscribers.close()
+    campaign.status = CampaignStatusEnum.SENT
+    campaign.finished_at = datetime.now(timezone.utc)
+    campaign.locked_until = None
+    db.commit()
+
+
+async def send_due_campaigns(client: httpx.AsyncClient, db: Session, chunk_size: int = CHUNK_SIZE) -> int:
+    sent = 0
+    claimed = []
+    while True:
+        # an interrupted campaign waits for its retry delay, and is never retried in the same run
+        campaign = claim_campaign(db, exclude_ids=claimed)
+        if not campaign:
+            return sent
+        claimed.append(campaign.id)
+        await send_campaign(client, db, campaign, chunk_size)
+        sent += campaign.status == CampaignStatusEnum.SENT
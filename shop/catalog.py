@@ -0,0 +1,503 @@
+"""
+In-process snapshot of the public catalog: the approved and available items, indexed by slug, shop and category, and
+the shop slugs and category names their listings are filtered by. GET /items/ and GET /item/{slug}/ are served from
+it without touching the database.
+
+A snapshot is never modified, every change builds the next version. Item, Category and Shop changes made through the
+ORM are collected by SQLAlchemy events and, once their session commits, applied on the next read: only the changed
+items are read again. Bulk statements whose rows are not known (inserts not returning item.id, updates not filtered
+by id) and snapshots older than CATALOG_MAX_AGE are reloaded in full. One reader of the process applies the changes,
+the others keep reading the previous snapshot meanwhile.
+
+Other processes learn about the changes through an invalidation channel: Postgres LISTEN/NOTIFY, or with
+CATALOG_CHANNEL=file an append-only file shared by the processes of one host (SQLite and local runs). Behind
+PgBouncer the LISTEN connection goes straight to Postgres (CATALOG_LISTEN_DATABASE_URL).
+
+Items left out of a snapshot, listener disconnects and changes not published are logged and counted in
+cache.stats(), reported by /superuser/metrics/.
+"""
+
+import bisect
+import heapq
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import Counter, deque
+from typing import NamedTuple, Optional
+
+from pydantic import ValidationError
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+
+from shop import constants
+from shop.models import Category, Item, Shop
+from shop.schemas import ItemOut
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "catalog"
+# pg_notify payloads are limited to 8000 bytes, larger change sets are sent as a full reload
+MAX_NOTIFY_PAYLOAD = 7000
+# seconds between the reconnects of the listener, doubled after every failed one
+LISTEN_RETRY_DELAY = 1
+LISTEN_MAX_RETRY_DELAY = 60
+
+# failures the catalog recovers from, by kind
+_errors = Counter()
+_errors_lock = threading.Lock()
+
+
+def _count_error(kind: str):
+    with _errors_lock:
+        _errors[kind] += 1
+
+
+class Entry(NamedTuple):
+    item: ItemOut
+    shop_id: int
+
+
+class Snapshot:
+    def __init__(
+        self,
+        version: int,
+        entries: dict,
+        shops: dict,
+        categories: dict,
+        item_ids: list = None,
+        slugs: dict = None,
+        shop_items: dict = None,
+        category_items: dict = None,
+    ):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # item id -> Entry, shop slug -> shop id, category id -> (shop id, name)
+        self.entries = entries
+        self.shops = shops
+        self.categories = categories
+        self.category_names = {}
+        for category_id, (shop_id, name) in categories.items():
+            self.category_names.setdefault(name, set()).add(category_id)
+        if item_ids is None:
+            # indexes of a full load, incremental updates pass the ones they copied and changed
+            item_ids, slugs, shop_items, category_items = sorted(entries), {}, {}, {}
+            for item_id in item_ids:
+                item, shop_id = entries[item_id]
+                slugs[item.slug] = item_id
+                shop_items.setdefault(shop_id, []).append(item_id)
+                category_items.setdefault(item.category_id, []).append(item_id)
+        self.item_ids = item_ids
+        self.slugs = slugs
+        self.shop_items = shop_items
+        self.category_items = category_items
+
+    def get_item(self, item_slug: str) -> Optional[ItemOut]:
+        item_id = self.slugs.get(item_slug)
+        return self.entries[item_id].item if item_id is not None else None
+
+    def available_items(self, shop_slug: str = None, category_name: str = None, limit: int = 50, after=None):
+        # same filters as utils.get_available_items: unknown shops and categories are ignored
+        shop_id = self.shops.get(shop_slug) if shop_slug else None
+        category_ids = None
+        if category_name and not (shop_slug and shop_id is None):
+            category_ids = [
+                category_id
+                for category_id in self.category_names.get(category_name, ())
+                if shop_id is None or self.categories[category_id][0] == shop_id
+            ] or None
+
+        if category_ids:
+            candidates = heapq.merge(*(self._after(self.category_items.get(c, []), after) for c in category_ids))
+        elif shop_id is not None:
+            candidates = self._after(self.shop_items.get(shop_id, []), after)
+        else:
+            candidates = self._after(self.item_ids, after)
+
+        items = []
+        for item_id in candidates:
+            entry = self.entries[item_id]
+            if shop_id is not None and entry.shop_id != shop_id:
+                continue
+            items.append(entry.item)
+            if len(items) > limit:
+                break
+        next_cursor = items[limit - 1].id if len(items) > limit else None
+        return items[:limit], next_cursor
+
+    @staticmethod
+    def _after(item_ids: list, after):
+        if after is None:
+            return iter(item_ids)
+        return (item_ids[index] for index in range(bisect.bisect_right(item_ids, after), len(item_ids)))
+
+
+def _public_items(db: Session):
+    return db.query(Item).filter(Item.is_approved == True, Item.is_available == True)
+
+
+def _load_shops(db: Session) -> dict:
+    return dict(db.query(Shop.slug, Shop.id).all())
+
+
+def _load_categories(db: Session) -> dict:
+    return {
+        category_id: (shop_id, name)
+        for category_id, shop_id, name in db.query(Category.id, Category.shop_id, Category.name)
+    }
+
+
+def _entry(item: Item) -> Optional[Entry]:
+    try:
+        return Entry(ItemOut.model_validate(item), item.shop_id)
+    except ValidationError as e:
+        # left out rather than failing the whole catalog, /item/{slug}/ reads it from the database
+        logger.warning("Item %s left out of the catalog: %r", item.id, e)
+        _count_error("items_left_out")
+        return None
+
+
+def load_snapshot(db: Session, version: int) -> Snapshot:
+    entries = {item.id: entry for item in _public_items(db) if (entry := _entry(item))}
+    return Snapshot(version, entries, _load_shops(db), _load_categories(db))
+
+
+def _remove_id(index: dict, key, item_id: int):
+    item_ids = list(index[key])
+    item_ids.remove(item_id)
+    index[key] = item_ids
+
+
+def _insert_id(index: dict, key, item_id: int):
+    item_ids = list(index.get(key, []))
+    bisect.insort(item_ids, item_id)
+    index[key] = item_ids
+
+
+def update_snapshot(db: Session, snapshot: Snapshot, item_ids: set, shops_changed: bool) -> Snapshot:
+    # copy on write: the indexes of the changed items are copied, the ones of the others are shared
+    entries, slugs = dict(snapshot.entries), dict(snapshot.slugs)
+    shop_items, category_items = dict(snapshot.shop_items), dict(snapshot.category_items)
+    all_ids = list(snapshot.item_ids)
+    for item_id in item_ids:
+        entry = entries.pop(item_id, None)
+        if entry:
+            del slugs[entry.item.slug]
+            _remove_id(shop_items, entry.shop_id, item_id)
+            _remove_id(category_items, entry.item.category_id, item_id)
+            all_ids.pop(bisect.bisect_left(all_ids, item_id))
+    if item_ids:
+        for item in _public_items(db).filter(Item.id.in_(item_ids)):
+            entry = _entry(item)
+            if entry is None:
+                continue
+            entries[item.id] = entry
+            slugs[item.slug] = item.id
+            _insert_id(shop_items, item.shop_id, item.id)
+            _insert_id(category_items, item.category_id, item.id)
+            bisect.insort(all_ids, item.id)
+    shops = _load_shops(db) if shops_changed else snapshot.shops
+    categories = _load_categories(db) if shops_changed else snapshot.categories
+    return Snapshot(snapshot.version + 1, entries, shops, categories, all_ids, slugs, shop_items, category_items)
+
+
+class FileChannel:
+    """
+    Invalidation channel for the processes of one host: every commit appends a line to the file, every process reads
+    the lines added since its last look. Reading costs a stat() while nothing changed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offset = os.path.getsize(path) if os.path.exists(path) else 0
+        # readers of the threadpool receive concurrently, each line must be read once
+        self._lock = threading.Lock()
+
+    def publish(self, message: dict):
+        # one write() of a line opened in append mode, so lines of concurrent writers don't interleave
+        with open(self.path, "ab") as file:
+            file.write(json.dumps(message).encode() + b"\n")
+
+    def receive(self) -> list:
+        with self._lock:
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                return []
+            if size == self._offset:
+                return []
+            if size < self._offset:
+                # the file was truncated, whatever was in it is unknown
+                self._offset = 0
+                return [{"full": True}]
+            with open(self.path, "rb") as file:
+                file.seek(self._offset)
+                data = file.read(size - self._offset)
+            # a line still being written is read next time
+            complete = data[: data.rfind(b"\n") + 1]
+            self._offset += len(complete)
+        return [json.loads(line) for line in complete.splitlines()]
+
+
+class PostgresChannel:
+    """
+    Invalidation channel through Postgres NOTIFY, received by a thread LISTENing on a connection of its own, taken
+    from `listen_engine` when given.
+    """
+
+    def __init__(self, engine, listen_engine=None):
+        self.engine = engine
+        self.listen_engine = listen_engine or engine
+        self._messages = deque()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, message: dict):
+        payload = json.dumps(message)
+        if len(payload) > MAX_NOTIFY_PAYLOAD:
+            payload = json.dumps({"pid": message.get("pid"), "full": True})
+        with self.engine.begin() as connection:
+            connection.execute(
+                text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": payload}
+            )
+
+    def receive(self) -> list:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="catalog-listener", daemon=True)
+                self._thread.start()
+        messages = []
+        while self._messages:
+            messages.append(self._messages.popleft())
+        return messages
+
+    def _listen(self):
+        delay = LISTEN_RETRY_DELAY
+        connected = False
+        while True:
+            try:
+                connection = self.listen_engine.raw_connection()
+                # the connection is left out of the pool, it only ever listens
+                connection.detach()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+                if connected:
+                    # notifications may have been missed while reconnecting, reloaded once the listener is back
+                    logger.info("Catalog listener reconnected")
+                    self._messages.append({"full": True})
+                connected, delay = True, LISTEN_RETRY_DELAY
+                while True:
+                    if select.select([dbapi_connection], [], [], 5) != ([], [], []):
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            self._messages.append(json.loads(dbapi_connection.notifies.pop(0).payload))
+            except Exception:
+                logger.exception("Catalog listener disconnected, reconnecting in %s s", delay)
+                _count_error("listener_disconnects")
+                time.sleep(delay)
+                delay = min(delay * 2, LISTEN_MAX_RETRY_DELAY)
+
+
+class CatalogCache:
+    def __init__(self, max_age: float, channel=None):
+        self.max_age = max_age
+        self.channel = channel
+        self._snapshot = None
+        self._pending_items = set()
+        self._pending_shops = False
+        self._pending_full = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def invalidate(self, items=(), shops: bool = False, full: bool = False):
+        with self._lock:
+            self._pending_items.update(items)
+            self._pending_shops = self._pending_shops or shops
+            self._pending_full = self._pending_full or full
+
+    def _receive(self):
+        if self.channel is None:
+            return
+        for message in self.channel.receive():
+            # changes of this process were applied when they were committed
+            if message.get("pid") != os.getpid():
+                self.invalidate(message.get("items", ()), message.get("shops", False), message.get("full", False))
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        with _errors_lock:
+            errors = dict(_errors)
+        return {
+            "version": snapshot.version if snapshot else None,
+            "items": len(snapshot.entries) if snapshot else 0,
+            "age_seconds": time.monotonic() - snapshot.loaded_at if snapshot else None,
+            "channel": type(self.channel).__name__ if self.channel else None,
+            "items_left_out": errors.get("items_left_out", 0),
+            "listener_disconnects": errors.get("listener_disconnects", 0),
+            "publish_failures": errors.get("publish_failures", 0),
+        }
+
+    def _is_current(self) -> bool:
+        return (
+            self._snapshot is not None
+            and not (self._pending_items or self._pending_shops or self._pending_full)
+            and time.monotonic() - self._snapshot.loaded_at < self.max_age
+        )
+
+    def snapshot(self, session_factory) -> Snapshot:
+        self._receive()
+        if self._is_current():
+            return self._snapshot
+        # one reader refreshes, the others keep reading the previous snapshot meanwhile. They only wait for the first
+        # snapshot of the process.
+        if not self._refresh_lock.acquire(blocking=self._snapshot is None):
+            return self._snapshot
+        try:
+            if self._is_current():
+                return self._snapshot
+            with self._lock:
+                items, shops, full = self._pending_items, self._pending_shops, self._pending_full
+                self._pending_items, self._pending_shops, self._pending_full = set(), False, False
+            snapshot = self._snapshot
+            db = session_factory()
+            try:
+                if snapshot is None or full or time.monotonic() - snapshot.loaded_at >= self.max_age:
+                    snapshot = load_snapshot(db, snapshot.version + 1 if snapshot else 1)
+                else:
+                    snapshot = update_snapshot(db, snapshot, items, shops)
+            except Exception:
+                # the changes are applied by the next read
+                self.invalidate(items, shops, full)
+                raise
+            finally:
+                db.close()
+            self._snapshot = snapshot
+            return snapshot
+        finally:
+            self._refresh_lock.release()
+
+
+def _get_channel():
+    if constants.CATALOG_CHANNEL == "file":
+        return FileChannel(constants.CATALOG_CHANNEL_FILE)
+    if constants.CATALOG_CHANNEL == "postgres" and os.getenv("ENVIRONMENT") != "test":
+        from shop.database import engine
+
+        if engine.dialect.name != "postgresql":
+            return None
+        if constants.CATALOG_LISTEN_DATABASE_URL:
+            return PostgresChannel(engine, create_engine(constants.CATALOG_LISTEN_DATABASE_URL, poolclass=NullPool))
+        if constants.DB_PGBOUNCER:
+            # the other processes would never hear about changes, and serve them for up to CATALOG_MAX_AGE
+            raise RuntimeError(
+                "CATALOG_CHANNEL=postgres with DB_PGBOUNCER needs CATALOG_LISTEN_DATABASE_URL, a connection that "
+                "bypasses PgBouncer, or another CATALOG_CHANNEL."
+            )
+        return PostgresChannel(engine)
+    return None
+
+
+cache = CatalogCache(constants.CATALOG_MAX_AGE, _get_channel())
+
+
+# Collecting the changes of a session, published once it commits
+
+
+def _changes(db: Session) -> dict:
+    return db.info.setdefault("catalog_changes", {"items": set(), "shops": False, "full": False})
+
+
+@event.listens_for(Item, "after_insert")
+@event.listens_for(Item, "after_update")
+@event.listens_for(Item, "after_delete")
+def _item_changed(mapper, connection, target):
+    _changes(Session.object_session(target))["items"].add(target.id)
+
+
+@event.listens_for(Category, "after_insert")
+@event.listens_for(Category, "after_update")
+@event.listens_for(Category, "after_delete")
+@event.listens_for(Shop, "after_insert")
+@event.listens_for(Shop, "after_update")
+@event.listens_for(Shop, "after_delete")
+def _shop_changed(mapper, connection, target):
+    _changes(Session.object_session(target))["shops"] = True
+
+
+def _filtered_item_ids(statement) -> Optional[list]:
+    # ids of `WHERE item.id = ...` and `WHERE item.id IN (...)`, None for any other filter
+    where = statement.whereclause
+    if not isinstance(where, BinaryExpression) or not isinstance(where.right, BindParameter):
+        return None
+    if getattr(where.left, "table", None) is not Item.__table__ or where.left.key != "id":
+        return None
+    if where.operator is operators.eq:
+        return [where.right.effective_value]
+    if where.operator is operators.in_op:
+        return list(where.right.effective_value)
+    return None
+
+
+def _inserted_items(orm_execute_state, changes: dict):
+    # a bulk insert returning item.id (like the /item/bulk import) adds the rows it returns, any other one can't
+    # tell which rows it added
+    columns = orm_execute_state.statement.returning_column_descriptions
+    id_index = next((i for i, column in enumerate(columns) if column["expr"] is Item.id), None)
+    if id_index is None:
+        changes["full"] = True
+        return None
+    frozen = orm_execute_state.invoke_statement().freeze()
+    changes["items"].update(row[id_index] for row in frozen.data)
+    return frozen()
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_statement(orm_execute_state):
+    if not (orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None:
+        return
+    changes = _changes(orm_execute_state.session)
+    if mapper.class_ is Item and orm_execute_state.is_insert:
+        return _inserted_items(orm_execute_state, changes)
+    if mapper.class_ is Item:
+        item_ids = _filtered_item_ids(orm_execute_state.statement)
+        if item_ids is None:
+            changes["full"] = True
+        else:
+            changes["items"].update(item_ids)
+    elif mapper.class_ in (Category, Shop):
+        changes["shops"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _session_committed(db):
+    changes = db.info.pop("catalog_changes", None)
+    if not changes or not (changes["items"] or changes["shops"] or changes["full"]):
+        return
+    cache.invalidate(changes["items"], changes["shops"], changes["full"])
+    if cache.channel is not None:
+        message = {
+            "pid": os.getpid(),
+            "items": sorted(changes["items"]),
+            "shops": changes["shops"],
+            "full": changes["full"],
+        }
+        try:
+            cache.channel.publish(message)
+        except Exception:
+            # the other processes pick the change up when their snapshot expires
+            logger.exception("Catalog change not published")
+            _count_error("publish_failures")
+
+
+@event.listens_for(Session, "after_rollback")
+def _session_rolled_back(db):
+    db.info.pop("catalog_changes", None)
@@ -0,0 +1,36 @@
+"""
+Maintenance commands.
+
+Usage:
+    python -m shop.commands backfill-revenue
+    python -m shop.commands repair-ratings
+    python -m shop.commands process-stripe-events
+"""
+
+import argparse
+
+from shop import utils
+from shop.database import SessionLocal
+
+COMMANDS = {
+    "backfill-revenue": utils.rebuild_shop_revenue,
+    "repair-ratings": utils.rebuild_item_ratings,
+    "process-stripe-events": utils.process_stripe_events,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m shop.commands", description="Shop-online maintenance commands.")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        COMMANDS[args.command](db)
+        db.commit()
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
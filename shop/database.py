@@ -1,8 +1,16 @@
 import os
+import threading
+import time
+from typing import Optional
+from uuid import uuid4
 
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 
 from shop import constants
 
@@ -14,11 +22,202 @@ SQLALCHEMY_DATABASE_URL = (
 # SQLALCHEMY_DATABASE_URL = "sqlite:///./shop.db"
 # SQLALCHEMY_DATABASE_URL = os.getenv('SQLALCHEMY_DATABASE_URL')
 SQLALCHEMY_DATABASE_URL_TEST = "sqlite:///./test.db"
+# the same databases through the async drivers
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+ASYNC_SQLALCHEMY_DATABASE_URL_TEST = "sqlite+aiosqlite:///./test.db"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-test_engine = create_engine(SQLALCHEMY_DATABASE_URL_TEST, connect_args={"check_same_thread": False})
+
+class _TimedCheckout:
+    # counts checkouts and how long they waited for a free connection, exported by pool_stats(). The counters only
+    # grow, wait_max is the longest wait since the previous take_counters() (the previous scrape of the metrics).
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait = time.perf_counter() - started
+            # checkouts run on many threads at once, += is not atomic
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+    def take_counters(self) -> tuple[int, int, float, float]:
+        # (checkouts, timeouts, wait_total, wait_max), and starts the next window of wait_max
+        with self._stats_lock:
+            counters = self.checkouts, self.timeouts, self.wait_total, self.wait_max
+            self.wait_max = 0.0
+        return counters
+
+    def recreate(self):
+        # keeps the counters when the pool is recreated (engine.dispose())
+        pool = super().recreate()
+        with self._stats_lock:
+            pool.checkouts, pool.timeouts = self.checkouts, self.timeouts
+            pool.wait_total, pool.wait_max = self.wait_total, self.wait_max
+        return pool
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(asyncpg: bool = False) -> dict:
+    if constants.DB_PGBOUNCER:
+        # PgBouncer pools the connections: no second pool here, and no prepared statements, which don't survive
+        # PgBouncer handing the next transaction to another server connection
+        options = {"poolclass": NullPool}
+        if asyncpg:
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+            }
+        return options
+    return {
+        "poolclass": TimedAsyncAdaptedQueuePool if asyncpg else TimedQueuePool,
+        "pool_size": constants.DB_POOL_SIZE,
+        "max_overflow": constants.DB_MAX_OVERFLOW,
+        "pool_timeout": constants.DB_POOL_TIMEOUT,
+        "pool_recycle": constants.DB_POOL_RECYCLE,
+        "pool_pre_ping": constants.DB_POOL_PRE_PING,
+    }
+
+
+def pool_stats(engine) -> dict:
+    pool = engine.pool
+    if not isinstance(pool, _TimedCheckout):
+        return {"pool": type(pool).__name__}
+    checkouts, timeouts, wait_total, wait_max = pool.take_counters()
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "in_use": pool.checkedout(),
+        "idle": pool.checkedin(),
+        # QueuePool.overflow() counts down from -size while the pool is not full yet
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": pool._max_overflow,
+        "checkouts": checkouts,
+        "timeouts": timeouts,
+        "wait_avg_ms": wait_total / checkouts * 1000 if checkouts else 0.0,
+        # since the previous call, a lifetime maximum would hide every later spike behind the first one
+        "wait_max_ms": wait_max * 1000,
+    }
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options())
+test_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL_TEST, poolclass=TimedQueuePool, connect_args={"check_same_thread": False}
+)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
+# bound to the replica picked for the request
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+
+class ReplicaSet:
+    """
+    Read replicas picked round-robin for the read-only endpoints.
+    A replica is checked with `SELECT 1` when it is first picked and again every `health_interval` seconds, the ones
+    failing the check or a request are skipped until they pass it again. choose() returns None when no replica is
+    healthy (or none are configured), reads then go to the primary.
+    """
+
+    def __init__(self, engines: list, health_interval: float):
+        self.engines = engines
+        self.health_interval = health_interval
+        self._healthy = [False] * len(engines)
+        self._checked_at = [float("-inf")] * len(engines)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self) -> Optional[Engine]:
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.engines), 1)
+        for offset in range(len(self.engines)):
+            index = (start + offset) % len(self.engines)
+            if self._is_healthy(index):
+                return self.engines[index]
+        return None
+
+    def _is_healthy(self, index: int) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            due = now - self._checked_at[index] >= self.health_interval
+            if due:
+                # other requests keep the last result meanwhile
+                self._checked_at[index] = now
+        if due:
+            self._healthy[index] = self._ping(self.engines[index])
+        return self._healthy[index]
+
+    @staticmethod
+    def _ping(replica: Engine) -> bool:
+        try:
+            with replica.connect() as connection:
+                connection.exec_driver_sql("SELECT 1")
+        except DBAPIError:
+            return False
+        return True
+
+    def mark_down(self, replica: Engine):
+        index = self.engines.index(replica)
+        with self._lock:
+            self._healthy[index] = False
+            self._checked_at[index] = time.monotonic()
+
+
+replicas = ReplicaSet(
+    [create_engine(url, **engine_options()) for url in constants.DB_REPLICA_URLS], constants.DB_REPLICA_HEALTH_INTERVAL
+)
+
+# async engines are created on first use, so processes that never use them don't need asyncpg/aiosqlite
+_async_engines = {}
+_async_sessionmakers = {}
+
+
+def get_async_engine(test: bool = False) -> AsyncEngine:
+    if test not in _async_engines:
+        if test:
+            _async_engines[test] = create_async_engine(
+                ASYNC_SQLALCHEMY_DATABASE_URL_TEST, poolclass=TimedAsyncAdaptedQueuePool
+            )
+        else:
+            _async_engines[test] = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, **engine_options(asyncpg=True))
+    return _async_engines[test]
+
+
+def get_async_sessionmaker(test: bool = False) -> async_sessionmaker:
+    if test not in _async_sessionmakers:
+        # objects stay loaded after commit, an expired attribute can't be lazy loaded outside of an await
+        _async_sessionmakers[test] = async_sessionmaker(get_async_engine(test), autoflush=False, expire_on_commit=False)
+    return _async_sessionmakers[test]
+
+
+def async_pool_stats(test: bool = False):
+    # None until the async engine is used
+    if test not in _async_engines:
+        return None
+    return pool_stats(_async_engines[test].sync_engine)
+
 
 Base = declarative_base()
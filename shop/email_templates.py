@@ -0,0 +1,85 @@
+"""
+Registry of the email templates in shop/templates/emails.
+
+Every template is read and compiled once (at startup, or on first use outside the API) into a list of static
+fragments and the placeholders between them. Placeholders with the same value for every message, like `{{host}}`,
+are resolved while compiling and merged into the static fragments, so rendering a message only joins the fragments
+with the few values of its own context.
+
+`{{name}}` is replaced with the value of `name`, HTML-escaped in .html templates, and `{{name|raw}}` with the value
+as it is (for HTML rendered from another template).
+"""
+
+import html
+import os
+import re
+
+from shop import constants
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates", "emails")
+PLACEHOLDER = re.compile(r"{{\s*(\w+)(\|raw)?\s*}}")
+
+
+def escape_html(value) -> str:
+    return html.escape(str(value))
+
+
+class Template:
+    def __init__(self, name: str, source: str, static_context: dict):
+        self.name = name
+        escape = escape_html if name.endswith(".html") else str
+        # (static text before the placeholder, placeholder name, conversion of its value) and the text after the last
+        self.parts = []
+        static, position = [], 0
+        for match in PLACEHOLDER.finditer(source):
+            static.append(source[position : match.start()])
+            position = match.end()
+            key, convert = match.group(1), str if match.group(2) else escape
+            if key in static_context:
+                static.append(convert(static_context[key]))
+            else:
+                self.parts.append(("".join(static), key, convert))
+                static = []
+        static.append(source[position:])
+        self.tail = "".join(static)
+        self.placeholders = {key for static, key, convert in self.parts}
+
+    def render(self, context: dict) -> str:
+        rendered = []
+        try:
+            for static, key, convert in self.parts:
+                rendered.append(static)
+                rendered.append(convert(context[key]))
+        except KeyError as e:
+            raise KeyError(f"Template {self.name} needs a value for {e.args[0]}.") from None
+        rendered.append(self.tail)
+        return "".join(rendered)
+
+
+class TemplateRegistry:
+    def __init__(self, directory: str = TEMPLATES_DIR):
+        self.directory = directory
+        self.templates = {}
+
+    def static_context(self) -> dict:
+        return {"host": constants.HOST}
+
+    def load(self):
+        static_context = self.static_context()
+        templates = {}
+        for filename in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, filename), encoding="utf-8") as file:
+                templates[filename] = Template(filename, file.read().rstrip("\n"), static_context)
+        self.templates = templates
+
+    def get(self, name: str) -> Template:
+        if not self.templates:
+            self.load()
+        return self.templates[name]
+
+    def render(self, name: str, /, **context) -> str:
+        # positional-only, so templates can have a `name` placeholder
+        return self.get(name).render(context)
+
+
+registry = TemplateRegistry()
@@ -0,0 +1,150 @@
+"""
+Delivers the emails queued in the email_outbox table and the scheduled newsletter campaigns (see shop.campaigns)
+through the SendGrid API.
+
+Emails are claimed in batches (SKIP LOCKED on Postgres, so several workers can run side by side), sent concurrently
+over one pooled HTTP client and retried with exponential backoff until EMAIL_MAX_ATTEMPTS. When the provider refuses
+the API key itself, the emails wait without using up their attempts and the worker stops draining until its next poll.
+
+Usage:
+    python -m shop.email_worker
+    python -m shop.email_worker --once
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from shop import campaigns, constants, utils
+from shop.models import EmailOutbox
+
+# how long a claimed email is hidden from other workers while it is being sent
+CLAIM_TIMEOUT = timedelta(minutes=5)
+POLL_INTERVAL = 5
+# the provider refuses the API key (revoked or rotated): every email fails the same way until the key is fixed
+PROVIDER_ERRORS = {401, 403}
+
+
+def get_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=constants.SENDGRID_API_BASE,
+        headers={"Authorization": f"Bearer {constants.SENDGRID_API_KEY or ''}"},
+        timeout=10,
+        limits=httpx.Limits(max_connections=constants.EMAIL_WORKER_CONCURRENCY),
+    )
+
+
+def claim_emails(db: Session, batch_size: int) -> list:
+    now = datetime.now(timezone.utc)
+    emails = (
+        db.query(EmailOutbox.id, EmailOutbox.to_email, EmailOutbox.subject, EmailOutbox.html_content)
+        .filter(EmailOutbox.sent_at.is_(None), EmailOutbox.next_attempt_at <= now)
+        .order_by(EmailOutbox.next_attempt_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if emails:
+        db.execute(
+            update(EmailOutbox)
+            .where(EmailOutbox.id.in_([email.id for email in emails]))
+            .values(next_attempt_at=now + CLAIM_TIMEOUT)
+            .execution_options(synchronize_session=False)
+        )
+    db.commit()
+    return emails
+
+
+def record_results(db: Session, results: list):
+    now = datetime.now(timezone.utc)
+    sent_ids = [email_id for email_id, error, retry, counted in results if error is None]
+    if sent_ids:
+        db.execute(
+            update(EmailOutbox)
+            .where(EmailOutbox.id.in_(sent_ids))
+            .values(sent_at=now, next_attempt_at=None)
+            .execution_options(synchronize_session=False)
+        )
+    for email_id, error, retry, counted in results:
+        if error is None:
+            continue
+        email = db.get(EmailOutbox, email_id)
+        email.last_error = error
+        if not counted:
+            email.next_attempt_at = now + timedelta(seconds=constants.EMAIL_RETRY_DELAY)
+            continue
+        email.attempts += 1
+        if retry and email.attempts < constants.EMAIL_MAX_ATTEMPTS:
+            email.next_attempt_at = now + timedelta(seconds=constants.EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1))
+        else:
+            email.next_attempt_at = None
+    db.commit()
+
+
+async def send_email(client: httpx.AsyncClient, email) -> tuple:
+    """
+    Returns (email id, error, whether to retry, whether the failure counts as an attempt).
+    """
+    message = {
+        "personalizations": [{"to": [{"email": email.to_email}]}],
+        "from": {"email": constants.FROM_EMAIL},
+        "subject": email.subject,
+        "content": [{"type": "text/html", "value": email.html_content}],
+    }
+    try:
+        response = await client.post("/v3/mail/send", json=message)
+    except httpx.TransportError as e:
+        return email.id, repr(e), True, True
+    if response.is_success:
+        return email.id, None, False, True
+    error = f"{response.status_code}: {response.text[:500]}"
+    if response.status_code in PROVIDER_ERRORS:
+        return email.id, error, True, False
+    # other client errors will fail the same way on every attempt
+    retry = response.status_code == 429 or response.status_code >= 500
+    return email.id, error, retry, True
+
+
+async def drain(client: httpx.AsyncClient, db: Session, batch_size: int = 100) -> int:
+    semaphore = asyncio.Semaphore(constants.EMAIL_WORKER_CONCURRENCY)
+
+    async def send_limited(email):
+        async with semaphore:
+            return await send_email(client, email)
+
+    sent = 0
+    while True:
+        emails = claim_emails(db, batch_size)
+        if not emails:
+            return sent
+        results = await asyncio.gather(*(send_limited(email) for email in emails))
+        record_results(db, results)
+        sent += sum(1 for email_id, error, retry, counted in results if error is None)
+        if any(not counted for email_id, error, retry, counted in results):
+            # the rest of the outbox would fail the same way
+            return sent
+
+
+async def run(once: bool = False):
+    async with get_client() as client:
+        while True:
+            db = utils.get_session()
+            try:
+                await drain(client, db)
+                await campaigns.send_due_campaigns(client, db)
+            finally:
+                db.close()
+            if once:
+                return
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m shop.email_worker", description="Send queued emails.")
+    parser.add_argument("--once", action="store_true", help="exit when the outbox is empty")
+    args = parser.parse_args()
+    asyncio.run(run(once=args.once))
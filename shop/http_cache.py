@@ -0,0 +1,111 @@
+"""
+Conditional GETs for the public read endpoints.
+
+The routes compute a weak ETag from the versions of the rows they return, before anything is serialized: the id and
+updated_at of items and shops, and the ids of reviews, which are never edited. Single rows also get a Last-Modified.
+A request whose If-None-Match (or, without one, If-Modified-Since) still matches is answered with an empty 304.
+Responses carry Cache-Control for the nginx in front of the app (nginx.conf), which keeps them for
+HTTP_CACHE_SHARED_MAX_AGE seconds and then revalidates them with the same conditional requests.
+
+The other GET responses get an ETag hashed from their body by conditional_response(), which saves the transfer of
+an unchanged response but not the work of building it.
+"""
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+
+from shop import constants
+
+PUBLIC_CACHE_CONTROL = (
+    f"public, max-age={constants.HTTP_CACHE_MAX_AGE}, s-maxage={constants.HTTP_CACHE_SHARED_MAX_AGE}, must-revalidate"
+)
+# responses of the other endpoints may be personal, nginx doesn't keep them and browsers revalidate them
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+
+
+def weak_etag(*parts) -> str:
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _modified_at(row) -> Optional[datetime]:
+    # items have an updated_at, shops a modified_at, both None until the row is first updated
+    return getattr(row, "updated_at", None) or getattr(row, "modified_at", None)
+
+
+def row_version(row) -> tuple:
+    return row.id, _modified_at(row), row.created_at
+
+
+def rows_etag(rows, *parts) -> str:
+    return weak_etag([row_version(row) for row in rows], *parts)
+
+
+def _to_utc(value: datetime) -> datetime:
+    # HTTP dates have a resolution of seconds, naive datetimes (SQLite) are in UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # weak comparison, W/"x" matches "x"
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = _to_utc(parsedate_to_datetime(if_modified_since))
+    except (TypeError, ValueError):
+        return False
+    return _to_utc(last_modified) <= since
+
+
+def check_not_modified(request: Request, response: Response, etag: str, last_modified: Optional[datetime] = None):
+    """
+    Sets the validators and Cache-Control of a public response, and raises HTTPException 304 when the client's copy
+    is still current. Headers set on `response` before (e.g. X-Next-Cursor) are part of the 304 as well.
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = PUBLIC_CACHE_CONTROL
+    if last_modified is not None:
+        response.headers["Last-Modified"] = format_datetime(_to_utc(last_modified), usegmt=True)
+    if is_not_modified(request, etag, last_modified):
+        headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+        raise HTTPException(status_code=304, headers=headers)
+
+
+def check_row_not_modified(request: Request, response: Response, row):
+    check_not_modified(request, response, weak_etag(row_version(row)), _modified_at(row) or row.created_at)
+
+
+async def conditional_response(request: Request, response: Response) -> Response:
+    if request.method != "GET" or response.status_code != 200:
+        return response
+    if "cache-control" not in response.headers:
+        response.headers["Cache-Control"] = PRIVATE_CACHE_CONTROL
+    if "etag" in response.headers or not response.headers.get("content-type", "").startswith("application/json"):
+        return response
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = weak_etag(body)
+    # raw headers, so repeated ones like Set-Cookie are kept
+    raw_headers = response.raw_headers + [(b"etag", etag.encode())]
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        conditional = Response(status_code=304)
+        conditional.raw_headers = [(n, v) for n, v in raw_headers if n not in (b"content-length", b"content-type")]
+        return conditional
+    conditional = Response(body, status_code=response.status_code)
+    conditional.raw_headers = raw_headers
+    return conditional
@@ -1,16 +1,28 @@
-from fastapi import Depends, FastAPI, Query
+import math
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI, Query, Request, Response
 from fastapi.responses import HTMLResponse
 from sqlalchemy.orm import Session
 
-from shop import constants, models, schemas
+from shop import constants, email_templates, http_cache, migrations, models, payments, schemas
 from shop.database import engine
 from shop.routers import categories, items, orders, shops, signup, superuser, users
-from shop.utils import get_db
+from shop.utils import LAST_WRITE_COOKIE, get_catalog_items, get_read_db
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    email_templates.registry.load()
+    yield
+    await payments.close_client()
+
 
 if constants.ENVIRONMENT == "prod":
-    app = FastAPI(docs_url=None, redoc_url=None)
+    app = FastAPI(docs_url=None, redoc_url=None, lifespan=lifespan)
 else:
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
 app.include_router(users.router)
 app.include_router(signup.router)
@@ -20,8 +32,34 @@ app.include_router(shops.router)
 app.include_router(orders.router)
 app.include_router(superuser.router)
 
-# Create all tables in the database (if they don't exist)
-models.Base.metadata.create_all(bind=engine)
+# Create all tables in the database (if they don't exist) and apply pending migrations
+migrations.upgrade(engine)
+
+
+@app.middleware("http")
+async def remember_last_write(request: Request, call_next):
+    """
+    Marks the clients that just wrote something, so their reads go to the primary until the replicas caught up, and
+    skip the responses nginx kept from before their write (nginx.conf).
+    """
+    response = await call_next(request)
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        response.set_cookie(
+            LAST_WRITE_COOKIE,
+            str(time.time()),
+            max_age=math.ceil(max(constants.READ_YOUR_WRITES_WINDOW, constants.HTTP_CACHE_SHARED_MAX_AGE)),
+            httponly=True,
+            samesite="lax",
+        )
+    return response
+
+
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    """
+    Adds Cache-Control and a body ETag to the GET responses the routes didn't set them on, see shop/http_cache.py.
+    """
+    return await http_cache.conditional_response(request, await call_next(request))
 
 
 @app.get("/")
@@ -39,7 +77,7 @@ async def root():
 
 
 @app.get("/users/", response_model=list[schemas.UserOut])
-def get_all_users(db: Session = Depends(get_db)):
+def get_all_users(db: Session = Depends(get_read_db)):
     """
     Endpoint to get all users
     """
@@ -49,67 +87,20 @@ def get_all_users(db: Session = Depends(get_db)):
 
 @app.get("/items/", response_model=list[schemas.ItemOut])
 def get_all_items_with_filtering(
+    request: Request,
+    response: Response,
     shop: str = Query(None, description="Filter items by shop slug"),
     category: str = Query(None, description="Filter items by category name"),
-    db: Session = Depends(get_db),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of items to return"),
+    after: int = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    db: Session = Depends(get_read_db),
 ):
     """
-    Endpoint to get all items with filtering by shop's name and category's name
+    Endpoint to get all items with filtering by shop's name and category's name.
+    Items are paginated by cursor, the cursor of the next page is returned in the X-Next-Cursor header.
     """
-    all_items = (
-        db.query(models.Item)
-        .filter(
-            models.Item.is_approved == True,
-            models.Item.is_available == True,
-        )
-        .all()
-    )
-    if shop:
-        shop_exists = db.query(models.Shop).filter(models.Shop.slug == shop).first()
-        if shop_exists:
-            items_by_shop = (
-                db.query(models.Item)
-                .join(models.Item.shop)
-                .filter(
-                    models.Shop.slug == shop,
-                    models.Item.is_approved == True,
-                    models.Item.is_available == True,
-                )
-            )
-            if category:
-                category_exists = (
-                    db.query(models.Category)
-                    .join(models.Category.shop)
-                    .filter(
-                        models.Shop.slug == shop,
-                        models.Category.name == category,
-                    )
-                    .first()
-                )
-                if category_exists:
-                    items_by_shop_category = (
-                        items_by_shop.join(models.Item.category).filter(models.Category.name == category).all()
-                    )
-
-                    if items_by_shop_category:
-                        return items_by_shop_category
-
-            return items_by_shop.all()
-        else:
-            return all_items
-
-    if category:
-        items_by_category = (
-            db.query(models.Item)
-            .join(models.Item.category)
-            .filter(
-                models.Category.name == category,
-                models.Item.is_approved == True,
-                models.Item.is_available == True,
-            )
-            .all()
-        )
-        if items_by_category:
-            return items_by_category
-
-    return all_items
+    items, next_cursor = get_catalog_items(db, shop, category, limit, after)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    http_cache.check_not_modified(request, response, http_cache.rows_etag(items, next_cursor))
+    return items
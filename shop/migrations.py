@@ -0,0 +1,260 @@
+"""
+Versioned schema migrations.
+
+`create_all` only creates missing tables, so changes to tables that already exist (indexes, columns, constraints)
+are shipped here as numbered migrations. A fresh database is created from the models and stamped with the latest
+version, an existing one gets every migration it has not seen yet applied in order.
+
+On Postgres, upgrade() holds an advisory lock so the processes starting together apply them once, and indexes are
+created and dropped CONCURRENTLY so the tables stay writable meanwhile.
+
+Usage:
+    python -m shop.migrations
+"""
+
+import re
+from typing import NamedTuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import func
+
+from shop import models
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200)),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+
+class AddColumn(NamedTuple):
+    """
+    ALTER TABLE ADD COLUMN, skipped when the table already has the column: a table added since the database was
+    created is created by create_all() from the current model, with the columns of later migrations already in it.
+    """
+
+    table: str
+    column: str
+    definition: str
+
+    def run(self, connection: Connection):
+        if self.column not in {column["name"] for column in inspect(connection).get_columns(self.table)}:
+            connection.exec_driver_sql(f"ALTER TABLE {self.table} ADD COLUMN {self.column} {self.definition}")
+
+
+# pg_advisory_lock key of upgrade()
+MIGRATION_LOCK_KEY = 740_225_001
+# index statements built CONCURRENTLY on Postgres, they have to be idempotent (IF [NOT] EXISTS)
+INDEX_STATEMENT = re.compile(r"^((?:CREATE (?:UNIQUE )?|DROP )INDEX) IF (?:NOT )?EXISTS (\w+)", re.IGNORECASE)
+
+# (version, description, statements) - never edit an applied migration, add a new one instead.
+# A statement is either SQL for every dialect, a (dialect name, SQL) pair or an AddColumn.
+MIGRATIONS = [
+    (
+        1,
+        "Indexes for hot filter columns",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_wish_list_item_id ON wish_list (item_id)",
+            "CREATE INDEX IF NOT EXISTS ix_category_name ON category (name)",
+            "CREATE INDEX IF NOT EXISTS ix_category_shop_id_name ON category (shop_id, name)",
+            "CREATE INDEX IF NOT EXISTS ix_item_category_id ON item (category_id)",
+            "CREATE INDEX IF NOT EXISTS ix_item_shop_id_name ON item (shop_id, name)",
+            "CREATE INDEX IF NOT EXISTS ix_item_approved_available ON item (is_approved, is_available, id)",
+            "CREATE INDEX IF NOT EXISTS ix_item_public_shop_id ON item (shop_id, id) WHERE is_approved AND is_available",
+            "CREATE INDEX IF NOT EXISTS ix_cart_user_id_item_id ON cart (user_id, item_id)",
+            'CREATE INDEX IF NOT EXISTS ix_order_user_id ON "order" (user_id)',
+            'CREATE INDEX IF NOT EXISTS ix_order_order_key ON "order" (order_key)',
+            "CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON order_item (order_id)",
+            "CREATE INDEX IF NOT EXISTS ix_order_item_item_id ON order_item (item_id)",
+            "CREATE INDEX IF NOT EXISTS ix_shop_order_order_id ON shop_order (order_id)",
+            "CREATE INDEX IF NOT EXISTS ix_shop_order_shop_id_billing_status_created_at"
+            " ON shop_order (shop_id, billing_status, created_at)",
+            "CREATE INDEX IF NOT EXISTS ix_item_review_item_id ON item_review (item_id)",
+        ],
+    ),
+    (
+        2,
+        "Backfill shop_revenue_daily from billed shop orders",
+        [
+            "INSERT INTO shop_revenue_daily (shop_id, day, order_count, revenue, items_sold)"
+            " SELECT shop_id, day, count(*), sum(total_paid), sum(items_sold) FROM ("
+            " SELECT so.shop_id AS shop_id, date(so.created_at) AS day, so.total_paid AS total_paid,"
+            " (SELECT coalesce(sum(oi.quantity), 0) FROM order_item oi JOIN item i ON i.id = oi.item_id"
+            " WHERE oi.order_id = so.order_id AND i.shop_id = so.shop_id) AS items_sold"
+            " FROM shop_order so WHERE so.billing_status) AS billed GROUP BY shop_id, day",
+        ],
+    ),
+    (
+        3,
+        "Item rating counters",
+        [
+            "ALTER TABLE item ADD COLUMN review_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE item ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0",
+            "UPDATE item SET"
+            " review_count = (SELECT count(stars) FROM item_review WHERE item_review.item_id = item.id),"
+            " rating_sum = (SELECT coalesce(sum(stars), 0) FROM item_review WHERE item_review.item_id = item.id)",
+            "UPDATE item SET average_rating ="
+            " CASE WHEN review_count > 0 THEN round(rating_sum * 1.0 / review_count, 1) ELSE 0.0 END",
+        ],
+    ),
+    (
+        4,
+        "Item star histogram counters and review pagination index",
+        [
+            "ALTER TABLE item ADD COLUMN stars_1_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE item ADD COLUMN stars_2_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE item ADD COLUMN stars_3_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE item ADD COLUMN stars_4_count INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE item ADD COLUMN stars_5_count INTEGER NOT NULL DEFAULT 0",
+            "UPDATE item SET"
+            " stars_1_count = (SELECT count(*) FROM item_review WHERE item_review.item_id = item.id AND stars = 1),"
+            " stars_2_count = (SELECT count(*) FROM item_review WHERE item_review.item_id = item.id AND stars = 2),"
+            " stars_3_count = (SELECT count(*) FROM item_review WHERE item_review.item_id = item.id AND stars = 3),"
+            " stars_4_count = (SELECT count(*) FROM item_review WHERE item_review.item_id = item.id AND stars = 4),"
+            " stars_5_count = (SELECT count(*) FROM item_review WHERE item_review.item_id = item.id AND stars = 5)",
+            "CREATE INDEX IF NOT EXISTS ix_item_review_item_id_id ON item_review (item_id, id)",
+            "DROP INDEX IF EXISTS ix_item_review_item_id",
+        ],
+    ),
+    (
+        5,
+        "Pattern indexes for slug prefix lookups",
+        [
+            ("postgresql", "CREATE INDEX IF NOT EXISTS ix_shop_slug_pattern ON shop (slug text_pattern_ops)"),
+            ("postgresql", "CREATE INDEX IF NOT EXISTS ix_category_slug_pattern ON category (slug text_pattern_ops)"),
+            ("postgresql", "CREATE INDEX IF NOT EXISTS ix_item_slug_pattern ON item (slug text_pattern_ops)"),
+        ],
+    ),
+    (
+        6,
+        "Unique cart item per user and item",
+        [
+            # merge duplicated cart items into the oldest one before adding the unique index
+            "UPDATE cart SET"
+            " quantity = (SELECT sum(c.quantity) FROM cart c WHERE c.user_id = cart.user_id AND c.item_id = cart.item_id),"
+            " price = (SELECT sum(c.price) FROM cart c WHERE c.user_id = cart.user_id AND c.item_id = cart.item_id)"
+            " WHERE id IN (SELECT min(id) FROM cart GROUP BY user_id, item_id HAVING count(*) > 1)",
+            "DELETE FROM cart WHERE id NOT IN (SELECT min(id) FROM cart GROUP BY user_id, item_id)",
+            "DROP INDEX IF EXISTS ix_cart_user_id_item_id",
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_user_id_item_id ON cart (user_id, item_id)",
+        ],
+    ),
+    (
+        7,
+        "Unique order key",
+        [
+            # orders duplicated by double-submitted checkouts keep their rows, renamed so they are never billed again
+            "UPDATE \"order\" SET order_key = order_key || '-duplicate-' || id"
+            ' WHERE order_key IS NOT NULL AND id NOT IN (SELECT min(id) FROM "order" GROUP BY order_key)',
+            "DROP INDEX IF EXISTS ix_order_order_key",
+            'CREATE UNIQUE INDEX IF NOT EXISTS uq_order_order_key ON "order" (order_key)',
+        ],
+    ),
+    (
+        8,
+        "Newsletter campaign attempts and errors",
+        [
+            # newsletter_campaign is newer than most databases, create_all() created it with these columns
+            AddColumn("newsletter_campaign", "rejected_count", "INTEGER NOT NULL DEFAULT 0"),
+            AddColumn("newsletter_campaign", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+            AddColumn("newsletter_campaign", "last_error", "TEXT"),
+            ("postgresql", "ALTER TYPE campaignstatusenum ADD VALUE IF NOT EXISTS 'FAILED'"),
+        ],
+    ),
+]
+
+
+def _steps(statements: list, dialect: str) -> list:
+    """
+    Splits the statements of a migration into steps run one after the other: (False, [SQL, ...]) run in a transaction
+    and (True, SQL) index statements that Postgres runs CONCURRENTLY, outside of any transaction, so they don't block
+    writes to the table while the index is built.
+    """
+    steps = []
+    for statement in statements:
+        if isinstance(statement, tuple) and not isinstance(statement, AddColumn):
+            statement_dialect, statement = statement
+            if statement_dialect != dialect:
+                continue
+        if dialect == "postgresql" and isinstance(statement, str) and INDEX_STATEMENT.match(statement):
+            steps.append((True, statement))
+        elif steps and not steps[-1][0]:
+            steps[-1][1].append(statement)
+        else:
+            steps.append((False, [statement]))
+    return steps
+
+
+def _run_concurrently(engine: Engine, statement: str):
+    operation, name = INDEX_STATEMENT.match(statement).groups()
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        if operation.upper().startswith("CREATE"):
+            # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind, which IF NOT EXISTS would keep
+            invalid = connection.exec_driver_sql(
+                "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid"
+                " WHERE pg_class.relname = %(name)s AND NOT pg_index.indisvalid",
+                {"name": name},
+            ).first()
+            if invalid:
+                connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        connection.exec_driver_sql(statement.replace(operation, f"{operation} CONCURRENTLY", 1))
+
+
+def _execute(connection: Connection, statement):
+    if isinstance(statement, AddColumn):
+        statement.run(connection)
+    else:
+        connection.exec_driver_sql(statement)
+
+
+def _upgrade(engine: Engine):
+    fresh = not inspect(engine).has_table(models.User.__tablename__)
+    models.Base.metadata.create_all(bind=engine)
+    schema_version.create(bind=engine, checkfirst=True)
+
+    with engine.connect() as connection:
+        applied = set(connection.scalars(select(schema_version.c.version)))
+
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        # tables created by create_all above already match the models
+        steps = [] if fresh else _steps(statements, engine.dialect.name)
+        # the last statements are committed together with the version
+        last = steps.pop()[1] if steps and not steps[-1][0] else []
+        for concurrently, step in steps:
+            if concurrently:
+                _run_concurrently(engine, step)
+            else:
+                with engine.begin() as connection:
+                    for statement in step:
+                        _execute(connection, statement)
+        with engine.begin() as connection:
+            for statement in last:
+                _execute(connection, statement)
+            connection.execute(schema_version.insert().values(version=version, description=description))
+
+
+def upgrade(engine: Engine):
+    if engine.dialect.name != "postgresql":
+        _upgrade(engine)
+        return
+    # every replica migrates at startup: the first one to take the lock applies the migrations, the others wait and
+    # then find them applied. A session lock, CREATE INDEX CONCURRENTLY can't run in the transaction of an xact lock.
+    with engine.connect() as lock:
+        lock.execution_options(isolation_level="AUTOCOMMIT")
+        lock.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_KEY})")
+        try:
+            _upgrade(engine)
+        finally:
+            lock.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_KEY})")
+
+
+if __name__ == "__main__":
+    from shop.database import engine
+
+    upgrade(engine)
@@ -1,16 +1,30 @@
-from passlib.context import CryptContext
-from sqlalchemy import Boolean, Column, DateTime, Enum, Float, ForeignKey, Integer, String, Table, Text
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Enum,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+    Text,
+    text,
+)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
+from shop import passwords
 from shop.database import Base
-from shop.schemas import ShopOrderStatusEnum, UserRoleEnum
+from shop.schemas import CampaignStatusEnum, ShopOrderStatusEnum, UserRoleEnum
 
 association_table = Table(
     "wish_list",
     Base.metadata,
     Column("user_id", ForeignKey("users.id"), primary_key=True),
-    Column("item_id", ForeignKey("item.id"), primary_key=True),
+    Column("item_id", ForeignKey("item.id"), primary_key=True, index=True),
 )
 
 
@@ -54,8 +68,11 @@ class User(Base):
 
     # Method to set the hashed password
     def set_password(self, password):
-        pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-        self._password = pwd_context.hash(password)
+        self._password = passwords.password_hasher.hash_sync(password)
+
+    # Method to set a password hashed with passwords.password_hasher in async code
+    def set_password_hash(self, password_hash):
+        self._password = password_hash
 
 
 class UserProfile(Base):
@@ -95,6 +112,10 @@ class Shop(Base):
     """
 
     __tablename__ = "shop"
+    # prefix LIKE lookups of generate_unique_*_slug need a pattern index on Postgres with a non-C collation
+    __table_args__ = (
+        Index("ix_shop_slug_pattern", "slug", postgresql_ops={"slug": "text_pattern_ops"}).ddl_if(dialect="postgresql"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), unique=True)
@@ -115,15 +136,22 @@ class Shop(Base):
     items = relationship("Item", back_populates="shop", cascade="all, delete-orphan")
     user = relationship("User", back_populates="shop", uselist=False)
     shop_orders = relationship("ShopOrder", back_populates="shop", cascade="all, delete-orphan")
+    revenue_days = relationship("ShopRevenueDaily", back_populates="shop", cascade="all, delete-orphan")
 
 
 class Category(Base):
     __tablename__ = "category"
+    __table_args__ = (
+        Index("ix_category_shop_id_name", "shop_id", "name"),
+        Index("ix_category_slug_pattern", "slug", postgresql_ops={"slug": "text_pattern_ops"}).ddl_if(
+            dialect="postgresql"
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     shop_id = Column(Integer, ForeignKey("shop.id"))
 
-    name = Column(String(100))
+    name = Column(String(100), index=True)
     slug = Column(String, unique=True)
     is_available = Column(Boolean, default=True)
 
@@ -134,10 +162,23 @@ class Category(Base):
 
 class Item(Base):
     __tablename__ = "item"
+    __table_args__ = (
+        Index("ix_item_shop_id_name", "shop_id", "name"),
+        Index("ix_item_approved_available", "is_approved", "is_available", "id"),
+        # partial index for the public catalog listing filtered by shop
+        Index(
+            "ix_item_public_shop_id",
+            "shop_id",
+            "id",
+            postgresql_where=text("is_approved AND is_available"),
+            sqlite_where=text("is_approved AND is_available"),
+        ),
+        Index("ix_item_slug_pattern", "slug", postgresql_ops={"slug": "text_pattern_ops"}).ddl_if(dialect="postgresql"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     shop_id = Column(Integer, ForeignKey("shop.id"))
-    category_id = Column(Integer, ForeignKey("category.id"))
+    category_id = Column(Integer, ForeignKey("category.id"), index=True)
 
     name = Column(String(55))
     image = Column(String)
@@ -145,6 +186,14 @@ class Item(Base):
     description = Column(Text)
     price = Column(Float(precision=2))
     average_rating = Column(Float(precision=2), default=0.0)
+    # rating counters maintained in SQL on review create/delete, average_rating is derived from them
+    review_count = Column(Integer, nullable=False, default=0, server_default="0")
+    rating_sum = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_1_count = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_2_count = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_3_count = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_4_count = Column(Integer, nullable=False, default=0, server_default="0")
+    stars_5_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     slug = Column(String, unique=True)
     is_approved = Column(Boolean, default=True)
@@ -162,18 +211,15 @@ class Item(Base):
     users = relationship("User", secondary=association_table, back_populates="items")
     reviews = relationship("ItemReview", back_populates="item", cascade="all, delete-orphan")
 
-    def _set_average_rating(self):
-        if self.reviews:
-            total = 0
-            for review in self.reviews:
-                total += review.stars
-            self.average_rating = round(total / len(self.reviews), 1)
-        else:
-            self.average_rating = 0.0
+    # Property to access the count of reviews per amount of stars
+    @property
+    def rating_histogram(self):
+        return {stars: getattr(self, f"stars_{stars}_count") for stars in range(1, 6)}
 
 
 class CartItem(Base):
     __tablename__ = "cart"
+    __table_args__ = (Index("uq_cart_user_id_item_id", "user_id", "item_id", unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -192,9 +238,11 @@ class CartItem(Base):
 
 class Order(Base):
     __tablename__ = "order"
+    # one order per PaymentIntent, a double-submitted checkout gets the order placed by the first request
+    __table_args__ = (Index("uq_order_order_key", "order_key", unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
 
     first_name = Column(String(50))
     last_name = Column(String(50))
@@ -220,8 +268,8 @@ class OrderItem(Base):
     __tablename__ = "order_item"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("order.id"))
-    item_id = Column(Integer, ForeignKey("item.id"))
+    order_id = Column(Integer, ForeignKey("order.id"), index=True)
+    item_id = Column(Integer, ForeignKey("item.id"), index=True)
 
     price = Column(Float(precision=2))
     quantity = Column(Integer, default=1)
@@ -233,10 +281,13 @@ class OrderItem(Base):
 
 class ShopOrder(Base):
     __tablename__ = "shop_order"
+    __table_args__ = (
+        Index("ix_shop_order_shop_id_billing_status_created_at", "shop_id", "billing_status", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     shop_id = Column(Integer, ForeignKey("shop.id"))
-    order_id = Column(Integer, ForeignKey("order.id"))
+    order_id = Column(Integer, ForeignKey("order.id"), index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     # TODO change default to False
     billing_status = Column(Boolean, default=True)
@@ -251,6 +302,84 @@ class ShopOrder(Base):
     user = relationship("User", back_populates="shop_orders")
 
 
+class ShopRevenueDaily(Base):
+    """
+    SQLAlchemy model for ShopRevenueDaily.
+    Represents the 'shop_revenue_daily' table in the database.
+    Pre-aggregated revenue of billed ShopOrders per shop and day, kept up to date when orders are billed.
+    """
+
+    __tablename__ = "shop_revenue_daily"
+
+    shop_id = Column(Integer, ForeignKey("shop.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+
+    order_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float(precision=2), nullable=False, default=0.0)
+    items_sold = Column(Integer, nullable=False, default=0)
+
+    # Relationships
+    shop = relationship("Shop", back_populates="revenue_days")
+
+
+class StripeEvent(Base):
+    """
+    SQLAlchemy model for StripeEvent.
+    Represents the 'stripe_event' table in the database.
+    Every received Stripe webhook event once, used to drop redelivered events and as the queue of events to apply.
+    """
+
+    __tablename__ = "stripe_event"
+    __table_args__ = (
+        # partial index for the queue of events waiting to be applied
+        Index(
+            "ix_stripe_event_pending",
+            "created_at",
+            postgresql_where=text("processed_at IS NULL"),
+            sqlite_where=text("processed_at IS NULL"),
+        ),
+    )
+
+    id = Column(String(255), primary_key=True)
+    type = Column(String(100))
+    order_key = Column(String(200), nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class EmailOutbox(Base):
+    """
+    SQLAlchemy model for EmailOutbox.
+    Represents the 'email_outbox' table in the database.
+    Emails written in the same transaction as the change they are about and delivered by shop.email_worker.
+    """
+
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        # partial index for the queue of emails waiting to be sent
+        Index(
+            "ix_email_outbox_pending",
+            "next_attempt_at",
+            postgresql_where=text("sent_at IS NULL"),
+            sqlite_where=text("sent_at IS NULL"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    to_email = Column(String(100), nullable=False)
+    subject = Column(String(200), nullable=False)
+    html_content = Column(Text, nullable=False)
+
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(Text, nullable=True)
+    # NULL once the email is sent or given up on
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+
 class NewsLetter(Base):
     __tablename__ = "newsletter"
 
@@ -263,8 +392,40 @@ class NewsLetter(Base):
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
 
+class NewsletterCampaign(Base):
+    """
+    SQLAlchemy model for NewsletterCampaign.
+    Represents the 'newsletter_campaign' table in the database.
+    An email sent to every active NewsLetter subscriber by shop.campaigns, last_newsletter_id checkpoints the progress.
+    """
+
+    __tablename__ = "newsletter_campaign"
+
+    id = Column(Integer, primary_key=True, index=True)
+    subject = Column(String(200), nullable=False)
+    html_content = Column(Text, nullable=False)
+
+    status = Column(Enum(CampaignStatusEnum), nullable=False, default=CampaignStatusEnum.DRAFT)
+    scheduled_at = Column(DateTime(timezone=True), nullable=True)
+    # id of the last subscriber the campaign was sent to, subscribers are sent to in id order
+    last_newsletter_id = Column(Integer, nullable=False, default=0, server_default="0")
+    sent_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # subscribers the provider refused (4xx), they are skipped
+    rejected_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # failed attempts to send the chunk after the checkpoint, the campaign fails after EMAIL_MAX_ATTEMPTS
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(Text, nullable=True)
+    # a worker sending the campaign holds it until then, a crashed worker's campaign is resumed afterwards
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
 class ItemReview(Base):
     __tablename__ = "item_review"
+    __table_args__ = (Index("ix_item_review_item_id_id", "item_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     item_id = Column(Integer, ForeignKey("item.id"))
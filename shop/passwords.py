@@ -0,0 +1,69 @@
+"""
+Password hashing and verification on a dedicated, bounded thread pool.
+
+A bcrypt hash or verification takes ~250 ms of CPU. bcrypt releases the GIL while it runs, so running it on threads
+of its own keeps the event loop and the shared threadpool of the sync endpoints free during a burst of logins. At
+most PASSWORD_HASH_WORKERS passwords are hashed at once and PASSWORD_HASH_QUEUE_SIZE more wait for a worker. Past
+that, requests are refused with 429 and a Retry-After header instead of queueing up behind each other.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from shop import constants
+
+PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, *args) -> Future:
+        with self._lock:
+            if self._in_flight >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=429, detail="Too many requests, please try again later.", headers={"Retry-After": "1"}
+                )
+            self._in_flight += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(PWD_CONTEXT.hash, password))
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await asyncio.wrap_future(self._submit(PWD_CONTEXT.verify, password, password_hash))
+
+    def hash_sync(self, password: str) -> str:
+        # for sync code, which already runs on a thread of its own
+        return self._submit(PWD_CONTEXT.hash, password).result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = self._in_flight
+        return {
+            "workers": self.workers,
+            "in_flight": in_flight,
+            "queue_depth": max(in_flight - self.workers, 0),
+            "queue_size": self.queue_size,
+            "rejected": self.rejected,
+        }
+
+
+password_hasher = PasswordHasher(constants.PASSWORD_HASH_WORKERS, constants.PASSWORD_HASH_QUEUE_SIZE)
@@ -0,0 +1,74 @@
+"""
+Stripe API calls made with a shared async HTTP client.
+
+The client keeps connections to Stripe alive between requests. Retries reuse the idempotency key of the first
+attempt, so a request that timed out after Stripe processed it never creates a second PaymentIntent.
+"""
+
+import asyncio
+import hashlib
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+
+from shop import constants
+
+RETRY_STATUS_CODES = {409, 429, 500, 502, 503, 504}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=constants.STRIPE_API_BASE,
+            auth=(constants.STRIPE_API_KEY or "", ""),
+            timeout=constants.STRIPE_TIMEOUT,
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def cart_idempotency_key(user_id: int, cart_lines: list) -> str:
+    # the same cart always maps to the same key, a new cart (new cart item ids) to a new one
+    lines = ",".join(
+        f"{cart_line.id}:{cart_line.item_id}:{cart_line.quantity}:{cart_line.price}" for cart_line in cart_lines
+    )
+    return hashlib.sha256(f"{user_id}|{lines}".encode()).hexdigest()
+
+
+async def _post(url: str, data: dict, idempotency_key: str) -> dict:
+    headers = {"Idempotency-Key": idempotency_key}
+    for attempt in range(constants.STRIPE_MAX_RETRIES + 1):
+        last_attempt = attempt == constants.STRIPE_MAX_RETRIES
+        try:
+            response = await get_client().post(url, data=data, headers=headers)
+        except httpx.TransportError:
+            if last_attempt:
+                raise HTTPException(status_code=400, detail="Payment provider is unavailable, please try again.")
+        else:
+            should_retry = response.headers.get("Stripe-Should-Retry")
+            retry = should_retry == "true" if should_retry else response.status_code in RETRY_STATUS_CODES
+            if response.is_success:
+                return response.json()
+            if not retry or last_attempt:
+                try:
+                    message = response.json()["error"]["message"]
+                except (ValueError, KeyError, TypeError):
+                    message = "Payment failed."
+                raise HTTPException(status_code=400, detail=message)
+        await asyncio.sleep(0.5 * 2**attempt)
+
+
+async def create_payment_intent(amount: int, currency: str, metadata: dict, idempotency_key: str) -> dict:
+    data = {"amount": amount, "currency": currency}
+    data.update({f"metadata[{key}]": value for key, value in metadata.items()})
+    return await _post("/v1/payment_intents", data, idempotency_key)
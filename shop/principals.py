@@ -0,0 +1,116 @@
+"""
+Cache of the authenticated principals, keyed by the `sub` of their access token.
+
+get_current_user and get_current_shop read the user's role, active and superuser flags and the id of their approved
+shop from here, so an authenticated request does not query the users and shop tables. Route handlers still get a
+User (and Shop) bound to their session: it is attached with the cached columns only, any other attribute or
+relationship is loaded when first used.
+
+Entries are dropped by the after_update/after_delete events of User and Shop, and once more after the session that
+made the change commits, so a request reading the row between the flush and the commit can't cache the old values
+for long. Changes made outside of the ORM (bulk updates, other processes) are picked up when the entry expires after
+PRINCIPAL_CACHE_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from shop import constants
+from shop.models import Shop, User
+
+
+class Principal(NamedTuple):
+    id: int
+    role: str
+    is_active: bool
+    is_superuser: bool
+    # id of the user's shop if it is approved
+    shop_id: Optional[int]
+
+    def attach_user(self, db: Session) -> User:
+        user = User(id=self.id, role=self.role, is_active=self.is_active, is_superuser=self.is_superuser)
+        make_transient_to_detached(user)
+        # load=False attaches it without a query, or returns the user already in the session
+        return db.merge(user, load=False)
+
+    def attach_shop(self, db: Session) -> Shop:
+        shop = Shop(id=self.shop_id, user_id=self.id, is_approved=True)
+        make_transient_to_detached(shop)
+        return db.merge(shop, load=False)
+
+
+class PrincipalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sub: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(sub)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at <= time.monotonic():
+                del self._entries[sub]
+                return None
+            self._entries.move_to_end(sub)
+            return principal
+
+    def put(self, sub: str, principal: Principal):
+        with self._lock:
+            self._entries[sub] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(sub)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, sub: str):
+        with self._lock:
+            self._entries.pop(sub, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache(constants.PRINCIPAL_CACHE_SIZE, constants.PRINCIPAL_CACHE_TTL)
+
+
+def _invalidate(target, user_id):
+    if user_id is None:
+        return
+    sub = str(user_id)
+    principal_cache.invalidate(sub)
+    db = object_session(target)
+    if db is not None:
+        db.info.setdefault("changed_principals", set()).add(sub)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _user_changed(mapper, connection, target):
+    _invalidate(target, target.id)
+
+
+@event.listens_for(Shop, "after_insert")
+@event.listens_for(Shop, "after_update")
+@event.listens_for(Shop, "after_delete")
+def _shop_changed(mapper, connection, target):
+    _invalidate(target, target.user_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _session_committed(db):
+    for sub in db.info.pop("changed_principals", ()):
+        principal_cache.invalidate(sub)
+
+
+@event.listens_for(Session, "after_rollback")
+def _session_rolled_back(db):
+    db.info.pop("changed_principals", None)
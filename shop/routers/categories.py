@@ -28,15 +28,13 @@ def create_category(
     """
     utils.check_free_category_name(db, current_shop.id, category_data.name)
 
-    slug = utils.generate_unique_category_slug(db, current_shop.shop_name, category_data.name)
-
     new_category = models.Category(
         shop_id=current_shop.id,
         name=category_data.name,
-        slug=slug,
     )
-    db.add(new_category)
-    db.commit()
+    utils.commit_with_unique_slug(
+        db, new_category, lambda: utils.generate_unique_category_slug(db, current_shop.shop_name, category_data.name)
+    )
     db.refresh(new_category)
 
     return new_category
@@ -1,10 +1,13 @@
+import csv
+import json
 from typing import Union
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
-from shop import models, schemas, utils
-from shop.utils import get_current_shop, get_current_user, get_db
+from shop import http_cache, models, schemas, utils
+from shop.utils import get_current_shop, get_current_user, get_db, get_read_db
 
 router = APIRouter(prefix="/item", tags=["items"])
 
@@ -33,25 +36,123 @@ def create_item(
         raise HTTPException(status_code=409, detail="Category not found.")
 
     utils.check_free_item_name(db, current_shop.id, item_data.name)
-    slug = utils.generate_unique_item_slug(db, current_shop.shop_name, item_data.name)
 
     new_item = models.Item(
         shop_id=current_shop.id,
         category_id=item_data.category_id,
         name=item_data.name,
-        slug=slug,
         image=item_data.image,
         title=item_data.title,
         description=item_data.description,
         price=item_data.price,
     )
-    db.add(new_item)
-    db.commit()
+    utils.commit_with_unique_slug(
+        db, new_item, lambda: utils.generate_unique_item_slug(db, current_shop.shop_name, item_data.name)
+    )
     db.refresh(new_item)
 
     return new_item
 
 
+async def _iter_lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode()
+    if buffer:
+        yield buffer.decode()
+
+
+async def _iter_rows(request: Request, content_type: str):
+    """
+    Yields (row number, row) pairs parsed from the streamed CSV or NDJSON body.
+    Rows which can't be parsed are yielded as an error message instead of a dict.
+    """
+    header = None
+    pending = ""
+    row_number = 0
+    async for line in _iter_lines(request):
+        if content_type == "csv":
+            # a quoted field may contain line breaks, wait for the closing quote
+            pending += line
+            if pending.count('"') % 2:
+                pending += "\n"
+                continue
+            line, pending = pending, ""
+        if not line.strip():
+            continue
+        if content_type == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = values
+                continue
+            row_number += 1
+            if len(values) != len(header):
+                yield row_number, f"Row has {len(values)} columns, expected {len(header)}."
+            else:
+                yield row_number, dict(zip(header, values))
+        else:
+            row_number += 1
+            try:
+                yield row_number, json.loads(line)
+            except json.JSONDecodeError:
+                yield row_number, "Invalid JSON."
+
+
+@router.post("/bulk")
+async def create_items_bulk(
+    request: Request,
+    batch_size: int = Query(1000, ge=1, le=10000, description="Amount of items inserted per batch"),
+    current_shop: models.Shop = Depends(get_current_shop),
+    db: Session = Depends(get_db),
+):
+    """
+    Endpoint to create Items in bulk from a streamed CSV (text/csv) or NDJSON (application/x-ndjson) body.
+    Each row has the fields of schemas.ItemCreate, rows are validated and inserted in batches.
+
+    Returns:
+    - dict: The amount of created Items and the errors of the rejected rows.
+
+    Raises:
+    - HTTPException 415: If the body is neither CSV nor NDJSON.
+    """
+    media_type = request.headers.get("content-type", "")
+    if "csv" in media_type:
+        content_type = "csv"
+    elif "ndjson" in media_type or "jsonl" in media_type:
+        content_type = "ndjson"
+    else:
+        raise HTTPException(status_code=415, detail="Only text/csv and application/x-ndjson are supported.")
+
+    category_ids = await run_in_threadpool(lambda: {category.id for category in current_shop.categories})
+    created = 0
+    errors = []
+    batch = []
+
+    async def flush():
+        nonlocal created
+        batch_created, batch_errors = await run_in_threadpool(
+            utils.create_items_bulk, db, current_shop, category_ids, batch
+        )
+        created += batch_created
+        errors.extend(batch_errors)
+        batch.clear()
+
+    async for row_number, row in _iter_rows(request, content_type):
+        if isinstance(row, dict):
+            batch.append((row_number, row))
+        else:
+            errors.append({"row": row_number, "errors": [{"loc": [], "msg": row}]})
+        if len(batch) == batch_size:
+            await flush()
+    if batch:
+        await flush()
+
+    return {"created": created, "errors": sorted(errors, key=lambda error: error["row"])}
+
+
 @router.patch("/{item_slug}/", response_model=schemas.ItemOut)
 def update_item(
     item_data: schemas.ItemPatch,
@@ -77,20 +178,28 @@ def update_item(
 
     item = utils.get_item_by_slug_for_shop(db, current_shop.id, item_slug)
     utils.check_item_owner(db, current_shop.id, item_slug)
-    changed = 0
+    changes = {}
     for key, value in item_data_dict.items():
         current_value = getattr(item, key)
         if value is not None:
             if value != current_value:
                 if key == "name":
                     utils.check_free_item_name(db, current_shop.id, value)
-                    setattr(item, "slug", utils.generate_unique_item_slug(db, current_shop.shop_name, value))
-                setattr(item, key, value)
-                changed += 1
-    if not changed:
+                changes[key] = value
+    if not changes:
         raise HTTPException(status_code=422, detail="Model was not changed.")
 
-    db.commit()
+    if "name" in changes:
+        utils.commit_with_unique_slug(
+            db,
+            item,
+            lambda: utils.generate_unique_item_slug(db, current_shop.shop_name, changes["name"]),
+            values=changes,
+        )
+    else:
+        for key, value in changes.items():
+            setattr(item, key, value)
+        db.commit()
     db.refresh(item)
 
     return item
@@ -124,7 +233,9 @@ def delete_item(
 @router.get("/{item_slug}/", response_model=schemas.ItemOut)
 def get_item(
     item_slug: str,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
 ):
     """
     Endpoint to get an Item from the database.
@@ -138,9 +249,8 @@ def get_item(
     Raises:
     - HTTPException 404: If the Item with the given slug does not exist.
     """
-    item = utils.get_item_by_slug(db, item_slug)
-    # item.reviews for querying the reviews
-    item.reviews
+    item = utils.get_catalog_item(db, item_slug)
+    http_cache.check_row_not_modified(request, response, item)
     return item
 
 
@@ -166,22 +276,32 @@ def create_item_comment(
         new_comment.comment = review_data.comment
 
     db.add(new_comment)
+    if new_comment.stars:
+        utils.update_item_rating(db, item.id, new_comment.stars)
     db.commit()
     db.refresh(new_comment)
-
-    item._set_average_rating()
-    db.commit()
-    db.refresh(item)
     return new_comment
 
 
 @router.get("/{item_slug}/reviews/", response_model=Union[dict, list[schemas.ItemReviewOut]])
 def get_item_reviews(
     item_slug: str,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of reviews to return"),
+    after: int = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    db: Session = Depends(get_read_db),
 ):
-    item = utils.get_item_by_slug(db, item_slug)
-    reviews = item.reviews
-    if not reviews:
+    """
+    Endpoint to get reviews of an Item.
+    Reviews are paginated by cursor, the cursor of the next page is returned in the X-Next-Cursor header.
+    """
+    item = utils.get_catalog_item(db, item_slug)
+    # reviews are never edited, their ids are their version and are read from the index alone
+    review_ids, next_cursor = utils.get_item_review_ids(db, item.id, limit, after)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    http_cache.check_not_modified(request, response, http_cache.weak_etag(item.id, review_ids, next_cursor))
+    if not review_ids and after is None:
         return {"detail": "No reviews found."}
-    return reviews
+    return utils.get_item_reviews_by_ids(db, review_ids)
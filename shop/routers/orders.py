@@ -1,18 +1,17 @@
-from collections import defaultdict
 from typing import Union
 
 import stripe
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from shop import constants, models, schemas, utils
-from shop.smtp_emails import send_new_order_confirmation_email
+from shop import constants, models, payments, schemas, utils
+from shop.smtp_emails import queue_new_order_confirmation_email
 from shop.utils import get_current_user, get_db
 
 router = APIRouter(tags=["Related to orders"])
 
-stripe.api_key = constants.STRIPE_API_KEY
-
 
 @router.get("/cart/")
 def get_cart_items(
@@ -38,6 +37,25 @@ def get_cart_items(
     return cart_out
 
 
+@router.put("/cart/")
+def sync_cart_items(
+    cart_items: list[schemas.CartSync],
+    current_user: models.User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Endpoint to set the quantities of many CartItems at once for the current User.
+    Items with a quantity of 0 are removed from the Cart, Items not listed are kept as they are.
+    """
+    # the last quantity wins when an item is listed more than once
+    quantities = {cart_item.item_slug: cart_item.quantity for cart_item in cart_items}
+    cart_items = utils.sync_cart_items(db, current_user.id, quantities)
+    db.commit()
+    cart_out_list = [schemas.CartOut.model_validate(cart_item) for cart_item in cart_items]
+    total_amount = sum(cart_item.price for cart_item in cart_out_list)
+    return {"total_amount": total_amount, "cart_items": cart_out_list}
+
+
 @router.post("/add-to-the-cart/{item_slug}", response_model=schemas.CartOut)
 def add_to_the_cart(
     item_slug: str,
@@ -47,21 +65,9 @@ def add_to_the_cart(
     """
     Endpoint to add an Item to the Cart.
     """
-    item = utils.get_item_by_slug(db, item_slug)
-    if item:
-        cart_item = utils.get_cart_item(db, current_user.id, item.id)
-        if cart_item:
-            cart_item.quantity += 1
-            cart_item.price = item.price * cart_item.quantity
-            db.commit()
-            db.refresh(cart_item)
-            return cart_item
-        else:
-            cart_item = models.CartItem(user_id=current_user.id, item_id=item.id, price=item.price)
-            db.add(cart_item)
-            db.commit()
-            db.refresh(cart_item)
-            return cart_item
+    cart_item = utils.add_cart_item(db, current_user.id, item_slug)
+    db.commit()
+    return cart_item
 
 
 @router.post("/subtract-from-the-cart/{item_slug}/", response_model=Union[schemas.CartOut, dict])
@@ -73,22 +79,13 @@ def subtract_from_the_cart(
     """
     Endpoint to subtract an Item from the Cart.
     """
-    item = utils.get_item_by_slug(db, item_slug)
-    if item:
-        cart_item = utils.get_cart_item(db, current_user.id, item.id)
-        if cart_item:
-            if cart_item.quantity > 1:
-                cart_item.quantity -= 1
-                cart_item.price = item.price * cart_item.quantity
-                db.commit()
-                db.refresh(cart_item)
-                return cart_item
-            else:
-                db.delete(cart_item)
-                db.commit()
-                return {"detail": "Item removed from the cart."}
-        else:
-            return {"detail": "Item already removed from the cart."}
+    cart_item, removed = utils.subtract_cart_item(db, current_user.id, item_slug)
+    db.commit()
+    if cart_item:
+        return cart_item
+    if removed:
+        return {"detail": "Item removed from the cart."}
+    return {"detail": "Item already removed from the cart."}
 
 
 @router.get("/order-details/", response_model=list[schemas.CartOut])
@@ -97,96 +94,87 @@ def get_order_details(current_user: models.User = Depends(get_current_user), db:
     return cart_items
 
 
+def _place_order(
+    db: Session, user_id: int, email: str, cart_lines: list, order_key: str, order_data: schemas.OrderBase
+):
+    new_order, created = utils.create_order(db, user_id, cart_lines, order_key, **order_data.model_dump())
+    if created:
+        # committed together with the order and its lines
+        queue_new_order_confirmation_email(db, email, new_order, cart_lines)
+    db.commit()
+    db.refresh(new_order)
+    return new_order
+
+
 @router.post("/create-order/", response_model=schemas.OrderOut)
-def post_order_details(
+async def post_order_details(
     order_data: schemas.OrderBase,
-    background_tasks: BackgroundTasks,
     current_user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    cart_items = utils.get_cart_items(db, current_user.id)
-    total_paid = sum(cart_item.price for cart_item in cart_items)
-
-    try:
-        payment_intent = stripe.PaymentIntent.create(
-            amount=int(total_paid) * 100, currency="usd", metadata={"user_id": current_user.id}
-        )
-    except stripe.error.StripeError as e:
-        # Handle payment error
-        error_message = str(e)
-        raise HTTPException(status_code=400, detail=error_message)
-
-    except stripe.error.CardError as e:
-        # Display error message to the user
-        err = e.error
-        raise HTTPException(status_code=400, detail=err["message"])
-
-    new_order = models.Order(
-        first_name=order_data.first_name,
-        last_name=order_data.last_name,
-        user_id=current_user.id,
-        total_paid=total_paid,
-        address=order_data.address,
-        city=order_data.city,
-        country=order_data.country,
-        pin_code=order_data.pin_code,
-        phone_number=order_data.phone_number,
-        order_key=payment_intent.get("id"),
+    # current_user belongs to the sync session, its email may still have to be loaded
+    user_id, email = await run_in_threadpool(lambda: (current_user.id, current_user.email))
+    cart_lines = await run_in_threadpool(utils.get_cart_lines, db, user_id)
+    # end the read transaction, so no pooled connection is held while waiting for Stripe
+    await run_in_threadpool(db.rollback)
+    total_paid = sum(cart_line.price for cart_line in cart_lines)
+
+    payment_intent = await payments.create_payment_intent(
+        amount=round(total_paid * 100),
+        currency="usd",
+        metadata={"user_id": user_id},
+        idempotency_key=payments.cart_idempotency_key(user_id, cart_lines),
     )
-    db.add(new_order)
-    db.commit()
-    db.refresh(new_order)
-    background_tasks.add_task(send_new_order_confirmation_email, current_user.email, new_order)
 
-    for cart_item in cart_items:
-        order_item = models.OrderItem(
-            order_id=new_order.id, item_id=cart_item.item_id, quantity=cart_item.quantity, price=cart_item.price
-        )
-
-        db.add(order_item)
+    new_order = await run_in_threadpool(_place_order, db, user_id, email, cart_lines, payment_intent["id"], order_data)
+    return new_order
 
-    shop_items = defaultdict(list)
 
-    for cart_item in cart_items:
-        shop_items[cart_item.item.shop_id].append(cart_item)
-        db.delete(cart_item)
+def _record_stripe_event(db: Session, event_id: str, event_type: str, order_key: str = None) -> bool:
+    recorded = utils.record_stripe_event(db, event_id, event_type, order_key)
+    db.commit()
+    return recorded
 
-    for shop_id, cart_items_in_shop in shop_items.items():
-        shop_total_price = sum(cart_item.price for cart_item in cart_items_in_shop)
-        shop_order = models.ShopOrder(
-            shop_id=shop_id, order_id=new_order.id, total_paid=shop_total_price, user_id=current_user.id
-        )
-        db.add(shop_order)
 
-    db.commit()
-    return new_order
+def _process_stripe_events():
+    db = utils.get_session()
+    try:
+        utils.process_stripe_events(db)
+    finally:
+        db.close()
 
 
 @router.post("/stripe-webhook/")
-async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
-    payload = await request.json()
-    event = None
-
+async def stripe_webhook(
+    request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(utils.get_async_db)
+):
+    """
+    Endpoint for Stripe webhook events.
+    Events are verified, stored once and acknowledged, the orders they pay are billed from the event queue.
+    """
+    if not constants.STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=500, detail="Stripe webhook secret is not configured.")
+    payload = await request.body()
     try:
-        event = stripe.Event.construct_from(payload, stripe.api_key)
+        event = stripe.Webhook.construct_event(
+            payload, request.headers.get("Stripe-Signature", ""), constants.STRIPE_WEBHOOK_SECRET
+        )
     except ValueError as e:
         # Invalid payload
         raise HTTPException(status_code=400, detail=str(e))
+    except stripe.error.SignatureVerificationError:
+        raise HTTPException(status_code=400, detail="Invalid signature.")
 
-    # Handle specific event types
+    order_key = None
     if event.type == "payment_intent.succeeded":
         payment_intent = event.data.object
-        order_key = payment_intent.id
-        user_id = payment_intent.metadata.user_id
-
-        if user_id is None:
+        if getattr(payment_intent.metadata, "user_id", None) is None:
             return {"error": "User ID not found"}
-        order = utils.get_order_by_order_key(db, order_key)
-        shop_order = db.query(models.ShopOrder).filter(models.ShopOrder.order_id == order.id).first()
-        order.billing_status = True
-        shop_order.billing_status = True
-        db.commit()
+        order_key = payment_intent.id
 
+    recorded = await db.run_sync(_record_stripe_event, event.id, event.type, order_key)
+    if recorded and order_key:
+        background_tasks.add_task(_process_stripe_events)
     return {"status": "success"}
 
 
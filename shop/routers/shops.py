@@ -1,11 +1,11 @@
 from datetime import date
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
 
-from shop import models, schemas, utils
-from shop.smtp_emails import send_status_updated_email
-from shop.utils import get_current_shop, get_db
+from shop import http_cache, models, schemas, utils
+from shop.smtp_emails import queue_status_updated_email
+from shop.utils import get_current_shop, get_db, get_read_db
 
 router = APIRouter(prefix="/shop", tags=["shop"])
 
@@ -38,7 +38,7 @@ def update_shop_details(
 
 
 @router.get("/{shop_slug}", response_model=schemas.ShopOut)
-def get_shop(shop_slug: str, db: Session = Depends(get_db)):
+def get_shop(shop_slug: str, request: Request, response: Response, db: Session = Depends(get_read_db)):
     """
     Endpoint to get a Shop from the database.
 
@@ -52,6 +52,7 @@ def get_shop(shop_slug: str, db: Session = Depends(get_db)):
     - HTTPException 404: If the Shop with the given slug does not exist.
     """
     shop = utils.get_shop_by_slug(db, shop_slug)
+    http_cache.check_row_not_modified(request, response, shop)
     return shop
 
 
@@ -78,7 +79,6 @@ def get_shop_order(
 def update_shop_order_status(
     order_id: int,
     order_data: schemas.ShopOrderPatch,
-    background_tasks: BackgroundTasks,
     current_shop: models.Shop = Depends(get_current_shop),
     db: Session = Depends(get_db),
 ):
@@ -106,10 +106,10 @@ def update_shop_order_status(
         if value is not None:
             if value != current_value:
                 setattr(order, key, value)
-                background_tasks.add_task(send_status_updated_email, order.user.email, order.status, order.order_id)
                 changed = 1
     if not changed:
         raise HTTPException(status_code=422, detail="Model was not changed.")
+    queue_status_updated_email(db, order.user.email, order.status, order.order_id)
 
     db.commit()
     db.refresh(order)
@@ -145,15 +145,20 @@ def get_all_items_for_shop_admin(
     return items
 
 
-@router.get("-admin/users/", response_model=list[schemas.UserOut])
+@router.get("-admin/users/", response_model=list[schemas.ShopCustomerOut])
 def get_all_users_for_shop(
+    sort_by: schemas.ShopCustomerSortEnum = Query(
+        schemas.ShopCustomerSortEnum.LAST_ORDER, description="Sort users by last order date, total spent or order count"
+    ),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of users to return"),
+    offset: int = Query(0, ge=0, description="Number of users to skip"),
     current_shop: models.Shop = Depends(get_current_shop),
     db: Session = Depends(get_db),
 ):
     """
-    Endpoint to get all users for shop admin
+    Endpoint to get all users for shop admin with their order count, total spent and last order date
     """
-    users = utils.get_all_users_ordered_in_shop(db, current_shop.id)
+    users = utils.get_all_users_ordered_in_shop(db, current_shop.id, sort_by, limit, offset)
     return users
 
 
@@ -172,14 +177,23 @@ def get_user_orders_shop(
 
 @router.get("-admin/stats-items/")
 def get_stats_items_per_shop(
+    start_date: date = Query(None, description="Filter orders by start date"),
+    end_date: date = Query(None, description="Filter orders by end date"),
     current_shop: models.Shop = Depends(get_current_shop),
     db: Session = Depends(get_db),
 ):
     """
-    Endpoint to get stats of items per shop
+    Endpoint to get stats of items per shop with filtering by start date and end date
     """
-    stats = utils.get_stats_for_each_item(db, current_shop.id)
-    return stats
+    if start_date and end_date:
+        if start_date > end_date:
+            raise HTTPException(status_code=409, detail="Start date cannot be greater than end date.")
+
+        stats = utils.get_stats_for_each_item(db, current_shop.id, str(start_date), str(end_date))
+        return stats
+    else:
+        stats = utils.get_stats_for_each_item(db, current_shop.id)
+        return stats
 
 
 @router.get("-admin/revenue/")
@@ -1,8 +1,10 @@
+from datetime import datetime, timezone
+
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from sqlalchemy.orm import Session
 
-from shop import schemas, utils
-from shop.models import User
+from shop import catalog, passwords, schemas, utils
+from shop.models import NewsletterCampaign, User
 from shop.utils import get_db
 
 router = APIRouter(prefix="/superuser", tags=["superuser"])
@@ -159,6 +161,9 @@ def update_shop_order_superuser(
     shop_order_data_dict = shop_order_data.model_dump()
 
     shop_order = utils.get_shop_order_by_id(db, shop_order_id)
+    # take the old values out of the revenue rollup, the new ones are added back after the update
+    if shop_order.billing_status:
+        utils.update_shop_revenue(db, [shop_order.id], sign=-1)
     changed = 0
     for key, value in shop_order_data_dict.items():
         current_value = getattr(shop_order, key)
@@ -169,6 +174,9 @@ def update_shop_order_superuser(
     if not changed:
         raise HTTPException(status_code=422, detail="Model was not changed.")
 
+    db.flush()
+    if shop_order.billing_status:
+        utils.update_shop_revenue(db, [shop_order.id])
     db.commit()
     db.refresh(shop_order)
 
@@ -212,6 +220,8 @@ def delete_item_review_superuser(
     item_review_id: int, current_user: User = Depends(utils.get_super_user), db: Session = Depends(get_db)
 ):
     item_review = utils.get_item_review_by_id(db, item_review_id)
+    if item_review.stars:
+        utils.update_item_rating(db, item_review.item_id, item_review.stars, sign=-1)
     db.delete(item_review)
     db.commit()
     return item_review
@@ -224,6 +234,7 @@ def delete_order_superuser(
     order = utils.get_order_by_order_id(db, order_id)
     # also delete all shop_orders
     shop_orders = order.shop_orders
+    utils.update_shop_revenue(db, [shop_order.id for shop_order in shop_orders if shop_order.billing_status], sign=-1)
     for shop_order in shop_orders:
         db.delete(shop_order)
 
@@ -250,3 +261,78 @@ def delete_user_superuser(
     db.delete(user)
     db.commit()
     return user
+
+
+@router.post("/newsletter-campaigns/", response_model=schemas.NewsletterCampaignOut)
+def create_newsletter_campaign_superuser(
+    campaign_data: schemas.NewsletterCampaignCreate,
+    current_user: User = Depends(utils.get_super_user),
+    db: Session = Depends(get_db),
+):
+    campaign = NewsletterCampaign(**campaign_data.model_dump())
+    if campaign.scheduled_at:
+        campaign.status = schemas.CampaignStatusEnum.SCHEDULED
+    db.add(campaign)
+    db.commit()
+    db.refresh(campaign)
+    return campaign
+
+
+@router.get("/newsletter-campaigns/", response_model=list[schemas.NewsletterCampaignOut])
+def get_newsletter_campaigns_superuser(
+    current_user: User = Depends(utils.get_super_user), db: Session = Depends(get_db)
+):
+    return db.query(NewsletterCampaign).order_by(NewsletterCampaign.id.desc()).all()
+
+
+@router.get("/newsletter-campaigns/{campaign_id}/", response_model=schemas.NewsletterCampaignOut)
+def get_newsletter_campaign_superuser(
+    campaign_id: int, current_user: User = Depends(utils.get_super_user), db: Session = Depends(get_db)
+):
+    return utils.get_newsletter_campaign_by_id(db, campaign_id)
+
+
+@router.post("/newsletter-campaigns/{campaign_id}/schedule/", response_model=schemas.NewsletterCampaignOut)
+def schedule_newsletter_campaign_superuser(
+    campaign_id: int,
+    schedule_data: schemas.NewsletterCampaignSchedule,
+    current_user: User = Depends(utils.get_super_user),
+    db: Session = Depends(get_db),
+):
+    campaign = utils.get_newsletter_campaign_by_id(db, campaign_id)
+    schedulable = (
+        schemas.CampaignStatusEnum.DRAFT,
+        schemas.CampaignStatusEnum.SCHEDULED,
+        schemas.CampaignStatusEnum.FAILED,
+    )
+    if campaign.status not in schedulable:
+        raise HTTPException(status_code=409, detail=f"Campaign is already {campaign.status.value}.")
+    # a failed campaign resumes after its checkpoint
+    campaign.attempts = 0
+    campaign.status = schemas.CampaignStatusEnum.SCHEDULED
+    campaign.scheduled_at = schedule_data.scheduled_at or datetime.now(timezone.utc)
+    db.commit()
+    db.refresh(campaign)
+    return campaign
+
+
+@router.post("/newsletter-campaigns/{campaign_id}/send/", response_model=schemas.NewsletterCampaignOut)
+def send_newsletter_campaign_superuser(
+    campaign_id: int, current_user: User = Depends(utils.get_super_user), db: Session = Depends(get_db)
+):
+    """
+    Schedules the campaign for now, the email worker starts sending it on its next poll.
+    """
+    return schedule_newsletter_campaign_superuser(campaign_id, schemas.NewsletterCampaignSchedule(), current_user, db)
+
+
+@router.get("/metrics/")
+def get_metrics_superuser(current_user: User = Depends(utils.get_super_user)):
+    """
+    Load of the process serving the request.
+    """
+    return {
+        "password_hashing": passwords.password_hasher.stats(),
+        "catalog": catalog.cache.stats(),
+        **utils.get_pool_stats(),
+    }
@@ -3,7 +3,7 @@ from sqlalchemy.orm import Session
 
 from shop import models, schemas, utils
 from shop.database import SessionLocal
-from shop.utils import get_current_user, get_db
+from shop.utils import get_current_user, get_db, get_read_db
 
 router = APIRouter(prefix="/user", tags=["users"])
 
@@ -76,7 +76,7 @@ def delete_user(current_user: models.User = Depends(get_current_user), db: Sessi
 
 
 @router.get("/{user_id}", response_model=schemas.UserOut)
-def read_user(user_id: int, db: SessionLocal = Depends(get_db)):
+def read_user(user_id: int, db: SessionLocal = Depends(get_read_db)):
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if user is None:
         raise HTTPException(status_code=404, detail="User not found.")
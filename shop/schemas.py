@@ -17,6 +17,21 @@ class ShopOrderStatusEnum(str, Enum):
     SENT = "Sent"
 
 
+class ShopCustomerSortEnum(str, Enum):
+    LAST_ORDER = "last_order"
+    TOTAL_SPENT = "total_spent"
+    ORDER_COUNT = "order_count"
+
+
+class CampaignStatusEnum(str, Enum):
+    DRAFT = "draft"
+    SCHEDULED = "scheduled"
+    SENDING = "sending"
+    SENT = "sent"
+    # given up after EMAIL_MAX_ATTEMPTS failed attempts, scheduling it again resumes it
+    FAILED = "failed"
+
+
 class UserBase(BaseModel):
     """
     Base Pydantic model for User. Includes common fields for create and update operations.
@@ -116,6 +131,17 @@ class UserOut(BaseModel):
         return value
 
 
+class ShopCustomerOut(UserOut):
+    """
+    Pydantic model for sending a customer of the shop in API responses.
+    Inherits from UserOut and includes the customer's aggregated billed orders in the shop.
+    """
+
+    order_count: int
+    total_spent: float
+    last_order_at: datetime
+
+
 class UserProfileCreate(UserProfileBase):
     """
     Pydantic model for creating a new UserProfile.
@@ -333,7 +359,8 @@ class ItemOut(ItemCreate):
     is_available: bool
     is_approved: bool
     created_at: datetime
-    reviews: Optional[list[ItemReviewOut]] = None
+    updated_at: Optional[datetime] = None
+    rating_histogram: dict[int, int]
 
 
 class CartBase(BaseModel):
@@ -366,6 +393,22 @@ class CartPatch(CartBase):
     quantity: Optional[int] = None
 
 
+class CartSync(CartBase):
+    """
+    Pydantic model for setting the quantity of an Item in the Cart by its slug.
+    Inherits from CartBase, a quantity of 0 removes the Item from the Cart.
+    """
+
+    item_slug: str
+    quantity: int
+
+    @field_validator("quantity")
+    def validate_quantity(cls, value):
+        if value < 0:
+            raise ValueError("Quantity can't be negative")
+        return value
+
+
 class CartOut(CartBase):
     """
     Pydantic model for sending Cart data in API responses.
@@ -502,6 +545,53 @@ class NewsLetterOut(NewsLetterBase):
     created_at: datetime
 
 
+class NewsletterCampaignCreate(BaseModel):
+    """
+    Pydantic model for creating a new NewsletterCampaign.
+    `{{email}}` and `{{unsubscribe_url}}` in the subject and content are replaced for every subscriber.
+    A campaign with scheduled_at is scheduled right away, otherwise it is kept as a draft.
+    """
+
+    subject: str
+    html_content: str
+    scheduled_at: Optional[datetime] = None
+
+    class Config:
+        validate_assignment = True
+        extra = "forbid"
+
+
+class NewsletterCampaignSchedule(BaseModel):
+    """
+    Pydantic model for scheduling a NewsletterCampaign, it is sent as soon as possible without scheduled_at.
+    """
+
+    scheduled_at: Optional[datetime] = None
+
+    class Config:
+        validate_assignment = True
+        extra = "forbid"
+
+
+class NewsletterCampaignOut(NewsletterCampaignCreate):
+    """
+    Pydantic model for sending NewsletterCampaign data in API responses.
+    """
+
+    id: int
+    status: CampaignStatusEnum
+    sent_count: int
+    rejected_count: int
+    attempts: int
+    last_error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
 class PatchCartItemAdmin(CartBase):
     """
     Pydantic model for partially updating an existing CartItem.
@@ -1,30 +1,113 @@
 import os
-from collections import defaultdict
+import time
+from datetime import date, timedelta
 
-from fastapi import Depends, HTTPException
-from jose import JWTError, jwt
+from fastapi import Depends, HTTPException, Request
+from jose import JWTError
+from pydantic import ValidationError
 from slugify import slugify
+from sqlalchemy import case, delete, exists, func, insert, literal, literal_column, or_, select, true, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from shop import constants
+from shop import catalog, constants, database, keyring
 from shop.auth import oauth2_scheme
-from shop.database import SessionLocal, TestingSessionLocal
-from shop.models import CartItem, Category, Item, ItemReview, NewsLetter, Order, OrderItem, Shop, ShopOrder, User
-from shop.schemas import TokenData
+from shop.database import (
+    ReadSessionLocal,
+    SessionLocal,
+    TestingSessionLocal,
+    async_pool_stats,
+    engine,
+    get_async_sessionmaker,
+    pool_stats,
+    test_engine,
+)
+from shop.models import (
+    CartItem,
+    Category,
+    Item,
+    ItemReview,
+    NewsLetter,
+    NewsletterCampaign,
+    Order,
+    OrderItem,
+    Shop,
+    ShopOrder,
+    ShopRevenueDaily,
+    StripeEvent,
+    User,
+    association_table,
+)
+from shop.principals import Principal, principal_cache
+from shop.schemas import ItemCreate, ShopCustomerSortEnum, TokenData
 
 
 # Dependency to get the database session
-def get_db():
+def get_session() -> Session:
     if os.getenv("ENVIRONMENT") == "test":
-        db = TestingSessionLocal()
+        return TestingSessionLocal()
+    return SessionLocal()
+
+
+def get_db():
+    db = get_session()
+    try:
         yield db
+    finally:
         db.close()
-    else:
-        db = SessionLocal()
-        try:
-            yield db
-        finally:
-            db.close()
+
+
+# set on the responses to writes, a client's reads go to the primary until it expires
+LAST_WRITE_COOKIE = "last_write"
+
+
+def wrote_recently(request: Request) -> bool:
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < constants.READ_YOUR_WRITES_WINDOW
+
+
+# Dependency to get a database session for read-only endpoints, on a read replica when there is a healthy one and
+# the client has not written anything recently
+def get_read_db(request: Request):
+    replica = None if wrote_recently(request) else database.replicas.choose()
+    if replica is None:
+        yield from get_db()
+        return
+    db = ReadSessionLocal(bind=replica)
+    try:
+        yield db
+    except OperationalError:
+        database.replicas.mark_down(replica)
+        raise
+    finally:
+        db.close()
+
+
+# Dependency to get an async database session, for async def handlers. Sync helpers taking a Session run on it
+# with `await db.run_sync(helper, ...)`, without blocking the event loop.
+def get_async_session() -> AsyncSession:
+    return get_async_sessionmaker(test=os.getenv("ENVIRONMENT") == "test")()
+
+
+async def get_async_db():
+    db = get_async_session()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+def get_pool_stats() -> dict:
+    test = os.getenv("ENVIRONMENT") == "test"
+    return {
+        "database_pool": pool_stats(test_engine if test else engine),
+        "async_database_pool": async_pool_stats(test),
+    }
 
 
 def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)) -> User:
@@ -34,12 +117,7 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(
-            token,
-            constants.JWT_SECRET,
-            algorithms=[constants.ALGORITHM],
-            options={"verify_aud": False},
-        )
+        payload = keyring.decode(token, verify_aud=False)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -47,21 +125,39 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(
-        User.id == token_data.username,
-    )
+    principal = principal_cache.get(token_data.username)
+    if principal is None:
+        try:
+            user_id = int(token_data.username)
+        except ValueError:
+            raise credentials_exception
+        # the user and the id of their approved shop in one query, cached for the next requests
+        row = (
+            db.query(User, Shop.id)
+            .outerjoin(Shop, (Shop.user_id == User.id) & (Shop.is_approved == True))
+            .filter(User.id == user_id)
+            .first()
+        )
+        if not row:
+            raise credentials_exception
+        user, shop_id = row
+        principal = Principal(user.id, user.role, user.is_active, user.is_superuser, shop_id)
+        principal_cache.put(token_data.username, principal)
+    else:
+        user = principal.attach_user(db)
 
-    if user.first():
-        active_user = user.filter(User.is_active == True).first()
-        if active_user:
-            return active_user
+    if not principal.is_active:
         raise HTTPException(status_code=401, detail="Please activate your account.")
-    else:
-        raise credentials_exception
+    return user
 
 
 def get_current_shop(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)) -> Shop:
     if current_user.role == "SHOP":
+        principal = principal_cache.get(str(current_user.id))
+        if principal is not None:
+            if principal.shop_id is not None:
+                return principal.attach_shop(db)
+            raise HTTPException(status_code=403, detail="Your shop is not approved.")
         shop = db.query(Shop).filter(Shop.user_id == current_user.id, Shop.is_approved == True).first()
         if shop:
             return shop
@@ -139,26 +235,80 @@ def check_free_shop_name(db: Session, shop_name: str):
     return existing_shop
 
 
-def generate_unique_category_slug(db: Session, shop_name: str, category_name: str):
-    unique_slug = f"{slugify(shop_name)}-{slugify(category_name)}"
-    counter = 1
+# prefixes looked up per query, every one adds a LIKE to the OR, SQLite refuses expressions deeper than 1000
+SLUG_PREFIXES_PER_QUERY = 200
 
-    while db.query(Category).filter(Category.slug == unique_slug).first():
-        unique_slug = f"{unique_slug}-{counter}"
-        counter += 1
 
-    return unique_slug
+def _generate_unique_slugs(db: Session, slug_column, base_slugs: list[str]):
+    # one query per chunk of prefixes, the first free "<base_slug>-<counter>" is picked in memory
+    prefixes = sorted(set(base_slugs))
+    taken = set()
+    for start in range(0, len(prefixes), SLUG_PREFIXES_PER_QUERY):
+        chunk = prefixes[start : start + SLUG_PREFIXES_PER_QUERY]
+        taken.update(
+            db.scalars(
+                select(slug_column).where(
+                    or_(slug_column.in_(chunk), *[slug_column.like(f"{base_slug}-%") for base_slug in chunk])
+                )
+            )
+        )
 
+    unique_slugs = []
+    for base_slug in base_slugs:
+        unique_slug = base_slug
+        counter = 1
+        while unique_slug in taken:
+            unique_slug = f"{base_slug}-{counter}"
+            counter += 1
+        taken.add(unique_slug)
+        unique_slugs.append(unique_slug)
+
+    return unique_slugs
+
+
+def _generate_unique_slug(db: Session, slug_column, base_slug: str):
+    return _generate_unique_slugs(db, slug_column, [base_slug])[0]
+
+
+# the unique index of `table`.slug is named <table>_slug_key on Postgres, SQLite only names the column
+def _is_unique_slug_violation(error: IntegrityError, table: str) -> bool:
+    diag = getattr(error.orig, "diag", None)
+    if diag is not None:
+        return diag.constraint_name == f"{table}_slug_key"
+    return str(error.orig) == f"UNIQUE constraint failed: {table}.slug"
+
+
+# before_commit adds whatever has to be committed together with the instance, it runs again on every retry. `values`
+# are set on slugged on every attempt too, the rollback discards the changes of a row that already exists.
+def commit_with_unique_slug(
+    db: Session, slugged, generate_slug, instance=None, attempts: int = 3, before_commit=None, values: dict = None
+):
+    instance = instance or slugged
+    for attempt in range(attempts):
+        for key, value in (values or {}).items():
+            setattr(slugged, key, value)
+        slug = generate_slug()
+        slugged.slug = slug
+        db.add(instance)
+        try:
+            if before_commit:
+                db.flush()
+                before_commit()
+            db.commit()
+            return instance
+        except IntegrityError:
+            db.rollback()
+            # retry only if a concurrent request took the slug between generating and inserting it
+            if attempt == attempts - 1 or generate_slug() == slug:
+                raise
 
-def generate_unique_shop_slug(db: Session, shop_name: str):
-    counter = 1
-    unique_slug = slugify(shop_name)
 
-    while db.query(Shop).filter(Shop.slug == unique_slug).first():
-        unique_slug = f"{unique_slug}-{counter}"
-        counter += 1
+def generate_unique_category_slug(db: Session, shop_name: str, category_name: str):
+    return _generate_unique_slug(db, Category.slug, f"{slugify(shop_name)}-{slugify(category_name)}")
+
 
-    return unique_slug
+def generate_unique_shop_slug(db: Session, shop_name: str):
+    return _generate_unique_slug(db, Shop.slug, slugify(shop_name))
 
 
 def check_free_category_name(db: Session, shop_id: int, category_name: str):
@@ -183,14 +333,73 @@ def get_category_by_slug(db: Session, category_slug: str):
 
 
 def generate_unique_item_slug(db: Session, shop_name: str, item_name: str):
-    unique_slug = f"{slugify(shop_name)}-{slugify(item_name)}"
-    counter = 1
+    return _generate_unique_slug(db, Item.slug, f"{slugify(shop_name)}-{slugify(item_name)}")
 
-    while db.query(Item).filter(Item.slug == unique_slug).first():
-        unique_slug = f"{unique_slug}-{counter}"
-        counter += 1
 
-    return unique_slug
+def create_items_bulk(db: Session, shop: Shop, category_ids: set[int], rows: list[tuple[int, dict]]):
+    errors = []
+    items = []
+    names = set()
+    for row_number, row in rows:
+        try:
+            item_data = ItemCreate.model_validate(row)
+        except ValidationError as e:
+            errors.append({"row": row_number, "errors": [{"loc": err["loc"], "msg": err["msg"]} for err in e.errors()]})
+            continue
+        if item_data.category_id not in category_ids:
+            errors.append({"row": row_number, "errors": [{"loc": ["category_id"], "msg": "Category not found."}]})
+        elif item_data.name in names:
+            detail = f"You already have item with the name '{item_data.name}'."
+            errors.append({"row": row_number, "errors": [{"loc": ["name"], "msg": detail}]})
+        else:
+            names.add(item_data.name)
+            items.append((row_number, item_data))
+
+    # names taken by earlier batches or items created before the import
+    taken_names = set(db.scalars(select(Item.name).where(Item.shop_id == shop.id, Item.name.in_(names))))
+    for row_number, item_data in items:
+        if item_data.name in taken_names:
+            detail = f"You already have item with the name '{item_data.name}'."
+            errors.append({"row": row_number, "errors": [{"loc": ["name"], "msg": detail}]})
+    items = [(row_number, item_data) for row_number, item_data in items if item_data.name not in taken_names]
+
+    for attempt in range(3):
+        if not items:
+            return 0, errors
+        base_slugs = [f"{slugify(shop.shop_name)}-{slugify(item_data.name)}" for _, item_data in items]
+        slugs = _generate_unique_slugs(db, Item.slug, base_slugs)
+        try:
+            # the returned ids let the catalog snapshot add the new items instead of reloading everything
+            db.execute(
+                insert(Item).returning(Item.id),
+                [
+                    dict(item_data.model_dump(), shop_id=shop.id, slug=slug)
+                    for (_, item_data), slug in zip(items, slugs)
+                ],
+            )
+            db.commit()
+            return len(items), errors
+        except IntegrityError as e:
+            db.rollback()
+            if _is_unique_slug_violation(e, Item.__tablename__):
+                # a concurrent request took one of the slugs, generate them again
+                if attempt == 2:
+                    raise
+                continue
+            # a category deleted during the import fails the foreign key, its rows are skipped and the others retried
+            deleted = category_ids - set(db.scalars(select(Category.id).where(Category.id.in_(category_ids))))
+            category_ids -= deleted
+            for row_number, item_data in items:
+                if item_data.category_id in deleted:
+                    errors.append(
+                        {"row": row_number, "errors": [{"loc": ["category_id"], "msg": "Category not found."}]}
+                    )
+            items = [(row_number, item_data) for row_number, item_data in items if item_data.category_id not in deleted]
+            if not deleted or attempt == 2:
+                # retrying would fail the same way
+                for row_number, _ in items:
+                    errors.append({"row": row_number, "errors": [{"loc": [], "msg": "The item could not be created."}]})
+                return 0, errors
 
 
 def check_free_item_name(db: Session, shop_id: int, item_name: str):
@@ -216,6 +425,95 @@ def get_item_by_slug(db: Session, item_slug: str):
     return existing_item
 
 
+def get_available_items(db: Session, shop_slug: str = None, category_name: str = None, limit: int = 50, after=None):
+    # Unknown shop/category filters are ignored, so the whole lookup is composed into a single statement:
+    # the shop id is resolved in a scalar subquery and falls back to the row's own value when it is missing.
+    query = db.query(Item).filter(Item.is_approved == True, Item.is_available == True)
+
+    shop_id = select(Shop.id).where(Shop.slug == shop_slug).scalar_subquery()
+    if shop_slug:
+        query = query.filter(Item.shop_id == func.coalesce(shop_id, Item.shop_id))
+
+    if category_name:
+        categories = select(Category.id).where(Category.name == category_name)
+        if shop_slug:
+            categories = categories.where(Category.shop_id == shop_id)
+        category_filter = or_(Item.category_id.in_(categories), ~exists(categories))
+        if shop_slug:
+            category_filter = or_(shop_id.is_(None), category_filter)
+        query = query.filter(category_filter)
+
+    # keyset pagination on the primary key, page N costs the same as page 1
+    if after is not None:
+        query = query.filter(Item.id > after)
+    items = query.order_by(Item.id).limit(limit + 1).all()
+
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return items[:limit], next_cursor
+
+
+# The public catalog is read from the in-process snapshot of shop/catalog.py, the database is only queried for items
+# that are not public (404 or not approved yet) or with CATALOG_CACHE turned off
+def get_catalog_items(db: Session, shop_slug: str = None, category_name: str = None, limit: int = 50, after=None):
+    if not constants.CATALOG_CACHE:
+        return get_available_items(db, shop_slug, category_name, limit, after)
+    return catalog.cache.snapshot(get_session).available_items(shop_slug, category_name, limit, after)
+
+
+def get_catalog_item(db: Session, item_slug: str):
+    item = catalog.cache.snapshot(get_session).get_item(item_slug) if constants.CATALOG_CACHE else None
+    return item or get_item_by_slug(db, item_slug)
+
+
+def _average_rating(rating_sum, review_count):
+    return case((review_count > 0, func.round(rating_sum * literal_column("1.0") / review_count, 1)), else_=0.0)
+
+
+# Adds (sign=1) or removes (sign=-1) a review's stars in a single UPDATE, so concurrent reviews don't lose counts
+def update_item_rating(db: Session, item_id: int, stars: int, sign: int = 1):
+    review_count = Item.review_count + sign
+    rating_sum = Item.rating_sum + sign * stars
+    stars_count = getattr(Item, f"stars_{stars}_count")
+    db.query(Item).filter(Item.id == item_id).update(
+        {
+            Item.review_count: review_count,
+            Item.rating_sum: rating_sum,
+            Item.average_rating: _average_rating(rating_sum, review_count),
+            stars_count: stars_count + sign,
+        },
+        synchronize_session=False,
+    )
+
+
+def rebuild_item_ratings(db: Session):
+    reviews = select(func.count(ItemReview.stars)).where(ItemReview.item_id == Item.id)
+    rating_sum = (
+        select(func.coalesce(func.sum(ItemReview.stars), 0)).where(ItemReview.item_id == Item.id).scalar_subquery()
+    )
+    counters = {Item.review_count: reviews.scalar_subquery(), Item.rating_sum: rating_sum}
+    for stars in range(1, 6):
+        counters[getattr(Item, f"stars_{stars}_count")] = reviews.where(ItemReview.stars == stars).scalar_subquery()
+    db.query(Item).update(counters, synchronize_session=False)
+    db.query(Item).update(
+        {Item.average_rating: _average_rating(Item.rating_sum, Item.review_count)}, synchronize_session=False
+    )
+
+
+# The ids of a page of an item's reviews, read from the (item_id, id) index alone, keyset paginated like items
+def get_item_review_ids(db: Session, item_id: int, limit: int = 50, after=None):
+    query = db.query(ItemReview.id).filter(ItemReview.item_id == item_id)
+    if after is not None:
+        query = query.filter(ItemReview.id > after)
+    review_ids = [review_id for review_id, in query.order_by(ItemReview.id).limit(limit + 1)]
+
+    next_cursor = review_ids[limit - 1] if len(review_ids) > limit else None
+    return review_ids[:limit], next_cursor
+
+
+def get_item_reviews_by_ids(db: Session, review_ids: list):
+    return db.query(ItemReview).filter(ItemReview.id.in_(review_ids)).order_by(ItemReview.id).all()
+
+
 def check_item_owner(db: Session, shop_id: int, item_slug: str):
     existing_item = (
         db.query(Item)
@@ -243,6 +541,83 @@ def get_cart_item(db: Session, user_id: int, item_id: int):
     return existing_cart_item
 
 
+# Inserts the item into the cart or increments its quantity in one INSERT ... ON CONFLICT DO UPDATE statement
+def add_cart_item(db: Session, user_id: int, item_slug: str):
+    item = select(literal(user_id), Item.id, literal(1), Item.price).where(Item.slug == item_slug)
+    statement = _insert(db, CartItem).from_select(["user_id", "item_id", "quantity", "price"], item)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CartItem.user_id, CartItem.item_id],
+        set_={
+            "quantity": CartItem.quantity + 1,
+            "price": statement.excluded.price * (CartItem.quantity + 1),
+            "updated_at": func.now(),
+        },
+    )
+    cart_item = db.execute(statement.returning(CartItem.item_id, CartItem.quantity, CartItem.price)).first()
+    if not cart_item:
+        raise HTTPException(status_code=404, detail="Item not found.")
+    return cart_item
+
+
+# Decrements the quantity of the item in the cart, returns (cart_item, removed)
+# where cart_item is None if the item was removed from the cart or was not in it
+def subtract_cart_item(db: Session, user_id: int, item_slug: str):
+    item_id = select(Item.id).where(Item.slug == item_slug).scalar_subquery()
+    item_price = select(Item.price).where(Item.id == CartItem.item_id).scalar_subquery()
+    cart_item = db.execute(
+        update(CartItem)
+        .where(CartItem.user_id == user_id, CartItem.item_id == item_id, CartItem.quantity > 1)
+        .values(quantity=CartItem.quantity - 1, price=item_price * (CartItem.quantity - 1))
+        .returning(CartItem.item_id, CartItem.quantity, CartItem.price)
+    ).first()
+    if cart_item:
+        return cart_item, False
+
+    removed = db.execute(
+        delete(CartItem).where(CartItem.user_id == user_id, CartItem.item_id == item_id).returning(CartItem.id)
+    ).first()
+    if not removed:
+        # tell an unknown item apart from one that is not in the cart
+        get_item_by_slug(db, item_slug)
+    return None, bool(removed)
+
+
+# Sets the quantities of many cart items at once: one IN query for the items, one upsert and one delete
+def sync_cart_items(db: Session, user_id: int, quantities: dict[str, int]):
+    items = db.query(Item.id, Item.slug, Item.price).filter(Item.slug.in_(quantities)).all()
+    if len(items) != len(quantities):
+        missing = sorted(set(quantities) - {item.slug for item in items})
+        raise HTTPException(status_code=404, detail=f"Items not found: {', '.join(missing)}.")
+
+    upserted = [
+        {
+            "user_id": user_id,
+            "item_id": item.id,
+            "quantity": quantities[item.slug],
+            "price": item.price * quantities[item.slug],
+        }
+        for item in items
+        if quantities[item.slug] > 0
+    ]
+    if upserted:
+        statement = _insert(db, CartItem).values(upserted)
+        db.execute(
+            statement.on_conflict_do_update(
+                index_elements=[CartItem.user_id, CartItem.item_id],
+                set_={
+                    "quantity": statement.excluded.quantity,
+                    "price": statement.excluded.price,
+                    "updated_at": func.now(),
+                },
+            )
+        )
+    removed = [item.id for item in items if quantities[item.slug] == 0]
+    if removed:
+        db.execute(delete(CartItem).where(CartItem.user_id == user_id, CartItem.item_id.in_(removed)))
+
+    return db.query(CartItem).filter(CartItem.user_id == user_id).order_by(CartItem.id).all()
+
+
 def get_cart_items(db: Session, user_id: int):
     existing_cart_items = (
         db.query(CartItem)
@@ -256,6 +631,124 @@ def get_cart_items(db: Session, user_id: int):
     return existing_cart_items
 
 
+# Cart items joined with the shop of their item, everything order placement needs in one query
+def get_cart_lines(db: Session, user_id: int):
+    cart_lines = (
+        db.query(CartItem.id, CartItem.item_id, CartItem.quantity, CartItem.price, Item.shop_id, Item.name)
+        .join(Item, Item.id == CartItem.item_id)
+        .filter(CartItem.user_id == user_id)
+        .order_by(CartItem.id)
+        .all()
+    )
+    if not cart_lines:
+        raise HTTPException(status_code=409, detail="Cart is empty.")
+    return cart_lines
+
+
+# Turns the cart lines into an Order with its OrderItems and ShopOrders using bulk inserts, then empties the cart.
+# Nothing is committed here, the caller commits the whole order at once. Returns the order and whether it was created:
+# a second checkout of the same cart gets the same PaymentIntent, and with it the order placed by the first one.
+def create_order(db: Session, user_id: int, cart_lines: list, order_key: str, **order_data):
+    order_id = db.execute(
+        _insert(db, Order)
+        .values(
+            user_id=user_id,
+            total_paid=sum(cart_line.price for cart_line in cart_lines),
+            order_key=order_key,
+            **order_data,
+        )
+        .on_conflict_do_nothing(index_elements=[Order.order_key])
+        .returning(Order.id)
+    ).scalar()
+    if order_id is None:
+        return db.query(Order).filter(Order.order_key == order_key).one(), False
+    new_order = db.get(Order, order_id)
+
+    db.execute(
+        insert(OrderItem),
+        [
+            {
+                "order_id": new_order.id,
+                "item_id": cart_line.item_id,
+                "quantity": cart_line.quantity,
+                "price": cart_line.price,
+            }
+            for cart_line in cart_lines
+        ],
+    )
+
+    shop_totals = {}
+    for cart_line in cart_lines:
+        shop_totals[cart_line.shop_id] = shop_totals.get(cart_line.shop_id, 0) + cart_line.price
+    shop_orders = db.execute(
+        insert(ShopOrder).returning(ShopOrder.id, ShopOrder.billing_status),
+        [
+            {"shop_id": shop_id, "order_id": new_order.id, "user_id": user_id, "total_paid": shop_total_price}
+            for shop_id, shop_total_price in shop_totals.items()
+        ],
+    ).all()
+    update_shop_revenue(db, [shop_order.id for shop_order in shop_orders if shop_order.billing_status])
+
+    # only the lines that were ordered, items added to the cart meanwhile stay there. Lines already gone were ordered
+    # by a concurrent checkout of an overlapping cart.
+    deleted = db.execute(delete(CartItem).where(CartItem.id.in_([cart_line.id for cart_line in cart_lines]))).rowcount
+    if deleted < len(cart_lines):
+        db.rollback()
+        raise HTTPException(status_code=409, detail="The cart changed while the order was placed, please try again.")
+    return new_order, True
+
+
+# Stores a received Stripe event, returns False if it was received before
+def record_stripe_event(db: Session, event_id: str, event_type: str, order_key: str = None) -> bool:
+    statement = _insert(db, StripeEvent).values(id=event_id, type=event_type, order_key=order_key)
+    return db.execute(statement.on_conflict_do_nothing(index_elements=[StripeEvent.id])).rowcount == 1
+
+
+# Applies pending Stripe events batch by batch: one UPDATE bills every Order and ShopOrder paid by the batch
+def process_stripe_events(db: Session, batch_size: int = 500) -> int:
+    processed = 0
+    while True:
+        events = (
+            db.query(StripeEvent.id, StripeEvent.order_key)
+            .filter(StripeEvent.processed_at.is_(None))
+            .order_by(StripeEvent.created_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not events:
+            return processed
+
+        order_keys = {event.order_key for event in events if event.order_key}
+        if order_keys:
+            db.execute(
+                update(Order)
+                .where(Order.order_key.in_(order_keys), Order.billing_status == False)
+                .values(billing_status=True)
+                .execution_options(synchronize_session=False)
+            )
+            # only the shop orders flipped here are added to the revenue, so replays never count twice
+            billed_shop_order_ids = db.scalars(
+                update(ShopOrder)
+                .where(
+                    ShopOrder.order_id.in_(select(Order.id).where(Order.order_key.in_(order_keys))),
+                    ShopOrder.billing_status == False,
+                )
+                .values(billing_status=True)
+                .returning(ShopOrder.id)
+                .execution_options(synchronize_session=False)
+            ).all()
+            update_shop_revenue(db, billed_shop_order_ids)
+        db.execute(
+            update(StripeEvent)
+            .where(StripeEvent.id.in_([event.id for event in events]))
+            .values(processed_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        processed += len(events)
+
+
 def get_orders(db: Session, user_id: int):
     existing_orders = db.query(Order).filter(Order.user_id == user_id, Order.billing_status == True).all()
     if not existing_orders:
@@ -320,94 +813,172 @@ def get_shop_orders_by_user_id_for_shop(db: Session, user_id: int, shop_id: int)
     return existing_orders
 
 
-def get_all_users_ordered_in_shop(db: Session, shop_id: int):
-    shop_orders = (
-        db.query(ShopOrder)
+def get_all_users_ordered_in_shop(
+    db: Session,
+    shop_id: int,
+    sort_by: ShopCustomerSortEnum = ShopCustomerSortEnum.LAST_ORDER,
+    limit: int = 50,
+    offset: int = 0,
+):
+    order_count = func.count(ShopOrder.id).label("order_count")
+    total_spent = func.sum(ShopOrder.total_paid).label("total_spent")
+    last_order_at = func.max(ShopOrder.created_at).label("last_order_at")
+    sort_columns = {
+        ShopCustomerSortEnum.LAST_ORDER: last_order_at,
+        ShopCustomerSortEnum.TOTAL_SPENT: total_spent,
+        ShopCustomerSortEnum.ORDER_COUNT: order_count,
+    }
+
+    users_per_shop = (
+        db.query(
+            User.id,
+            User.first_name,
+            User.last_name,
+            User.username,
+            User.email,
+            User.role,
+            order_count,
+            total_spent,
+            last_order_at,
+        )
+        .join(ShopOrder, ShopOrder.user_id == User.id)
         .filter(
             ShopOrder.shop_id == shop_id,
             ShopOrder.billing_status == True,
         )
+        .group_by(User.id)
+        .order_by(sort_columns[sort_by].desc(), User.id)
+        .limit(limit)
+        .offset(offset)
         .all()
     )
-    users_per_shop = set()
-    for order in shop_orders:
-        user = db.query(User).filter(User.id == order.user_id).first()
-        users_per_shop.add(user)
     if not users_per_shop:
         raise HTTPException(status_code=409, detail="No users have ordered in your shop.")
     return users_per_shop
 
 
-def get_stats_for_each_item(db: Session, shop_id: int):
-    items_per_shop = (
-        db.query(Item)
-        .filter(
-            Item.shop_id == shop_id,
+def get_stats_for_each_item(db: Session, shop_id: int, start_date: str = None, end_date: str = None):
+    # counted in correlated subqueries, joining wish_list/item_review would multiply the order item sums
+    wish_list_count = (
+        select(func.count()).where(association_table.c.item_id == Item.id).correlate(Item).scalar_subquery()
+    )
+    reviews_count = select(func.count(ItemReview.id)).where(ItemReview.item_id == Item.id).scalar_subquery()
+
+    query = (
+        db.query(
+            Item.id,
+            func.sum(OrderItem.price).label("price"),
+            func.sum(OrderItem.quantity).label("quantity"),
+            wish_list_count.label("wish_list_count"),
+            reviews_count.label("reviews_count"),
+            Item.average_rating,
         )
-        .all()
+        .join(OrderItem, OrderItem.item_id == Item.id)
+        .filter(Item.shop_id == shop_id)
     )
-    items_ids = [item.id for item in items_per_shop]
+    if start_date and end_date:
+        # the whole end day, like the revenue of ShopRevenueDaily.day
+        end = (date.fromisoformat(end_date) + timedelta(days=1)).isoformat()
+        query = query.join(Order, Order.id == OrderItem.order_id).filter(
+            Order.created_at >= start_date, Order.created_at < end
+        )
 
-    item_price_quantity_dict = defaultdict(dict)
+    item_price_quantity_dict = {
+        row.id: {
+            "price": row.price,
+            "quantity": row.quantity,
+            "wish_list_count": row.wish_list_count,
+            "reviews_count": row.reviews_count,
+            "average_rating": row.average_rating,
+        }
+        for row in query.group_by(Item.id, Item.average_rating)
+    }
 
-    order_items = (
-        db.query(OrderItem)
-        .filter(
-            OrderItem.item_id.in_(items_ids),
+    if not item_price_quantity_dict:
+        raise HTTPException(status_code=409, detail="No items have been sold in your shop.")
+
+    return item_price_quantity_dict
+
+
+def _insert(db: Session, table):
+    # INSERT ... ON CONFLICT is dialect specific in SQLAlchemy, both Postgres and SQLite support it
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def _shop_revenue_select(sign: int, *criteria):
+    items_sold = (
+        select(func.coalesce(func.sum(OrderItem.quantity), 0))
+        .join(Item, Item.id == OrderItem.item_id)
+        .where(OrderItem.order_id == ShopOrder.order_id, Item.shop_id == ShopOrder.shop_id)
+        .scalar_subquery()
+    )
+    shop_orders = (
+        select(
+            ShopOrder.shop_id,
+            func.date(ShopOrder.created_at).label("day"),
+            ShopOrder.total_paid,
+            items_sold.label("items_sold"),
         )
-        .all()
+        .where(ShopOrder.billing_status == True, *criteria)
+        .subquery()
+    )
+    return (
+        select(
+            shop_orders.c.shop_id,
+            shop_orders.c.day,
+            sign * func.count(),
+            sign * func.sum(shop_orders.c.total_paid),
+            sign * func.sum(shop_orders.c.items_sold),
+        )
+        .where(true())
+        .group_by(shop_orders.c.shop_id, shop_orders.c.day)
     )
 
-    for order_item in order_items:
-        item = db.query(Item).filter(Item.id == order_item.item_id).first()
-        if order_item.item_id not in item_price_quantity_dict:
-            item_price_quantity_dict[order_item.item_id]["price"] = order_item.price
-            item_price_quantity_dict[order_item.item_id]["quantity"] = order_item.quantity
-        else:
-            item_price_quantity_dict[order_item.item_id]["price"] += order_item.price
-            item_price_quantity_dict[order_item.item_id]["quantity"] += order_item.quantity
 
-        item_price_quantity_dict[order_item.item_id]["wish_list_count"] = len(item.users)
-        item_price_quantity_dict[order_item.item_id]["reviews_count"] = len(item.reviews)
-        item_price_quantity_dict[order_item.item_id]["average_rating"] = item.average_rating
+# Adds (sign=1) or subtracts (sign=-1) the given billed ShopOrders to the daily revenue rollup.
+# Call it after the ShopOrders are flushed and, when subtracting, before they are changed or deleted.
+def update_shop_revenue(db: Session, shop_order_ids: list[int], sign: int = 1):
+    if not shop_order_ids:
+        return
+    columns = ["shop_id", "day", "order_count", "revenue", "items_sold"]
+    statement = _insert(db, ShopRevenueDaily).from_select(
+        columns, _shop_revenue_select(sign, ShopOrder.id.in_(shop_order_ids))
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[ShopRevenueDaily.shop_id, ShopRevenueDaily.day],
+        set_={
+            "order_count": ShopRevenueDaily.order_count + statement.excluded.order_count,
+            "revenue": ShopRevenueDaily.revenue + statement.excluded.revenue,
+            "items_sold": ShopRevenueDaily.items_sold + statement.excluded.items_sold,
+        },
+    )
+    db.execute(statement)
 
-    if not item_price_quantity_dict:
-        raise HTTPException(status_code=409, detail="No items have been sold in your shop.")
 
-    return item_price_quantity_dict
+def rebuild_shop_revenue(db: Session):
+    db.query(ShopRevenueDaily).delete()
+    columns = ["shop_id", "day", "order_count", "revenue", "items_sold"]
+    db.execute(insert(ShopRevenueDaily).from_select(columns, _shop_revenue_select(1)))
 
 
 def get_total_revenue_with_filtering(db: Session, shop_id: int, start_date: str, end_date: str):
-    shop_orders = (
-        db.query(ShopOrder)
+    total_revenue = (
+        db.query(func.sum(ShopRevenueDaily.revenue))
         .filter(
-            ShopOrder.shop_id == shop_id,
-            ShopOrder.billing_status == True,
-            ShopOrder.created_at.between(start_date, end_date),
+            ShopRevenueDaily.shop_id == shop_id,
+            ShopRevenueDaily.day.between(start_date, end_date),
         )
-        .all()
+        .scalar()
     )
-
-    total_revenue = 0
-    for order in shop_orders:
-        total_revenue += order.total_paid
     if not total_revenue:
         raise HTTPException(status_code=409, detail="You have no orders in your shop for the given period.")
     return {"Revenue": total_revenue}
 
 
 def get_total_revenue(db: Session, shop_id: int):
-    shop_orders = (
-        db.query(ShopOrder)
-        .filter(
-            ShopOrder.shop_id == shop_id,
-            ShopOrder.billing_status == True,
-        )
-        .all()
-    )
-    total_revenue = 0
-    for order in shop_orders:
-        total_revenue += order.total_paid
+    total_revenue = db.query(func.sum(ShopRevenueDaily.revenue)).filter(ShopRevenueDaily.shop_id == shop_id).scalar()
     if not total_revenue:
         raise HTTPException(status_code=409, detail="No orders have been made in your shop.")
     return {"Total revenue": total_revenue}
@@ -428,6 +999,13 @@ def get_newsletter_by_id(db: Session, newsletter_id: int):
     return existing_email
 
 
+def get_newsletter_campaign_by_id(db: Session, campaign_id: int):
+    existing_campaign = db.query(NewsletterCampaign).filter(NewsletterCampaign.id == campaign_id).first()
+    if not existing_campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found.")
+    return existing_campaign
+
+
 def check_if_user_bought_item(db: Session, user_id: int, item_id: int):
     existing_order = (
         db.query(OrderItem)
@@ -1,18 +1,42 @@
+import hashlib
+import hmac
+import json
+import time
+from contextlib import contextmanager
 from unittest.mock import patch
 
 import pytest
 from faker import Faker
 from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from sqlalchemy import event
 
 from shop.auth import create_access_token
-from shop.database import TestingSessionLocal
+from shop.database import TestingSessionLocal, test_engine
 from shop.main import app
-from shop.models import Item, NewsLetter, Shop, ShopOrder, User
+from shop.models import Category, Item, NewsLetter, Shop, ShopOrder, User
+from tests import fake_stripe
 
 client = TestClient(app)
 
 
+@contextmanager
+def capture_statements(engine=test_engine, parameters: bool = False):
+    """
+    Collects the SQL statements run on `engine` inside the block, or (statement, parameters) pairs with `parameters`.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, statement_parameters, context, executemany):
+        statements.append((statement, statement_parameters) if parameters else statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 def get_newsletter_and_activate(email: str):
     db = TestingSessionLocal()
     newsletter = db.query(NewsLetter).filter(NewsLetter.email == email).first()
@@ -53,12 +77,24 @@ def get_shop_by_user_id(user_id: int):
 
 
 def create_order(data, shop_id: int):
-    mock_payment_intent = {"id": "mocked_payment_intent_id"}
-    with patch("shop.routers.orders.stripe.PaymentIntent.create", return_value=mock_payment_intent):
+    with patch("shop.payments._client", fake_stripe.client()):
         response = client.post(f"/create-order/", headers=get_headers(shop_id), json=data)
     return response
 
 
+STRIPE_WEBHOOK_SECRET = "whsec_test"
+
+
+def post_stripe_event(event: dict, secret: str = STRIPE_WEBHOOK_SECRET):
+    payload = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    headers = {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+    with patch("shop.constants.STRIPE_WEBHOOK_SECRET", STRIPE_WEBHOOK_SECRET):
+        response = client.post("/stripe-webhook/", headers=headers, content=payload)
+    return response
+
+
 def get_shop_order_by_order_id(shop_id: int, order_id: int):
     db = TestingSessionLocal()
     shop_order = db.query(ShopOrder).filter(ShopOrder.shop_id == shop_id, ShopOrder.order_id == order_id).first()
@@ -85,6 +121,16 @@ def ger_user_by_id_approve(user_id: int):
     return user
 
 
+def make_user_superuser(user_id: int):
+    db = TestingSessionLocal()
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise ValueError("User not found.")
+    user.is_superuser = True
+    db.commit()
+    return user
+
+
 def delete_user(response_json):
     db = TestingSessionLocal()
     user_id = response_json.json().get("id")
@@ -97,10 +143,9 @@ def delete_user(response_json):
 
 
 def create_user(data):
-    with patch("shop.routers.signup.BackgroundTasks.add_task"):
-        response = client.post("/signup/", json=data)
-        if response.status_code != 200:
-            print(response.json())
+    response = client.post("/signup/", json=data)
+    if response.status_code != 200:
+        print(response.json())
     return response
 
 
@@ -162,3 +207,31 @@ def order_data():
         "city": "string",
         "pin_code": "string",
     }
+
+
+@pytest.fixture
+def catalog_db(fake):
+    # an approved shop with 5 public items in 2 categories, created through the ORM
+    db = TestingSessionLocal()
+    shop = Shop(shop_name=fake.uuid4(), slug=fake.uuid4(), is_approved=True)
+    category = Category(shop=shop, name="catalog-category", slug=fake.uuid4())
+    other = Category(shop=shop, name="catalog-other", slug=fake.uuid4())
+    items = [
+        Item(
+            shop=shop,
+            category=category if i % 2 else other,
+            name=f"catalog-{i}",
+            slug=fake.uuid4(),
+            price=i,
+            image="/catalog.jpg",
+            title="catalog-title",
+            description="catalog-description",
+        )
+        for i in range(5)
+    ]
+    db.add_all(items)
+    db.commit()
+    yield db, shop, items
+    db.delete(shop)
+    db.commit()
+    db.close()
@@ -1,5 +1,4 @@
 import itertools
-from unittest.mock import patch
 
 import factory
 from faker import Faker
@@ -54,8 +53,7 @@ def delete_user_id(user_id):
 
 
 def create_user(data):
-    with patch("shop.routers.signup.BackgroundTasks.add_task"):
-        response = client.post("/signup/", json=data)
+    response = client.post("/signup/", json=data)
     return response
 
 
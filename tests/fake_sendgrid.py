@@ -0,0 +1,60 @@
+"""
+Local sink for the SendGrid mail send API used by the email worker tests.
+
+Tests talk to it in-process through `client()`. To catch the mail of a running API, run it as a server:
+    python -m tests.fake_sendgrid --port 12112
+    SENDGRID_API_BASE=http://127.0.0.1:12112 python -m shop.email_worker
+"""
+
+import argparse
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+app = FastAPI()
+# every message accepted, the recipients answered with a 500 / 400, and the status of every request (e.g. 401)
+app.state.messages = []
+app.state.failing_recipients = set()
+app.state.rejected_recipients = set()
+app.state.status_code = None
+
+
+@app.post("/v3/mail/send")
+async def send_mail(request: Request):
+    if app.state.status_code:
+        return JSONResponse({"errors": [{"message": "Fake SendGrid error.", "field": None}]}, app.state.status_code)
+    message = await request.json()
+    recipients = {to["email"] for personalization in message["personalizations"] for to in personalization["to"]}
+    if recipients & app.state.failing_recipients:
+        return JSONResponse({"errors": [{"message": "Fake SendGrid failure."}]}, status_code=500)
+    errors = [
+        {"message": "Invalid recipient.", "field": f"personalizations.{n}.to.0.email"}
+        for n, personalization in enumerate(message["personalizations"])
+        if {to["email"] for to in personalization["to"]} & app.state.rejected_recipients
+    ]
+    if errors:
+        return JSONResponse({"errors": errors}, status_code=400)
+    app.state.messages.append(message)
+    return Response(status_code=202)
+
+
+def reset():
+    app.state.messages.clear()
+    app.state.failing_recipients.clear()
+    app.state.rejected_recipients.clear()
+    app.state.status_code = None
+
+
+def client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://fake-sendgrid")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the fake SendGrid API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12112)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,79 @@
+"""
+Minimal stand-in for the Stripe PaymentIntents API used by tests and checkout benchmarks.
+
+Tests talk to it in-process through `client()`. For benchmarks run it as a server and point the API at it:
+    python -m tests.fake_stripe --port 12111 --latency 0.5
+    STRIPE_API_BASE=http://127.0.0.1:12111 uvicorn shop.main:app
+"""
+
+import argparse
+import asyncio
+import uuid
+from urllib.parse import parse_qsl
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+# seconds every request takes and how many of the next requests fail with a 500
+app.state.latency = 0.0
+app.state.failures = 0
+# (idempotency key, form data) of every request received
+app.state.requests = []
+app.state.payment_intents = {}
+
+
+@app.post("/v1/payment_intents")
+async def create_payment_intent(request: Request):
+    data = dict(parse_qsl((await request.body()).decode()))
+    idempotency_key = request.headers.get("Idempotency-Key")
+    app.state.requests.append((idempotency_key, data))
+    if app.state.latency:
+        await asyncio.sleep(app.state.latency)
+    if app.state.failures:
+        app.state.failures -= 1
+        return JSONResponse({"error": {"type": "api_error", "message": "Fake Stripe failure."}}, status_code=500)
+
+    if idempotency_key in app.state.payment_intents:
+        return app.state.payment_intents[idempotency_key]
+    if int(data.get("amount", 0)) < 50:
+        error = {"type": "invalid_request_error", "message": "Amount must be at least $0.50 usd"}
+        return JSONResponse({"error": error}, status_code=400)
+
+    payment_intent_id = f"pi_{uuid.uuid4().hex[:24]}"
+    payment_intent = {
+        "id": payment_intent_id,
+        "object": "payment_intent",
+        "amount": int(data["amount"]),
+        "currency": data.get("currency"),
+        "metadata": {key[9:-1]: value for key, value in data.items() if key.startswith("metadata[")},
+        "client_secret": f"{payment_intent_id}_secret_{uuid.uuid4().hex[:24]}",
+        "status": "requires_payment_method",
+    }
+    if idempotency_key:
+        app.state.payment_intents[idempotency_key] = payment_intent
+    return payment_intent
+
+
+def reset():
+    app.state.latency = 0.0
+    app.state.failures = 0
+    app.state.requests.clear()
+    app.state.payment_intents.clear()
+
+
+def client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://fake-stripe")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the fake Stripe API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every request takes")
+    args = parser.parse_args()
+    app.state.latency = args.latency
+    uvicorn.run(app, host=args.host, port=args.port)
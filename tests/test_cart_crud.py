@@ -70,3 +70,77 @@ def test_cart_get_all_items():
     response_cart = client.get(f"/cart/", headers=get_headers(shop_id))
     assert response_cart.status_code == 200
     delete_user(new_shop)
+
+
+def test_cart_add_increments_single_line():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    item_slug = user_data_dict["item_slug"]
+    assert new_shop.status_code == 200
+    shop_id = new_shop.json()["id"]
+    response_1 = client.post(f"/add-to-the-cart/{item_slug}/", headers=get_headers(shop_id))
+    response_2 = client.post(f"/add-to-the-cart/{item_slug}/", headers=get_headers(shop_id))
+    assert response_2.status_code == 200
+    assert response_2.json()["quantity"] == response_1.json()["quantity"] + 1
+    assert response_2.json()["price"] == 10.0 * response_2.json()["quantity"]
+
+    response_cart = client.get("/cart/", headers=get_headers(shop_id))
+    cart_items = [
+        cart_item
+        for cart_item in response_cart.json()["cart_items"]
+        if cart_item["item_id"] == response_2.json()["item_id"]
+    ]
+    assert len(cart_items) == 1
+    assert cart_items[0]["quantity"] == response_2.json()["quantity"]
+    delete_user(new_shop)
+
+
+def test_cart_sync_success(fake):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    item_slug = user_data_dict["item_slug"]
+    assert new_shop.status_code == 200
+    shop_id = new_shop.json()["id"]
+    item_data = {
+        "name": fake.name(),
+        "image": "/image.jpg",
+        "title": "title",
+        "description": "description",
+        "price": 5.0,
+        "category_id": user_data_dict["category_id"],
+    }
+    response_item = client.post("/item/", headers=get_headers(shop_id), json=item_data)
+    assert response_item.status_code == 200
+
+    data = [{"item_slug": item_slug, "quantity": 3}, {"item_slug": response_item.json()["slug"], "quantity": 2}]
+    response = client.put("/cart/", headers=get_headers(shop_id), json=data)
+    assert response.status_code == 200
+    assert response.json()["total_amount"] == 40.0
+    assert {(cart_item["item_id"], cart_item["quantity"]) for cart_item in response.json()["cart_items"]} == {
+        (user_data_dict["item_id"], 3),
+        (response_item.json()["id"], 2),
+    }
+
+    data = [{"item_slug": item_slug, "quantity": 0}]
+    response = client.put("/cart/", headers=get_headers(shop_id), json=data)
+    assert response.status_code == 200
+    assert response.json()["total_amount"] == 10.0
+    assert [cart_item["item_id"] for cart_item in response.json()["cart_items"]] == [response_item.json()["id"]]
+    delete_user(new_shop)
+
+
+def test_cart_sync_item_not_found(fake):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    item_slug = user_data_dict["item_slug"]
+    assert new_shop.status_code == 200
+    shop_id = new_shop.json()["id"]
+    missing_slug = fake.slug()
+    data = [{"item_slug": item_slug, "quantity": 2}, {"item_slug": missing_slug, "quantity": 1}]
+    response = client.put("/cart/", headers=get_headers(shop_id), json=data)
+    assert response.status_code == 404
+    assert response.json() == {"detail": f"Items not found: {missing_slug}."}
+
+    response_cart = client.get("/cart/", headers=get_headers(shop_id))
+    assert response_cart.json()["cart_items"][0]["quantity"] == 1
+    delete_user(new_shop)
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+from conftest import client, delete_user, get_headers, make_user_superuser
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+
+from shop.database import TimedQueuePool, pool_stats
+from tests.factories import ShopFactory
+
+
+def test_pool_stats_count_checkouts_and_timeouts():
+    engine = create_engine(
+        "sqlite:///./test.db", poolclass=TimedQueuePool, pool_size=1, max_overflow=1, pool_timeout=0.05
+    )
+    first = engine.connect()
+    second = engine.connect()
+    with pytest.raises(TimeoutError):
+        engine.connect()
+    stats = pool_stats(engine)
+    assert stats["in_use"] == 2
+    assert stats["overflow"] == 1
+    assert stats["checkouts"] == 3
+    assert stats["timeouts"] == 1
+    assert stats["wait_max_ms"] >= 50
+    first.close()
+    second.close()
+    stats = pool_stats(engine)
+    assert stats["in_use"] == 0
+    # the longest wait is reported once, the next scrape starts over
+    assert stats["wait_max_ms"] == 0
+    assert stats["checkouts"] == 3
+    engine.dispose()
+
+
+def test_pool_stats_count_concurrent_checkouts():
+    engine = create_engine("sqlite:///./test.db", poolclass=TimedQueuePool, pool_size=4, max_overflow=0)
+
+    def checkouts():
+        for _ in range(200):
+            engine.connect().close()
+
+    threads = [threading.Thread(target=checkouts) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool_stats(engine)["checkouts"] == 1600
+    engine.dispose()
+
+
+def test_metrics_report_database_pool():
+    new_user = ShopFactory.create(role="CUSTOMER")["new_user"]
+    user_id = new_user.json()["id"]
+    make_user_superuser(user_id)
+    response = client.get("/superuser/metrics/", headers=get_headers(user_id))
+    assert response.status_code == 200
+    database_pool = response.json()["database_pool"]
+    assert database_pool["pool"] == "TimedQueuePool"
+    assert database_pool["checkouts"] > 0
+    delete_user(new_user)
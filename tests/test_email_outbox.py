@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from conftest import client, create_order, create_user, delete_user, get_headers
+
+from shop import email_worker
+from shop.database import TestingSessionLocal
+from shop.models import EmailOutbox
+from shop.smtp_emails import queue_email
+from tests import fake_sendgrid
+from tests.factories import ShopFactory
+
+
+def get_queued_emails(to_email: str):
+    db = TestingSessionLocal()
+    emails = db.query(EmailOutbox).filter(EmailOutbox.to_email == to_email).order_by(EmailOutbox.id).all()
+    db.close()
+    return emails
+
+
+def delete_queued_emails(to_emails: list[str]):
+    db = TestingSessionLocal()
+    db.query(EmailOutbox).filter(EmailOutbox.to_email.in_(to_emails)).delete()
+    db.commit()
+    db.close()
+
+
+def drain_outbox():
+    db = TestingSessionLocal()
+    try:
+        return asyncio.run(email_worker.drain(fake_sendgrid.client(), db))
+    finally:
+        db.close()
+
+
+def test_signup_queues_activation_email(random_user_data):
+    new_user = create_user(random_user_data)
+    assert new_user.status_code == 200
+    emails = get_queued_emails(random_user_data["email"])
+    assert [email.subject for email in emails] == ["Welcome to our shop!"]
+    assert "/verification/?token=" in emails[0].html_content
+    delete_queued_emails([random_user_data["email"]])
+    delete_user(new_user)
+
+
+def test_create_order_queues_confirmation_email(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    response = create_order(order_data, new_shop.json()["id"])
+    assert response.status_code == 200
+    emails = get_queued_emails(new_shop.json()["email"])
+    assert emails[-1].subject == "Your order has been placed"
+    assert f"/orders/{response.json()['id']}/" in emails[-1].html_content
+    delete_queued_emails([new_shop.json()["email"]])
+    delete_user(new_shop)
+
+
+def test_worker_sends_and_retries_with_backoff(fake):
+    to_emails = [fake.uuid4() + fake.email() for _ in range(3)]
+    db = TestingSessionLocal()
+    for to_email in to_emails:
+        queue_email(db, to_email, "subject", "<p>content</p>")
+    db.commit()
+    db.close()
+    fake_sendgrid.reset()
+    fake_sendgrid.app.state.failing_recipients.add(to_emails[1])
+    fake_sendgrid.app.state.rejected_recipients.add(to_emails[2])
+
+    drain_outbox()
+    delivered = [message["personalizations"][0]["to"][0]["email"] for message in fake_sendgrid.app.state.messages]
+    assert to_emails[0] in delivered
+    sent, failed, rejected = (get_queued_emails(to_email)[0] for to_email in to_emails)
+    assert sent.sent_at is not None and sent.next_attempt_at is None
+    assert failed.sent_at is None and failed.attempts == 1
+    assert failed.next_attempt_at.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc) + timedelta(seconds=10)
+    assert rejected.sent_at is None and rejected.attempts == 1 and rejected.next_attempt_at is None
+
+    # the retry is due and the provider is back
+    fake_sendgrid.app.state.failing_recipients.clear()
+    db = TestingSessionLocal()
+    db.query(EmailOutbox).filter(EmailOutbox.id == failed.id).update(
+        {"next_attempt_at": datetime.now(timezone.utc) - timedelta(seconds=1)}
+    )
+    db.commit()
+    db.close()
+    drain_outbox()
+    failed = get_queued_emails(to_emails[1])[0]
+    assert failed.sent_at is not None and failed.attempts == 1
+    delete_queued_emails(to_emails)
+
+
+def test_worker_waits_while_the_provider_refuses_the_api_key(fake):
+    to_emails = [fake.uuid4() + fake.email() for _ in range(2)]
+    db = TestingSessionLocal()
+    for to_email in to_emails:
+        queue_email(db, to_email, "subject", "<p>content</p>")
+    db.commit()
+    db.close()
+    fake_sendgrid.reset()
+    fake_sendgrid.app.state.status_code = 401
+
+    # the emails are kept without using up their attempts, and the worker stops after the batch
+    with patch.object(email_worker, "claim_emails", wraps=email_worker.claim_emails) as claim_emails:
+        drain_outbox()
+    assert claim_emails.call_count == 1
+    for to_email in to_emails:
+        email = get_queued_emails(to_email)[0]
+        assert email.sent_at is None and email.attempts == 0
+        assert email.next_attempt_at is not None and email.last_error.startswith("401")
+
+    # the key is fixed
+    fake_sendgrid.reset()
+    db = TestingSessionLocal()
+    db.query(EmailOutbox).filter(EmailOutbox.to_email.in_(to_emails)).update(
+        {"next_attempt_at": datetime.now(timezone.utc) - timedelta(seconds=1)}
+    )
+    db.commit()
+    db.close()
+    drain_outbox()
+    assert all(get_queued_emails(to_email)[0].sent_at is not None for to_email in to_emails)
+    delete_queued_emails(to_emails)
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from shop.email_templates import Template, TemplateRegistry, registry
+
+
+def test_template_static_placeholders_compiled_in():
+    template = Template("test.html", "<a href='http://{{host}}/{{ path }}'>{{name}}</a>", {"host": "shop.test"})
+    assert [static for static, key, convert in template.parts] == ["<a href='http://shop.test/", "'>"]
+    assert template.placeholders == {"path", "name"}
+    assert template.render({"path": "orders/1/", "name": "Bob"}) == "<a href='http://shop.test/orders/1/'>Bob</a>"
+
+
+def test_template_escaping():
+    template = Template("test.html", "<b>{{name}}</b>{{lines|raw}}", {})
+    assert template.render({"name": "<Tom & Jerry>", "lines": "<tr></tr>"}) == "<b>&lt;Tom &amp; Jerry&gt;</b><tr></tr>"
+    assert Template("test.subject.txt", "{{name}}", {}).render({"name": "Tom & Jerry"}) == "Tom & Jerry"
+
+
+def test_template_missing_value():
+    with pytest.raises(KeyError, match="Template test.html needs a value for name."):
+        Template("test.html", "{{name}}", {}).render({})
+
+
+def test_registry_loads_every_template():
+    directory_registry = TemplateRegistry()
+    directory_registry.load()
+    assert set(directory_registry.templates) == set(os.listdir(registry.directory))
+
+
+def test_order_confirmation_renders_lines():
+    lines = registry.render("order_line.html", name="Socks <3", quantity=2, price=10.0)
+    html_content = registry.render("order_confirmation.html", total_paid=20.0, order_id=7, lines=lines)
+    assert "<tr><td>Socks &lt;3</td><td>2</td><td>10.0$</td></tr>" in html_content
+    assert "/orders/7/" in html_content
@@ -0,0 +1,71 @@
+from shop import constants, database
+from tests.conftest import capture_statements, client
+
+
+def test_item_not_modified(catalog_db):
+    db, shop, items = catalog_db
+    item_slug = items[0].slug
+    response = client.get(f"/item/{item_slug}/")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"].startswith("public")
+    etag, last_modified = response.headers["ETag"], response.headers["Last-Modified"]
+    assert etag.startswith('W/"')
+
+    assert client.get(f"/item/{item_slug}/", headers={"If-None-Match": etag}).status_code == 304
+    response = client.get(f"/item/{item_slug}/", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    items[0].price = 99
+    db.commit()
+    response = client.get(f"/item/{item_slug}/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["price"] == 99
+    assert response.headers["ETag"] != etag
+
+
+def test_items_and_reviews_not_modified_without_serializing(catalog_db, fake):
+    db, shop, items = catalog_db
+    item_slug, shop_slug = items[0].slug, shop.slug
+    listing = client.get(f"/items/?shop={shop_slug}&limit=2")
+    assert listing.headers["X-Next-Cursor"]
+    reviews = client.get(f"/item/{item_slug}/reviews/")
+    shop_response = client.get(f"/shop/{shop_slug}")
+    with capture_statements() as statements:
+        response = client.get(f"/items/?shop={shop_slug}&limit=2", headers={"If-None-Match": listing.headers["ETag"]})
+        assert response.status_code == 304
+        assert response.headers["X-Next-Cursor"] == listing.headers["X-Next-Cursor"]
+        assert statements == []
+
+        response = client.get(f"/item/{item_slug}/reviews/", headers={"If-None-Match": reviews.headers["ETag"]})
+        assert response.status_code == 304
+        # only the ids of the reviews were read
+        assert len(statements) == 1
+
+        response = client.get(f"/shop/{shop_slug}", headers={"If-None-Match": shop_response.headers["ETag"]})
+        assert response.status_code == 304
+
+    items[1].is_available = False
+    db.commit()
+    response = client.get(f"/items/?shop={shop_slug}&limit=2", headers={"If-None-Match": listing.headers["ETag"]})
+    assert response.status_code == 200
+
+
+def test_other_get_responses_get_a_body_etag():
+    response = client.get("/users/")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    response = client.get("/users/", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+def test_writes_mark_the_client_without_replicas(fake):
+    # nginx serves the writer from the app, not from its cache, while the last_write cookie is set
+    assert database.replicas.engines == []
+    response = client.post("/newsletter/signup/", json={"email": fake.email()})
+    assert response.status_code == 200
+    assert "last_write" in response.cookies
+    max_age = int(response.headers["set-cookie"].split("Max-Age=")[1].split(";")[0])
+    assert max_age >= constants.HTTP_CACHE_SHARED_MAX_AGE
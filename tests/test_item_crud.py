@@ -1,10 +1,23 @@
+import json
+import sqlite3
+from unittest.mock import patch
+
+from sqlalchemy import Insert
+from sqlalchemy.exc import IntegrityError
+
+from shop import utils
+from shop.database import TestingSessionLocal
+from shop.models import Item, Shop
+from shop.utils import rebuild_item_ratings
 from tests.conftest import (
     client,
+    create_order,
     delete_user,
     get_amount_of_all_items,
     get_amount_of_items_per_shop,
     get_headers,
     get_shop_by_user_id,
+    make_user_superuser,
 )
 from tests.factories import ShopFactory
 
@@ -377,3 +390,236 @@ def test_get_items_by_shop_not_exists_category_exists():
     assert response.status_code == 200
     assert len(response.json()) == get_amount_of_all_items()
     delete_user(new_shop)
+
+
+def test_get_items_paginated_by_cursor(random_item_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    shop = get_shop_by_user_id(user_id)
+    random_item_data["category_id"] = user_data_dict["category_id"]
+    response_item = client.post("/item/", headers=get_headers(user_id), json=random_item_data)
+    assert response_item.status_code == 200
+
+    response_1 = client.get(f"/items/?shop={shop.slug}&limit=1")
+    assert response_1.status_code == 200
+    assert len(response_1.json()) == 1
+    assert response_1.json()[0]["slug"] == user_data_dict["item_slug"]
+    next_cursor = response_1.headers["X-Next-Cursor"]
+
+    response_2 = client.get(f"/items/?shop={shop.slug}&limit=1&after={next_cursor}")
+    assert response_2.status_code == 200
+    assert len(response_2.json()) == 1
+    assert response_2.json()[0]["slug"] == response_item.json()["slug"]
+    assert "X-Next-Cursor" not in response_2.headers
+    delete_user(new_shop)
+
+
+def test_item_review_updates_rating_counters(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    item_slug = user_data_dict["item_slug"]
+    response_order = create_order(order_data, user_id)
+    assert response_order.status_code == 200
+
+    response_1 = client.post(
+        f"/item/{item_slug}/reviews/", headers=get_headers(user_id), json={"stars": 5, "comment": "great"}
+    )
+    assert response_1.status_code == 200
+    response_2 = client.post(
+        f"/item/{item_slug}/reviews/", headers=get_headers(user_id), json={"stars": 2, "comment": "meh"}
+    )
+    assert response_2.status_code == 200
+    response_item = client.get(f"/item/{item_slug}/")
+    assert response_item.json()["average_rating"] == 3.5
+    assert response_item.json()["rating_histogram"] == {"1": 0, "2": 1, "3": 0, "4": 0, "5": 1}
+
+    response_page_1 = client.get(f"/item/{item_slug}/reviews/?limit=1")
+    assert [review["id"] for review in response_page_1.json()] == [response_1.json()["id"]]
+    next_cursor = response_page_1.headers["X-Next-Cursor"]
+    response_page_2 = client.get(f"/item/{item_slug}/reviews/?limit=1&after={next_cursor}")
+    assert [review["id"] for review in response_page_2.json()] == [response_2.json()["id"]]
+    assert "X-Next-Cursor" not in response_page_2.headers
+
+    make_user_superuser(user_id)
+    response_delete = client.delete(f"/superuser/item-review/{response_2.json()['id']}/", headers=get_headers(user_id))
+    assert response_delete.status_code == 200
+    assert client.get(f"/item/{item_slug}/").json()["average_rating"] == 5.0
+
+    db = TestingSessionLocal()
+    rebuild_item_ratings(db)
+    db.commit()
+    item = db.query(Item).filter(Item.slug == item_slug).first()
+    assert (item.review_count, item.rating_sum, item.average_rating) == (1, 5, 5.0)
+    assert item.rating_histogram == {1: 0, 2: 0, 3: 0, 4: 0, 5: 1}
+    db.close()
+    delete_user(new_shop)
+
+
+def test_create_item_slug_suffix_does_not_compound(random_item_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    random_item_data["category_id"] = user_data_dict["category_id"]
+    slugs = []
+    for name in ["slug item", "slug-item", "slug_item"]:
+        random_item_data["name"] = name
+        response = client.post("/item/", headers=get_headers(user_id), json=random_item_data)
+        assert response.status_code == 200
+        slugs.append(response.json()["slug"])
+    assert slugs[1] == f"{slugs[0]}-1"
+    assert slugs[2] == f"{slugs[0]}-2"
+    delete_user(new_shop)
+
+
+def test_create_item_retries_on_concurrent_slug(random_item_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    random_item_data["category_id"] = user_data_dict["category_id"]
+    taken_slug = user_data_dict["item_slug"]
+    generate_unique_item_slug = utils.generate_unique_item_slug
+    # the first generated slug is taken by "another request" before the insert
+    slugs = iter([taken_slug])
+
+    def generate_slug(*args):
+        return next(slugs, None) or generate_unique_item_slug(*args)
+
+    with patch("shop.utils.generate_unique_item_slug", side_effect=generate_slug):
+        response = client.post("/item/", headers=get_headers(user_id), json=random_item_data)
+    assert response.status_code == 200
+    assert response.json()["slug"] not in (taken_slug, None)
+    delete_user(new_shop)
+
+
+def test_update_item_name_retries_on_concurrent_slug(random_item_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    random_item_data["category_id"] = user_data_dict["category_id"]
+    item_slug = client.post("/item/", headers=get_headers(user_id), json=random_item_data).json()["slug"]
+    taken_slug = user_data_dict["item_slug"]
+    generate_unique_item_slug = utils.generate_unique_item_slug
+    # the first generated slug is taken by "another request" before the update
+    slugs = iter([taken_slug])
+
+    def generate_slug(*args):
+        return next(slugs, None) or generate_unique_item_slug(*args)
+
+    data = {"name": "renamed concurrently", "price": 77}
+    with patch("shop.utils.generate_unique_item_slug", side_effect=generate_slug):
+        response = client.patch(f"/item/{item_slug}", headers=get_headers(user_id), json=data)
+    assert response.status_code == 200
+    assert response.json()["slug"] not in (taken_slug, item_slug)
+    # the other changes survive the rollback of the first attempt
+    assert response.json()["name"] == "renamed concurrently"
+    assert response.json()["price"] == 77
+    delete_user(new_shop)
+
+
+def test_create_items_bulk_csv():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    category_id = user_data_dict["category_id"]
+    body = (
+        "category_id,name,image,title,description,price\n"
+        f'{category_id},bulk-1,/1.jpg,title,"multi\nline description",10.5\n'
+        f"{category_id},bulk-2,/2.jpg,title,description,not-a-price\n"
+        f"{category_id},fixture-item,/3.jpg,title,description,3\n"
+        f"{category_id + 1000},bulk-4,/4.jpg,title,description,4\n"
+        f"{category_id},bulk-5,/5.jpg,title,description,5\n"
+    )
+    headers = dict(get_headers(user_id), **{"Content-Type": "text/csv"})
+    response = client.post("/item/bulk?batch_size=2", headers=headers, content=body)
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+    assert [error["row"] for error in response.json()["errors"]] == [2, 3, 4]
+    assert response.json()["errors"][1]["errors"][0]["msg"] == "You already have item with the name 'fixture-item'."
+    assert response.json()["errors"][2]["errors"][0]["msg"] == "Category not found."
+    assert get_amount_of_items_per_shop(get_shop_by_user_id(user_id).id) == 3
+    delete_user(new_shop)
+
+
+def test_create_items_bulk_ndjson():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    category_id = user_data_dict["category_id"]
+    row = {"category_id": category_id, "image": "/1.jpg", "title": "title", "description": "description", "price": 1}
+    body = "\n".join(
+        [json.dumps(dict(row, name="bulk item")), "{not json", json.dumps(dict(row, name="bulk-item", qwerty=1))]
+        + [json.dumps(dict(row, name="bulk-item"))]
+    )
+    headers = dict(get_headers(user_id), **{"Content-Type": "application/x-ndjson"})
+    response = client.post("/item/bulk", headers=headers, content=body)
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+    assert [error["row"] for error in response.json()["errors"]] == [2, 3]
+    assert response.json()["errors"][0]["errors"][0]["msg"] == "Invalid JSON."
+    response_items = client.get(f"/items/?shop={get_shop_by_user_id(user_id).slug}")
+    slugs = sorted(item["slug"] for item in response_items.json() if item["name"].startswith("bulk"))
+    assert slugs[1] == f"{slugs[0]}-1"
+    delete_user(new_shop)
+
+
+def test_create_items_bulk_default_batch_size():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    row = {"category_id": user_data_dict["category_id"], "image": "/1.jpg", "title": "title", "description": "d"}
+    body = "\n".join(json.dumps(dict(row, name=f"batch-item-{n}", price=n)) for n in range(1000))
+    headers = dict(get_headers(user_id), **{"Content-Type": "application/x-ndjson"})
+    response = client.post("/item/bulk", headers=headers, content=body)
+    assert response.status_code == 200
+    assert response.json() == {"created": 1000, "errors": []}
+    delete_user(new_shop)
+
+
+def test_create_items_bulk_unsupported_media_type():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    response = client.post("/item/bulk", headers=get_headers(user_id), content="<xml/>")
+    assert response.status_code == 415
+    delete_user(new_shop)
+
+
+def test_create_items_bulk_reports_integrity_errors_as_row_errors():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    category_id = user_data_dict["category_id"]
+    deleted_category_id = category_id + 1000
+    row = {"image": "/1.jpg", "title": "title", "description": "description", "price": 1}
+    rows = [
+        (1, dict(row, category_id=category_id, name="bulk-1")),
+        (2, dict(row, category_id=deleted_category_id, name="bulk-2")),
+        (3, dict(row, category_id=category_id, name="bulk-3")),
+    ]
+    db = TestingSessionLocal()
+    shop = db.get(Shop, get_shop_by_user_id(new_shop.json()["id"]).id)
+    execute = db.execute
+    failures = []
+
+    def fail_inserts(statement, *args, **kwargs):
+        if isinstance(statement, Insert) and failures:
+            raise IntegrityError(str(statement), {}, sqlite3.IntegrityError(failures.pop(0)))
+        return execute(statement, *args, **kwargs)
+
+    with patch.object(db, "execute", side_effect=fail_inserts):
+        # the category of the second row was deleted during the import, the other rows are inserted
+        failures.append("FOREIGN KEY constraint failed")
+        created, errors = utils.create_items_bulk(db, shop, {category_id, deleted_category_id}, rows)
+        assert created == 2
+        assert errors == [{"row": 2, "errors": [{"loc": ["category_id"], "msg": "Category not found."}]}]
+
+        # anything else fails every row of the batch, without a retry
+        failures.append("CHECK constraint failed: price")
+        rows = [(4, dict(row, category_id=category_id, name="bulk-4"))]
+        created, errors = utils.create_items_bulk(db, shop, {category_id}, rows)
+        assert created == 0
+        assert errors == [{"row": 4, "errors": [{"loc": [], "msg": "The item could not be created."}]}]
+    assert get_amount_of_items_per_shop(shop.id) == 3
+    db.close()
+    delete_user(new_shop)
@@ -1,9 +1,24 @@
+import threading
 from datetime import datetime, timedelta
-
-from conftest import client, create_user, delete_user, get_user_by_id_and_assign_inactive
+from unittest.mock import patch
+
+from conftest import (
+    capture_statements,
+    client,
+    create_user,
+    delete_user,
+    ger_user_by_id_approve,
+    get_headers,
+    get_user_by_id_and_assign_inactive,
+    make_user_superuser,
+)
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 from jose import jwt
 
 from shop import constants
+from shop.keyring import Keyring
+from shop.passwords import PasswordHasher
 from tests.factories import ShopFactory
 
 
@@ -201,3 +216,86 @@ def test_reset_password_expired_token():
     assert response.status_code == 401
     assert response.json() == {"detail": "Token has expired."}
     delete_user(new_user)
+
+
+def test_tokens_verified_across_key_rotation():
+    user_data_dict = ShopFactory.create(role="CUSTOMER")
+    new_user = user_data_dict["new_user"]
+    user_id = new_user.json()["id"]
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    public_pem = (
+        private_key.public_key()
+        .public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        .decode()
+    )
+    old_key = {"kid": "old", "alg": "HS256", "secret": "old-secret"}
+    new_key = {"kid": "new", "alg": "RS256", "private_key": private_pem, "public_key": public_pem}
+
+    with patch("shop.keyring._keyring", Keyring.from_config({"active": "old", "keys": [old_key]})):
+        old_headers = get_headers(user_id)
+    assert jwt.get_unverified_header(old_headers["Authorization"][7:])["kid"] == "old"
+
+    # the new key signs, tokens of the old key are still accepted
+    with patch("shop.keyring._keyring", Keyring.from_config({"active": "new", "keys": [new_key, old_key]})):
+        new_headers = get_headers(user_id)
+        assert jwt.get_unverified_header(new_headers["Authorization"][7:]) == {
+            "alg": "RS256",
+            "kid": "new",
+            "typ": "JWT",
+        }
+        assert client.get("/user/me", headers=new_headers).status_code == 200
+        assert client.get("/user/me", headers=old_headers).status_code == 200
+
+    # the old key is removed
+    with patch("shop.keyring._keyring", Keyring.from_config({"active": "new", "keys": [new_key]})):
+        assert client.get("/user/me", headers=new_headers).status_code == 200
+        response = client.get("/user/me", headers=old_headers)
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Could not validate credentials"}
+    delete_user(new_user)
+
+
+def test_login_rejected_when_password_hashing_saturated(random_user_data):
+    new_user = create_user(random_user_data)
+    ger_user_by_id_approve(new_user.json()["id"])
+    make_user_superuser(new_user.json()["id"])
+    data = {"username": random_user_data["email"], "password": random_user_data["password"]}
+    password_hasher = PasswordHasher(workers=1, queue_size=1)
+    release = threading.Event()
+    with patch("shop.passwords.password_hasher", password_hasher):
+        # the worker is busy and one job waits in the queue, the next login is refused
+        busy = [password_hasher._submit(release.wait) for _ in range(2)]
+        try:
+            response = client.post("/login", data=data)
+            response_metrics = client.get("/superuser/metrics/", headers=get_headers(new_user.json()["id"]))
+        finally:
+            release.set()
+        for future in busy:
+            future.result()
+        response_after = client.post("/login", data=data)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert response_metrics.json()["password_hashing"] == {
+        "workers": 1,
+        "in_flight": 2,
+        "queue_depth": 1,
+        "queue_size": 1,
+        "rejected": 1,
+    }
+    assert response_after.status_code == 200
+    delete_user(new_user)
+
+
+def test_signup_and_login_use_async_session(random_user_data):
+    with capture_statements() as statements:
+        new_user = create_user(random_user_data)
+        data = {"username": random_user_data["email"], "password": random_user_data["password"]}
+        response = client.post("/login", data=data)
+    assert new_user.status_code == 200
+    assert response.status_code == 200
+    # nothing ran on the sync engine, so nothing blocked the event loop
+    assert statements == []
+    delete_user(new_user)
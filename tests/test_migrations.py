@@ -0,0 +1,68 @@
+from pathlib import Path
+
+from sqlalchemy import create_engine, inspect, select
+
+from shop import models
+from shop.migrations import MIGRATIONS, _steps, schema_version, upgrade
+
+BASELINE_SCHEMA = Path(__file__).parent / "baseline_schema.sql"
+
+
+def test_postgres_index_statements_run_concurrently_on_their_own():
+    statements = [
+        "UPDATE cart SET quantity = 1",
+        "DELETE FROM cart WHERE quantity = 0",
+        "DROP INDEX IF EXISTS ix_cart_user_id_item_id",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_user_id_item_id ON cart (user_id, item_id)",
+        ("postgresql", "CREATE INDEX IF NOT EXISTS ix_item_slug_pattern ON item (slug text_pattern_ops)"),
+    ]
+    assert _steps(statements, "postgresql") == [
+        (False, ["UPDATE cart SET quantity = 1", "DELETE FROM cart WHERE quantity = 0"]),
+        (True, "DROP INDEX IF EXISTS ix_cart_user_id_item_id"),
+        (True, "CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_user_id_item_id ON cart (user_id, item_id)"),
+        (True, "CREATE INDEX IF NOT EXISTS ix_item_slug_pattern ON item (slug text_pattern_ops)"),
+    ]
+    # other databases run the whole migration in one transaction
+    assert _steps(statements, "sqlite") == [(False, statements[:4])]
+
+
+def test_upgrade_twice_applies_every_migration_once(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    upgrade(engine)
+    upgrade(engine)
+    with engine.connect() as connection:
+        versions = list(connection.scalars(select(schema_version.c.version).order_by(schema_version.c.version)))
+    assert versions == [version for version, _, _ in MIGRATIONS]
+    engine.dispose()
+
+
+def test_unique_order_key_migration_renames_duplicates(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    upgrade(engine)
+    # a database from before migration 7, with an order placed twice
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX uq_order_order_key")
+        connection.exec_driver_sql("INSERT INTO \"order\" (id, order_key) VALUES (1, 'pi_1'), (2, 'pi_1'), (3, 'pi_3')")
+        connection.execute(schema_version.delete().where(schema_version.c.version == 7))
+    upgrade(engine)
+    with engine.connect() as connection:
+        keys = list(connection.exec_driver_sql('SELECT order_key FROM "order" ORDER BY id').scalars())
+    assert keys == ["pi_1", "pi_1-duplicate-2", "pi_3"]
+    engine.dispose()
+
+
+def test_upgrade_database_from_before_the_migrations(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    with engine.connect() as connection:
+        connection.connection.executescript(BASELINE_SCHEMA.read_text())
+    upgrade(engine)
+    with engine.connect() as connection:
+        versions = list(connection.scalars(select(schema_version.c.version).order_by(schema_version.c.version)))
+    assert versions == [version for version, _, _ in MIGRATIONS]
+    # every table and column of the models exists
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        assert {column.name for column in table.columns} <= {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+    engine.dispose()
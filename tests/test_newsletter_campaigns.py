@@ -0,0 +1,206 @@
+import asyncio
+from unittest.mock import patch
+
+from conftest import client, delete_user, get_headers, make_user_superuser
+
+from shop import campaigns
+from shop.database import TestingSessionLocal
+from shop.models import NewsLetter, NewsletterCampaign
+from shop.schemas import CampaignStatusEnum
+from tests import fake_sendgrid
+from tests.factories import ShopFactory
+
+
+def create_superuser():
+    new_user = ShopFactory.create(role="CUSTOMER")["new_user"]
+    make_user_superuser(new_user.json()["id"])
+    return new_user
+
+
+def create_subscribers(fake, amount: int) -> list[str]:
+    emails = [fake.uuid4() + fake.email() for _ in range(amount)]
+    db = TestingSessionLocal()
+    db.add_all([NewsLetter(email=email, is_active=True) for email in emails])
+    db.commit()
+    db.close()
+    return emails
+
+
+def delete_campaign_and_subscribers(campaign_id: int, emails: list[str]):
+    db = TestingSessionLocal()
+    db.query(NewsletterCampaign).filter(NewsletterCampaign.id == campaign_id).delete()
+    db.query(NewsLetter).filter(NewsLetter.email.in_(emails)).delete()
+    db.commit()
+    db.close()
+
+
+def send_due_campaigns(chunk_size: int):
+    db = TestingSessionLocal()
+    try:
+        return asyncio.run(campaigns.send_due_campaigns(fake_sendgrid.client(), db, chunk_size=chunk_size))
+    finally:
+        db.close()
+
+
+def get_recipients() -> list[str]:
+    return [
+        personalization["to"][0]["email"]
+        for message in fake_sendgrid.app.state.messages
+        for personalization in message["personalizations"]
+    ]
+
+
+def test_newsletter_campaign_create_and_schedule():
+    new_user = create_superuser()
+    headers = get_headers(new_user.json()["id"])
+    data = {"subject": "News", "html_content": "<p>Hello {{email}}</p>"}
+    response = client.post("/superuser/newsletter-campaigns/", headers=headers, json=data)
+    assert response.status_code == 200
+    assert response.json()["status"] == "draft"
+    campaign_id = response.json()["id"]
+
+    response_send = client.post(f"/superuser/newsletter-campaigns/{campaign_id}/send/", headers=headers)
+    assert response_send.status_code == 200
+    assert response_send.json()["status"] == "scheduled"
+    assert response_send.json()["scheduled_at"] is not None
+
+    db = TestingSessionLocal()
+    db.query(NewsletterCampaign).filter(NewsletterCampaign.id == campaign_id).update(
+        {"status": CampaignStatusEnum.SENT}
+    )
+    db.commit()
+    db.close()
+    response_schedule = client.post(
+        f"/superuser/newsletter-campaigns/{campaign_id}/schedule/", headers=headers, json={}
+    )
+    assert response_schedule.status_code == 409
+    assert response_schedule.json() == {"detail": "Campaign is already sent."}
+    delete_campaign_and_subscribers(campaign_id, [])
+    delete_user(new_user)
+
+
+def test_newsletter_campaign_not_superuser():
+    new_user = ShopFactory.create(role="CUSTOMER")["new_user"]
+    data = {"subject": "News", "html_content": "<p>Hello</p>"}
+    response = client.post("/superuser/newsletter-campaigns/", headers=get_headers(new_user.json()["id"]), json=data)
+    assert response.status_code == 403
+    delete_user(new_user)
+
+
+def test_newsletter_campaign_sent_in_chunks_and_resumed(fake):
+    new_user = create_superuser()
+    headers = get_headers(new_user.json()["id"])
+    emails = create_subscribers(fake, 5)
+    data = {"subject": "News", "html_content": "<p>Hello {{email}}, <a href='{{unsubscribe_url}}'>unsubscribe</a></p>"}
+    campaign_id = client.post("/superuser/newsletter-campaigns/", headers=headers, json=data).json()["id"]
+    client.post(f"/superuser/newsletter-campaigns/{campaign_id}/send/", headers=headers)
+
+    # the provider fails on the chunk with the fourth subscriber
+    fake_sendgrid.reset()
+    fake_sendgrid.app.state.failing_recipients.add(emails[3])
+    send_due_campaigns(chunk_size=2)
+    received = [email for email in get_recipients() if email in emails]
+    assert emails[0] in received and emails[3] not in received and emails[4] not in received
+    campaign = client.get(f"/superuser/newsletter-campaigns/{campaign_id}/", headers=headers).json()
+    assert campaign["status"] == "sending"
+
+    # resumed after the last accepted chunk once the retry delay is over
+    fake_sendgrid.app.state.failing_recipients.clear()
+    db = TestingSessionLocal()
+    db.query(NewsletterCampaign).filter(NewsletterCampaign.id == campaign_id).update({"locked_until": None})
+    db.commit()
+    db.close()
+    send_due_campaigns(chunk_size=2)
+    # every subscriber got the campaign exactly once
+    assert sorted(email for email in get_recipients() if email in emails) == sorted(emails)
+    campaign = client.get(f"/superuser/newsletter-campaigns/{campaign_id}/", headers=headers).json()
+    assert campaign["status"] == "sent"
+    assert campaign["finished_at"] is not None
+
+    personalization = next(
+        personalization
+        for message in fake_sendgrid.app.state.messages
+        for personalization in message["personalizations"]
+        if personalization["to"][0]["email"] == emails[0]
+    )
+    assert personalization["substitutions"]["{{email}}"] == emails[0]
+    assert "/newsletter/unsubscribe/?token=" in personalization["substitutions"]["{{unsubscribe_url}}"]
+    delete_campaign_and_subscribers(campaign_id, emails)
+    delete_user(new_user)
+
+
+def create_and_send_campaign(headers) -> int:
+    data = {"subject": "News", "html_content": "<p>Hello {{email}}</p>"}
+    campaign_id = client.post("/superuser/newsletter-campaigns/", headers=headers, json=data).json()["id"]
+    client.post(f"/superuser/newsletter-campaigns/{campaign_id}/send/", headers=headers)
+    return campaign_id
+
+
+def test_newsletter_campaign_skips_rejected_recipients(fake):
+    new_user = create_superuser()
+    headers = get_headers(new_user.json()["id"])
+    emails = create_subscribers(fake, 5)
+    campaign_id = create_and_send_campaign(headers)
+
+    # the provider refuses one address of a chunk, the others of the chunk are still sent to
+    fake_sendgrid.reset()
+    fake_sendgrid.app.state.rejected_recipients.add(emails[2])
+    send_due_campaigns(chunk_size=4)
+    assert sorted(email for email in get_recipients() if email in emails) == sorted(emails[:2] + emails[3:])
+    campaign = client.get(f"/superuser/newsletter-campaigns/{campaign_id}/", headers=headers).json()
+    assert campaign["status"] == "sent"
+    assert campaign["rejected_count"] == 1
+    assert emails[2] in campaign["last_error"] and "400" in campaign["last_error"]
+    delete_campaign_and_subscribers(campaign_id, emails)
+    delete_user(new_user)
+
+
+def test_newsletter_campaign_fails_after_max_attempts(fake):
+    new_user = create_superuser()
+    headers = get_headers(new_user.json()["id"])
+    emails = create_subscribers(fake, 2)
+    campaign_id = create_and_send_campaign(headers)
+
+    fake_sendgrid.reset()
+    fake_sendgrid.app.state.failing_recipients.add(emails[0])
+    with patch("shop.constants.EMAIL_MAX_ATTEMPTS", 2):
+        for _ in range(2):
+            db = TestingSessionLocal()
+            db.query(NewsletterCampaign).filter(NewsletterCampaign.id == campaign_id).update({"locked_until": None})
+            db.commit()
+            db.close()
+            send_due_campaigns(chunk_size=2)
+    campaign = client.get(f"/superuser/newsletter-campaigns/{campaign_id}/", headers=headers).json()
+    assert campaign["status"] == "failed"
+    assert campaign["attempts"] == 2
+    assert "500" in campaign["last_error"]
+
+    # scheduled again, it resumes from its checkpoint
+    fake_sendgrid.reset()
+    client.post(f"/superuser/newsletter-campaigns/{campaign_id}/send/", headers=headers)
+    send_due_campaigns(chunk_size=2)
+    campaign = client.get(f"/superuser/newsletter-campaigns/{campaign_id}/", headers=headers).json()
+    assert campaign["status"] == "sent"
+    assert sorted(email for email in get_recipients() if email in emails) == sorted(emails)
+    delete_campaign_and_subscribers(campaign_id, emails)
+    delete_user(new_user)
+
+
+def test_newsletter_campaign_retries_request_wide_errors(fake):
+    new_user = create_superuser()
+    headers = get_headers(new_user.json()["id"])
+    emails = create_subscribers(fake, 4)
+    campaign_id = create_and_send_campaign(headers)
+
+    # a revoked API key fails every recipient, the chunk is neither split nor skipped
+    fake_sendgrid.reset()
+    fake_sendgrid.app.state.status_code = 401
+    send_due_campaigns(chunk_size=4)
+    campaign = client.get(f"/superuser/newsletter-campaigns/{campaign_id}/", headers=headers).json()
+    assert campaign["status"] == "sending"
+    assert campaign["attempts"] == 1
+    assert campaign["rejected_count"] == 0
+    assert campaign["sent_count"] == 0
+    assert "401" in campaign["last_error"]
+    delete_campaign_and_subscribers(campaign_id, emails)
+    delete_user(new_user)
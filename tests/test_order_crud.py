@@ -1,5 +1,24 @@
-from conftest import client, create_order, delete_user, get_headers, get_shop_order_by_order_id
+import json
 
+import pytest
+from conftest import (
+    capture_statements,
+    client,
+    create_order,
+    delete_user,
+    get_headers,
+    get_shop_by_user_id,
+    get_shop_order_by_order_id,
+    post_stripe_event,
+)
+from fastapi import HTTPException
+
+from shop import utils
+from shop.database import TestingSessionLocal
+from shop.models import Order, OrderItem, ShopOrder, ShopRevenueDaily, StripeEvent
+from shop.routers import orders
+from shop.schemas import OrderBase
+from tests import fake_stripe
 from tests.factories import ShopFactory
 
 
@@ -14,6 +33,64 @@ def test_order_create_success(order_data):
     delete_user(new_shop)
 
 
+def test_order_create_many_lines(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    shop_id = new_shop.json()["id"]
+    row = {"category_id": user_data_dict["category_id"], "image": "/1.jpg", "title": "title", "description": "d"}
+    body = "\n".join(json.dumps(dict(row, name=f"order-item-{n}", price=n)) for n in range(1, 51))
+    headers = dict(get_headers(shop_id), **{"Content-Type": "application/x-ndjson"})
+    assert client.post("/item/bulk", headers=headers, content=body).json()["created"] == 50
+    response_items = client.get(f"/items/?shop={get_shop_by_user_id(shop_id).slug}&limit=500")
+    cart = [{"item_slug": item["slug"], "quantity": 2} for item in response_items.json()]
+    response_cart = client.put("/cart/", headers=get_headers(shop_id), json=cart)
+    assert response_cart.status_code == 200
+
+    with capture_statements() as statements:
+        response = create_order(order_data, shop_id)
+    assert response.status_code == 200
+    assert response.json()["total_paid"] == response_cart.json()["total_amount"]
+    # the number of statements does not grow with the number of cart lines
+    assert len(statements) < 15
+
+    db = TestingSessionLocal()
+    assert db.query(OrderItem).filter(OrderItem.order_id == response.json()["id"]).count() == 51
+    db.close()
+    assert client.get("/cart/", headers=get_headers(shop_id)).status_code == 409
+    delete_user(new_shop)
+
+
+def test_order_create_payment_retried_with_same_idempotency_key(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    shop_id = new_shop.json()["id"]
+    fake_stripe.reset()
+    fake_stripe.app.state.failures = 1
+    response = create_order(order_data, shop_id)
+    assert response.status_code == 200
+    assert len(fake_stripe.app.state.requests) == 2
+    (first_key, first_data), (second_key, second_data) = fake_stripe.app.state.requests
+    assert first_key == second_key
+    assert first_data == second_data == {"amount": "1000", "currency": "usd", "metadata[user_id]": str(shop_id)}
+    delete_user(new_shop)
+
+
+def test_order_create_payment_error(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    item_slug = user_data_dict["item_slug"]
+    shop_id = new_shop.json()["id"]
+    item_patch = client.patch(f"/item/{item_slug}/", headers=get_headers(shop_id), json={"price": 0.1})
+    assert item_patch.status_code == 200
+    client.put("/cart/", headers=get_headers(shop_id), json=[{"item_slug": item_slug, "quantity": 1}])
+    fake_stripe.reset()
+    response = create_order(order_data, shop_id)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Amount must be at least $0.50 usd"}
+    assert client.get("/cart/", headers=get_headers(shop_id)).status_code == 200
+    delete_user(new_shop)
+
+
 def test_order_create_empty_cart(order_data):
     user_data_dict = ShopFactory.create()
     new_shop = user_data_dict["new_shop"]
@@ -176,3 +253,80 @@ def test_order_patch_status_not_changed(order_data):
     assert response_patch.status_code == 422
     assert response_patch.json() == {"detail": "Model was not changed."}
     delete_user(new_shop)
+
+
+def payment_succeeded_event(event_id: str, order_key: str, user_id: int):
+    payment_intent = {"id": order_key, "object": "payment_intent", "metadata": {"user_id": str(user_id)}}
+    return {"id": event_id, "object": "event", "type": "payment_intent.succeeded", "data": {"object": payment_intent}}
+
+
+def test_stripe_webhook_bills_all_shop_orders_once(order_data, fake):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    shop_id = new_shop.json()["id"]
+    response = create_order(order_data, shop_id)
+    assert response.status_code == 200
+    order_id = response.json()["id"]
+
+    # an unpaid order of two shop orders
+    db = TestingSessionLocal()
+    order = db.query(Order).filter(Order.id == order_id).first()
+    shop_order = order.shop_orders[0]
+    db.add(ShopOrder(shop_id=shop_order.shop_id, order_id=order_id, user_id=order.user_id, total_paid=5.0))
+    db.flush()
+    order.billing_status = False
+    db.query(ShopOrder).filter(ShopOrder.order_id == order_id).update({"billing_status": False})
+    db.query(ShopRevenueDaily).filter(ShopRevenueDaily.shop_id == shop_order.shop_id).delete()
+    db.commit()
+
+    event_ids = [fake.uuid4(), fake.uuid4()]
+    for event_id in event_ids * 3:
+        response_webhook = post_stripe_event(payment_succeeded_event(event_id, order.order_key, shop_id))
+        assert response_webhook.status_code == 200
+        assert response_webhook.json() == {"status": "success"}
+
+    db.expire_all()
+    assert order.billing_status is True
+    assert [shop_order.billing_status for shop_order in order.shop_orders] == [True, True]
+    assert (
+        db.query(StripeEvent).filter(StripeEvent.id.in_(event_ids), StripeEvent.processed_at.isnot(None)).count() == 2
+    )
+    revenue = db.query(ShopRevenueDaily).filter(ShopRevenueDaily.shop_id == shop_order.shop_id).one()
+    assert (revenue.order_count, revenue.revenue) == (2, 15.0)
+    db.query(StripeEvent).filter(StripeEvent.id.in_(event_ids)).delete()
+    db.commit()
+    db.close()
+    delete_user(new_shop)
+
+
+def test_stripe_webhook_invalid_signature(fake):
+    response = post_stripe_event(payment_succeeded_event(fake.uuid4(), fake.uuid4(), 1), secret="whsec_wrong")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid signature."}
+
+
+def test_order_create_same_cart_twice(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    shop_id = new_shop.json()["id"]
+    db = TestingSessionLocal()
+    cart_lines = utils.get_cart_lines(db, shop_id)
+    db.rollback()
+    # both requests of a double-submitted checkout read the cart before Stripe answers with the same PaymentIntent
+    first = orders._place_order(db, shop_id, "first@example.com", cart_lines, "pi_same_cart", OrderBase(**order_data))
+    second_db = TestingSessionLocal()
+    second = orders._place_order(
+        second_db, shop_id, "first@example.com", cart_lines, "pi_same_cart", OrderBase(**order_data)
+    )
+    assert second.id == first.id
+    assert db.query(Order).filter(Order.order_key == "pi_same_cart").count() == 1
+    assert db.query(OrderItem).filter(OrderItem.order_id == first.id).count() == len(cart_lines)
+
+    # a checkout with another PaymentIntent finds its cart lines already ordered
+    with pytest.raises(HTTPException) as error:
+        orders._place_order(second_db, shop_id, "first@example.com", cart_lines, "pi_other", OrderBase(**order_data))
+    assert error.value.status_code == 409
+    assert db.query(Order).filter(Order.order_key == "pi_other").count() == 0
+    db.close()
+    second_db.close()
+    delete_user(new_shop)
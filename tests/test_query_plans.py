@@ -0,0 +1,90 @@
+import pytest
+
+from shop import utils
+from shop.database import TestingSessionLocal, test_engine
+from shop.models import CartItem, Category, Item, ItemReview, NewsLetter, Order, OrderItem, Shop, ShopOrder, User
+from tests.conftest import capture_statements
+
+
+def get_full_scans(statement: str, parameters) -> list[str]:
+    with test_engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("SET enable_seqscan = off")
+            plan = [row[0] for row in connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)]
+            return [line for line in plan if "Seq Scan" in line]
+        plan = [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+        return [line for line in plan if line.startswith("SCAN") and "INDEX" not in line and "CONSTANT" not in line]
+
+
+@pytest.fixture
+def seeded_db(fake):
+    db = TestingSessionLocal()
+    user = User(username=fake.user_name() + fake.uuid4(), email=fake.uuid4() + fake.email(), is_active=True)
+    user.set_password(fake.password())
+    shop = Shop(shop_name=fake.uuid4(), slug=fake.uuid4(), is_approved=True)
+    user.shop = shop
+    category = Category(shop=shop, name="plan-category", slug=fake.uuid4())
+    item = Item(shop=shop, category=category, name="plan-item", slug=fake.uuid4(), price=10.0)
+    order = Order(user=user, order_key=fake.uuid4(), total_paid=10.0)
+    db.add_all(
+        [
+            user,
+            CartItem(user=user, item=item, price=10.0),
+            OrderItem(order=order, item=item, price=10.0),
+            ShopOrder(shop=shop, order=order, user=user, total_paid=10.0),
+            ItemReview(item=item, user=user, stars=5, comment="plan-review"),
+        ]
+    )
+    user.items.append(item)
+    newsletter = NewsLetter(email=fake.uuid4() + fake.email())
+    db.add(newsletter)
+    db.flush()
+    utils.update_shop_revenue(db, [shop_order.id for shop_order in order.shop_orders])
+    db.commit()
+    yield db, user, shop, category, item, order, newsletter
+    db.delete(newsletter)
+    db.delete(user)
+    db.commit()
+    db.close()
+
+
+def test_get_queries_use_indexes(seeded_db):
+    db, user, shop, category, item, order, newsletter = seeded_db
+    shop_order = order.shop_orders[0]
+    calls = [
+        lambda: utils.get_user_by_id(db, user.id),
+        lambda: utils.get_user_by_email(db, user.email),
+        lambda: utils.get_shop_by_slug(db, shop.slug),
+        lambda: utils.get_category_by_slug_and_shop_id(db, shop.id, category.slug),
+        lambda: utils.get_category_by_slug(db, category.slug),
+        lambda: utils.get_item_by_slug_for_shop(db, shop.id, item.slug),
+        lambda: utils.get_item_by_slug(db, item.slug),
+        lambda: utils.get_available_items(db, shop.slug, category.name),
+        lambda: utils.get_item_review_ids(db, item.id),
+        lambda: utils.get_cart_item(db, user.id, item.id),
+        lambda: utils.get_cart_items(db, user.id),
+        lambda: utils.get_orders(db, user.id),
+        lambda: utils.get_order_by_order_id(db, order.id),
+        lambda: utils.get_order_by_order_key(db, order.order_key),
+        lambda: utils.get_shop_orders(db, shop.id),
+        lambda: utils.get_shop_order_by_order_id(db, shop_order.id, shop.id),
+        lambda: utils.get_shop_orders_by_user_id_for_shop(db, user.id, shop.id),
+        lambda: utils.get_all_users_ordered_in_shop(db, shop.id),
+        lambda: utils.get_stats_for_each_item(db, shop.id),
+        lambda: utils.get_total_revenue_with_filtering(db, shop.id, "2000-01-01", "2999-01-01"),
+        lambda: utils.get_total_revenue(db, shop.id),
+        lambda: utils.get_newsletter_by_id(db, newsletter.id),
+        lambda: utils.get_cart_item_by_id(db, user.cart_items[0].id),
+        lambda: utils.get_shop_order_by_id(db, shop_order.id),
+        lambda: utils.get_item_review_by_id(db, item.reviews[0].id),
+    ]
+    full_scans = []
+    for call in calls:
+        db.expire_all()
+        with capture_statements(parameters=True) as statements:
+            call()
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            full_scans += [(statement, line) for line in get_full_scans(statement, parameters)]
+    assert not full_scans
@@ -0,0 +1,54 @@
+import shutil
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+
+from shop.database import ReplicaSet, test_engine
+from shop.main import app
+from tests.conftest import capture_statements
+
+
+def make_replica(path: str):
+    # a copy of the test database, standing in for a replica of the primary
+    with test_engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint")
+    shutil.copyfile("test.db", path)
+    return create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+
+def test_replicas_round_robin_skips_unhealthy(tmp_path):
+    first, second = make_replica(str(tmp_path / "replica_1.db")), make_replica(str(tmp_path / "replica_2.db"))
+    broken = create_engine("sqlite:////nonexistent/replica.db")
+    try:
+        replicas = ReplicaSet([first, broken, second], health_interval=60)
+        assert [replicas.choose() for _ in range(4)] == [first, second, second, first]
+
+        replicas.mark_down(first)
+        assert [replicas.choose() for _ in range(2)] == [second, second]
+        replicas.mark_down(second)
+        assert replicas.choose() is None
+    finally:
+        for replica in (first, second):
+            replica.dispose()
+
+
+def test_reads_go_to_primary_after_own_write(fake, tmp_path):
+    replica = make_replica(str(tmp_path / "replica.db"))
+    client = TestClient(app)
+    try:
+        with capture_statements(replica) as statements, patch(
+            "shop.database.replicas", ReplicaSet([replica], health_interval=60)
+        ):
+            assert client.get("/items/").status_code == 200
+            assert statements
+
+            # the write marks the client, its next reads are served by the primary
+            statements.clear()
+            response = client.post("/newsletter/signup/", json={"email": fake.email()})
+            assert response.status_code == 200
+            assert "last_write" in response.cookies
+            assert client.get("/items/").status_code == 200
+            assert statements == []
+    finally:
+        replica.dispose()
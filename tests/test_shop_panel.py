@@ -1,3 +1,7 @@
+from datetime import date, datetime, timedelta, timezone
+
+from shop.database import TestingSessionLocal
+from shop.utils import rebuild_shop_revenue
 from tests.conftest import client, create_order, delete_user, get_headers
 from tests.factories import ShopFactory
 
@@ -82,6 +86,35 @@ def test_get_all_shop_users(order_data):
     delete_user(new_shop)
 
 
+def test_get_all_shop_users_sorted_by_total_spent(order_data):
+    user_data_dict_1 = ShopFactory.create()
+    new_shop = user_data_dict_1["new_shop"]
+    user_id_1 = new_shop.json()["id"]
+    item_slug = user_data_dict_1["item_slug"]
+    user_data_dict_2 = ShopFactory.create(role="CUSTOMER")
+    new_user = user_data_dict_2["new_user"]
+    user_id_2 = new_user.json()["id"]
+    for _ in range(3):
+        response_cart = client.post(f"/add-to-the-cart/{item_slug}/", headers=get_headers(user_id_2))
+        assert response_cart.status_code == 200
+    create_order(order_data, user_id_2)
+    create_order(order_data, user_id_1)
+
+    response = client.get("/shop-admin/users/?sort_by=total_spent", headers=get_headers(user_id_1))
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [user_id_2, user_id_1]
+    assert response.json()[0]["total_spent"] == 30
+    assert response.json()[0]["order_count"] == 1
+
+    response_page = client.get(
+        "/shop-admin/users/?sort_by=total_spent&limit=1&offset=1", headers=get_headers(user_id_1)
+    )
+    assert response_page.status_code == 200
+    assert [user["id"] for user in response_page.json()] == [user_id_1]
+    delete_user(new_shop)
+    delete_user(new_user)
+
+
 def test_get_all_shop_orders_per_user(order_data):
     user_data_dict_1 = ShopFactory.create()
     new_shop_1 = user_data_dict_1["new_shop"]
@@ -119,6 +152,38 @@ def test_get_shop_stats_for_each_item(order_data):
     delete_user(new_shop)
 
 
+def test_get_shop_stats_for_each_item_with_filtering(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    item_slug = user_data_dict["item_slug"]
+    item_id = user_data_dict["item_id"]
+    response_cart = client.post(f"/add-to-the-cart/{item_slug}/", headers=get_headers(user_id))
+    assert response_cart.status_code == 200
+    response_order = create_order(order_data, user_id)
+    assert response_order.status_code == 200
+    start_date, end_date = date.today() - timedelta(days=1), date.today() + timedelta(days=1)
+    response = client.get(
+        f"/shop-admin/stats-items/?start_date={start_date}&end_date={end_date}", headers=get_headers(user_id)
+    )
+    assert response.status_code == 200
+    assert response.json()[str(item_id)]["quantity"] == 2
+    assert response.json()[str(item_id)]["reviews_count"] == 0
+    response_past = client.get(
+        "/shop-admin/stats-items/?start_date=2020-01-01&end_date=2020-09-01", headers=get_headers(user_id)
+    )
+    assert response_past.status_code == 409
+    assert response_past.json() == {"detail": "No items have been sold in your shop."}
+    # orders of the end day are counted, created_at is in UTC
+    today = datetime.now(timezone.utc).date()
+    response_today = client.get(
+        f"/shop-admin/stats-items/?start_date={today}&end_date={today}", headers=get_headers(user_id)
+    )
+    assert response_today.status_code == 200
+    assert response_today.json()[str(item_id)]["quantity"] == 2
+    delete_user(new_shop)
+
+
 def test_get_total_revenue_with_filtering(order_data):
     user_data_dict = ShopFactory.create()
     new_shop = user_data_dict["new_shop"]
@@ -151,6 +216,28 @@ def test_get_total_revenue_without_filtering(order_data):
     delete_user(new_shop)
 
 
+def test_get_total_revenue_after_backfill(order_data):
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    item_slug = user_data_dict["item_slug"]
+    response_cart = client.post(f"/add-to-the-cart/{item_slug}/", headers=get_headers(user_id))
+    assert response_cart.status_code == 200
+    response_order = create_order(order_data, user_id)
+    assert response_order.status_code == 200
+    db = TestingSessionLocal()
+    rebuild_shop_revenue(db)
+    db.commit()
+    db.close()
+    start_date, end_date = date.today() - timedelta(days=1), date.today() + timedelta(days=1)
+    response = client.get(
+        f"/shop-admin/revenue/?start_date={start_date}&end_date={end_date}", headers=get_headers(user_id)
+    )
+    assert response.status_code == 200
+    assert response.json()["Revenue"] == response_order.json()["total_paid"]
+    delete_user(new_shop)
+
+
 def test_get_total_revenue_with_filtering_date_issue(order_data):
     user_data_dict = ShopFactory.create()
     new_shop = user_data_dict["new_shop"]
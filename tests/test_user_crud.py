@@ -1,4 +1,12 @@
-from conftest import client, create_user, delete_user, ger_user_by_id_approve, get_headers
+from conftest import (
+    capture_statements,
+    client,
+    create_user,
+    delete_user,
+    ger_user_by_id_approve,
+    get_headers,
+    get_user_by_id_and_assign_inactive,
+)
 
 from shop import models
 from shop.database import test_engine
@@ -143,3 +151,22 @@ def test_patch_user_not_auth():
     response = client.patch(f"user/", json=data)
     assert response.status_code == 401
     assert response.json() == {"detail": "Not authenticated"}
+
+
+def test_authenticated_requests_cache_principal():
+    user_data_dict = ShopFactory.create()
+    new_shop = user_data_dict["new_shop"]
+    user_id = new_shop.json()["id"]
+    assert client.get("/shop-admin/categories/", headers=get_headers(user_id)).status_code == 200
+
+    with capture_statements() as statements:
+        response = client.get("/shop-admin/categories/", headers=get_headers(user_id))
+    assert response.status_code == 200
+    assert not [statement for statement in statements if "FROM users" in statement or "FROM shop " in statement]
+
+    # changing the user drops the cached principal
+    get_user_by_id_and_assign_inactive(user_id)
+    response = client.get("/shop-admin/categories/", headers=get_headers(user_id))
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Please activate your account."}
+    delete_user(new_shop)